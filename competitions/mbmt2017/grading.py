@@ -12,11 +12,15 @@ from django.db.models import Q
 import math
 import statistics
 
+import numpy as np
 import scipy.optimize
 
 import grading.models as g
-import home.models as f
+import coaches.models as c
 from grading.grading import CompetitionGrader, ChillDictionary, cached, cache_get, cache_set
+from grading.tables import ScoreTable
+from grading.profiling import profiled
+from grading import aggregates, parallel
 from grading.models import CORRECT, ESTIMATION
 
 
@@ -37,14 +41,17 @@ class Grader(CompetitionGrader):
 
     LAMBDA = 0.52
 
-    cache = {}
+    scoreboards = ("calculate_individual_scores", "calculate_team_scores")
+    live_rounds = ("guts",)
+
+    # Question 26 scores each estimate against those of the other teams
+    live_incremental = False
 
     def __init__(self, competition: g.Competition):
         """Initialize the MBMT 2017 grader."""
 
         super().__init__(competition)
         self.individual_bonus = {}
-        self.individual_powers = {}
 
         # Question graders
         self.register_question_grader(
@@ -57,29 +64,14 @@ class Grader(CompetitionGrader):
             Q(type=ESTIMATION),
             self.guts_question_grader)
 
+    @profiled()
     def _calculate_individual_modifiers(self, round1, round2):
         """Calculate the point bonuses for an individual round."""
 
         self.individual_bonus = {}
 
-        factors = ChillDictionary({division: ChillDictionary() for division in f.DIVISIONS_MAP})
-        for i, round in enumerate((round1, round2)):
-            for question in round.questions.all():
-                for answer in g.Answer.objects.filter(question=question).all():
-
-                    # Ignore absent students
-                    if not answer.student.attending:
-                        continue
-
-                    # Ignores people2017 whose grading view is not opened
-                    division = answer.student.team.division
-                    subject = answer.student.subject1 if i == 0 else answer.student.subject2
-
-                    # Set atomic factor to correct and total values
-                    if question.number not in factors[division][subject]:
-                        factors[division][subject][question.number] = [0, 0]  # Correct, total
-                    factors[division][subject][question.number][0] += answer.value or 0
-                    factors[division][subject][question.number][1] += 1
+        # Correct and total answers of attending students
+        factors = aggregates.subject_question_counts(((round1, "subject1"), (round2, "subject2")))
 
         for division in factors:
             self.individual_bonus[division] = {}
@@ -97,6 +89,7 @@ class Grader(CompetitionGrader):
             return 0.375 - 1.0/len(scores) * sum(pow(score, d) for score in scores if score != 0)
         return power_average
 
+    @profiled()
     def _calculate_individual_exponent(self, scores):
         """Determines the exponent for an individual subject test."""
 
@@ -143,49 +136,44 @@ class Grader(CompetitionGrader):
                 value = 0 if e <= 0 else max(0, 12 - 4 * math.log10(max(e/a, a/e)))
         return value * question.weight
 
-    def z_score(self, raw_scores):
+    def z_score(self, raw_scores: ScoreTable):
         """General team round grader based on Z score."""
 
-        scores = ChillDictionary()
-        for division in raw_scores:
-            scores[division] = ChillDictionary()
-            data = list(map(lambda team: raw_scores[division][team], raw_scores[division]))
-            mean = statistics.mean(data)
-            dev = statistics.stdev(data, mean)
-            for team in raw_scores[division]:
-                scores[division][team] = 0 if dev == 0 else (raw_scores[division][team] - mean) / dev
-        return scores.dict()
-
-    @cached(cache, "team_scores")
+        def standardize(data):
+            dev = statistics.stdev(data)
+            return np.zeros(len(data)) if dev == 0 else (data - data.mean()) / dev
+        return raw_scores.transform(standardize)
+
+    @cached(None, "team_scores", depends=(TEAM,))
     def team_round_grader(self, round: g.Round):
         """Grader for the team round."""
 
-        raw_scores = self.grade_round(round)
+        raw_scores = self.grade_round_table(round)
         self.cache_set("raw_team_scores", raw_scores)
         return self.z_score(raw_scores)
 
     # Cached for use in live grading
-    @cached(cache, "guts_scores")
+    @cached(None, "guts_scores", depends=(GUTS,))
     def guts_round_grader(self, round: g.Round):
         """Grader for the guts round."""
 
-        raw_scores = self.grade_round(round)
+        raw_scores = self.grade_round_table(round)
         self.cache_set("raw_guts_scores", raw_scores)
         return self.z_score(raw_scores)
 
-    @cached(cache, "raw_guts_score")
+    @cached(None, "raw_guts_score", depends=(GUTS,))
     def guts_live_round_scores(self):
         """Guts live round."""
 
-        round = self.competition.rounds.filter(ref="guts").first()
-        return self.grade_round(round)
+        round = self.round("guts")
+        return self.grade_round_table(round)
 
-    @cached(cache, "individual_scores")
+    @cached(None, "individual_scores", depends=(SUBJECT1, SUBJECT2))
     def calculate_individual_scores(self):
         """Custom function that groups both subject rounds together."""
 
-        subject1 = self.competition.rounds.filter(ref="subject1").first()
-        subject2 = self.competition.rounds.filter(ref="subject2").first()
+        subject1 = self.round("subject1")
+        subject2 = self.round("subject2")
         self._calculate_individual_modifiers(subject1, subject2)
         raw_scores1 = self.grade_round(subject1)
         raw_scores2 = self.grade_round(subject2)
@@ -194,11 +182,11 @@ class Grader(CompetitionGrader):
         subject_scores = ChillDictionary()
 
         # This ignores students who received answers for one test but not another
-        for division in f.DIVISIONS_MAP:
+        for division in c.DIVISIONS_MAP:
 
             # Set up dictionary so no missing keys
             subject_scores[division] = ChillDictionary()
-            for subject in f.SUBJECTS_MAP:
+            for subject in c.SUBJECTS_MAP:
                 subject_scores[division][subject] = ChillDictionary()
 
             split_scores[division] = ChillDictionary()
@@ -214,7 +202,7 @@ class Grader(CompetitionGrader):
                 subject_scores[division][student.subject1][student] = score1
                 subject_scores[division][student.subject2][student] = score2
 
-        self.cache_set("subject_scores", subject_scores.dict())
+        self.cache_set("subject_scores", ScoreTable.from_scores("student", subject_scores, subjects=True))
 
         powers = ChillDictionary()
         max_scores = ChillDictionary()
@@ -232,7 +220,7 @@ class Grader(CompetitionGrader):
                 # Doesn't work for fewer than 3 scores
                 else:
                     powers[division][subject] = 0
-        self.individual_powers = powers.dict()
+        self.cache_set("individual_powers", powers.dict())
 
         raw_scores = ChillDictionary()
         final_scores = ChillDictionary()
@@ -250,50 +238,48 @@ class Grader(CompetitionGrader):
                 raw_scores[division][student] = score
                 final_scores[division][student] = score
 
-        self.cache_set("raw_individual_scores", raw_scores.dict())
+        self.cache_set("raw_individual_scores", ScoreTable.from_scores("student", raw_scores))
 
-        return final_scores.dict()
+        return ScoreTable.from_scores("student", final_scores)
 
-    @cached(cache, "team_individual_scores")
+    @cached(None, "team_individual_scores", depends=(SUBJECT1, SUBJECT2))
     def calculate_team_individual_scores(self):
         """Custom function that combines team and guts scores."""
 
         raw_scores = self.calculate_individual_scores(use_cache=True)
-        final_scores = ChillDictionary()
-        for team in f.Team.current():
+        teams = list(self.teams().prefetch_related("students"))
+        scores = []
+        for team in teams:
             score = 0
             count = 0
             for student in team.students.all():
-                if student.attending and team.division in raw_scores and student in raw_scores[team.division]:
-                    score += raw_scores[team.division][student]
+                if student.attending and student in raw_scores:
+                    score += raw_scores.get(student)
                     count += 1
-            final_scores[team.division][team] = 0 if count == 0 else score / count
-        return final_scores.dict()
+            scores.append(0 if count == 0 else score / count)
+        return ScoreTable("team", [team.id for team in teams], [team.division for team in teams], scores)
 
-    @cached(cache, "team_overall_scores")
+    @cached(None, "team_overall_scores", depends=(SUBJECT1, SUBJECT2, TEAM, GUTS))
     def calculate_team_scores(self, use_cache=True):
         """Calculate the team scores."""
 
-        team_round = self.competition.rounds.filter(ref=TEAM).first()
-        guts_round = self.competition.rounds.filter(ref=GUTS).first()
-        individual_scores = self.calculate_team_individual_scores(use_cache=use_cache)
-        team_round_scores = self.team_round_grader(team_round, use_cache=use_cache)
-        guts_round_scores = self.guts_round_grader(guts_round, use_cache=use_cache)
-
-        final_scores = ChillDictionary()
-        for team in f.Team.current():
-            score = 0
-            if team in individual_scores[team.division]:
-                score += 0.4 * individual_scores[team.division][team]
-            if team in team_round_scores[team.division]:
-                score += 0.3 * team_round_scores[team.division][team]
-            if team in guts_round_scores[team.division]:
-                score += 0.3 * guts_round_scores[team.division][team]
-
-            final_scores[team.division][team] = score
-        return final_scores.dict()
-
-    def grade_competition(self, competition):
+        team_round = self.round(TEAM)
+        guts_round = self.round(GUTS)
+        individual_scores, team_round_scores, guts_round_scores = parallel.concurrently(
+            lambda: self.calculate_team_individual_scores(use_cache=use_cache),
+            lambda: self.team_round_grader(team_round, use_cache=use_cache),
+            lambda: self.guts_round_grader(guts_round, use_cache=use_cache))
+
+        teams = list(self.teams())
+        scores = []
+        for team in teams:
+            scores.append(
+                0.4 * individual_scores.get(team) +
+                0.3 * team_round_scores.get(team) +
+                0.3 * guts_round_scores.get(team))
+        return ScoreTable("team", [team.id for team in teams], [team.division for team in teams], scores)
+
+    def grade_competition(self):
         """Grade the entire competition."""
 
         pass
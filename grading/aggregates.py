@@ -0,0 +1,48 @@
+"""Grouped database aggregates used by the yearly graders.
+
+Statistics that graders derive from every answer, such as how many
+students answered each question correctly, are computed by the
+database in one grouped query rather than by loading each answer and
+its student and team.
+"""
+
+from django.db.models import Case, When, F, Sum, Count, CharField
+
+import coaches.models
+from . import models
+
+
+def subject_question_counts(rounds):
+    """Count correct and total answers of attending students.
+
+    Empty answers, such as those created for answer sheets, are not
+    counted, so counts are the same whether or not they exist.
+
+    The rounds are given as pairs of a round and the student field,
+    `subject1` or `subject2`, holding the subject its answers count
+    toward. Returns the correct and total counts as a tuple by
+    division, subject, and question number, with every division
+    present. Counts of questions with the same number in several
+    rounds are added together.
+    """
+
+    rounds = list(rounds)
+    counts = {division: {} for division in coaches.models.DIVISIONS_MAP}
+    if not rounds:
+        return counts
+
+    subject = Case(
+        *(When(question__round=round, then=F("student__" + field)) for round, field in rounds),
+        output_field=CharField())
+    rows = models.Answer.objects.filter(
+        question__round__in=[round for round, field in rounds], student__attending=True, value__isnull=False,
+    ).annotate(subject=subject).values(
+        "student__team__division", "subject", "question__number",
+    ).annotate(correct=Sum("value"), total=Count("id")).order_by()
+
+    for row in rows:
+        division = counts.setdefault(row["student__team__division"], {})
+        subject_counts = division.setdefault(row["subject"], {})
+        correct, total = subject_counts.get(row["question__number"], (0, 0))
+        subject_counts[row["question__number"]] = (correct + (row["correct"] or 0), total + row["total"])
+    return counts
@@ -0,0 +1,231 @@
+"""Bulk creation and updates of answers.
+
+Before grading starts, the answer grid of every round can be created
+at once, with an empty answer for each question and each team or
+student the round is taken by, so that opening a grading sheet only
+reads. Sheets whose answers are missing have them created in one bulk
+insert, and the values submitted for a sheet are written in one
+transaction with one bulk update, followed by a single propagation of
+the changes to the running totals and generations. Many sheets can be
+submitted at once in the same way, for example by scanning stations.
+"""
+
+from django.db import transaction
+
+import math
+
+import coaches.models
+from . import bulk, generations, models, signals
+
+
+def group(round: models.Round):
+    """Get the answer field of the entities that take a round."""
+
+    return "student" if round.grouping == models.INDIVIDUAL else "team"
+
+
+def entities(round: models.Round):
+    """Get the ids of every team or student of a round's competition."""
+
+    if round.grouping == models.INDIVIDUAL:
+        entities = coaches.models.Student.objects.filter(team__competition=round.competition_id)
+    else:
+        entities = coaches.models.Team.objects.filter(competition=round.competition_id)
+    return entities.values_list("id", flat=True)
+
+
+def missing(round: models.Round, entity_ids, questions=None):
+    """Build the unsaved empty answers missing from a round for some entities."""
+
+    field = group(round) + "_id"
+    questions = list(round.questions.all()) if questions is None else questions
+    existing = set(models.Answer.objects.filter(
+        question__round=round, **{field + "__in": entity_ids}).values_list(field, "question_id"))
+    return [
+        models.Answer(question_id=question.id, **{field: entity_id})
+        for entity_id in entity_ids for question in questions
+        if (entity_id, question.id) not in existing]
+
+
+def materialize(competition, rounds=None):
+    """Create the empty answers missing from the grid of every round.
+
+    Returns the number of answers created.
+    """
+
+    rounds = list(competition.rounds.all() if rounds is None else rounds)
+    created = {}
+    with transaction.atomic():
+        for round in rounds:
+            answers = missing(round, list(entities(round)))
+            models.Answer.objects.bulk_create(answers, batch_size=500)
+            if answers:
+                created[round.id] = len(answers)
+
+        # Empty answers score and count nothing, but are regraded all the same
+        generations.bump(created)
+    return sum(created.values())
+
+
+def sheet(round: models.Round, entity):
+    """Get the questions of a round paired with the answers of a team or student.
+
+    Missing answers are created empty in one bulk insert. Of several
+    answers to a question, the first is used.
+    """
+
+    field = group(round)
+    questions = list(round.questions.order_by("number"))
+    answers = models.Answer.objects.filter(question__round=round, **{field: entity}).order_by("id")
+    by_question = {}
+    for answer in answers:
+        by_question.setdefault(answer.question_id, answer)
+
+    absent = [question for question in questions if question.id not in by_question]
+    if absent:
+        models.Answer.objects.bulk_create(models.Answer(question=question, **{field: entity}) for question in absent)
+        for answer in models.Answer.objects.filter(question__in=absent, **{field: entity}).order_by("id"):
+            by_question.setdefault(answer.question_id, answer)
+        generations.bump([round.id])
+
+    for question in questions:
+        by_question[question.id].question = question
+    return [(question, by_question[question.id]) for question in questions]
+
+
+def write(values):
+    """Save new values of answers in one transaction.
+
+    Takes pairs of an answer and its new value, and only writes the
+    answers whose value differs from the stored one. Returns the
+    changed answers.
+    """
+
+    changes = [(answer, answer.stored_value, value) for answer, value in values if answer.stored_value != value]
+    if not changes:
+        return []
+
+    with transaction.atomic():
+        for answer, old, new in changes:
+            answer.value = new
+        bulk.update(models.Answer, [answer for answer, old, new in changes], ("value",))
+        signals.answers_changed(changes)
+    for answer, old, new in changes:
+        answer.stored_value = new
+    return [answer for answer, old, new in changes]
+
+
+# Most sheets accepted in one submission
+MAX_SHEETS = 1000
+
+
+class SheetError(ValueError):
+    """Raised when a submitted sheet of answers is invalid."""
+
+
+def parse_value(question: models.Question, value):
+    """Check a submitted answer value against its question."""
+
+    if value is None:
+        return None
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or not math.isfinite(value):
+        raise SheetError("Question {} needs a number or null, not {!r}.".format(question.number, value))
+    if question.type == models.CORRECT and value not in (0, 1):
+        raise SheetError("Question {} is marked correct or not, so needs 0, 1, or null.".format(question.number))
+    return float(value)
+
+
+def submit(competition, rows):
+    """Save many sheets of answers to a competition in one transaction.
+
+    Each row names a round by `round`, a team or student by `team` or
+    `student`, and maps question numbers to values in `answers`. Rows
+    are checked against the round's questions, and the answers of valid
+    rows are created or updated together. Returns a result per row,
+    either the number of answers created and changed or the errors
+    that kept the row from being saved.
+    """
+
+    rows = list(rows)
+    rounds = {round.ref: round for round in competition.rounds.all()}
+    questions = {}
+    for question in models.Question.objects.filter(round__competition=competition):
+        questions.setdefault(question.round_id, {})[question.number] = question
+    known = {
+        "team": set(coaches.models.Team.objects.filter(competition=competition).values_list("id", flat=True)),
+        "student": set(coaches.models.Student.objects.filter(
+            team__competition=competition).values_list("id", flat=True))}
+
+    # Check each row and collect the values of valid ones
+    results, valid = [], []
+    for index, row in enumerate(rows):
+        try:
+            if not isinstance(row, dict):
+                raise SheetError("Rows must be objects.")
+            round = rounds.get(row.get("round"))
+            if round is None:
+                raise SheetError("Unknown round {!r}.".format(row.get("round")))
+            field = group(round)
+            entity = row.get(field)
+            if isinstance(entity, bool) or not isinstance(entity, int) or entity not in known[field]:
+                raise SheetError("Unknown {} {!r} for round {}.".format(field, entity, round.ref))
+            if not isinstance(row.get("answers"), dict):
+                raise SheetError("Answers must map question numbers to values.")
+            values = {}
+            for number, value in row["answers"].items():
+                try:
+                    question = questions.get(round.id, {})[int(number)]
+                except (KeyError, ValueError):
+                    raise SheetError("Round {} has no question {!r}.".format(round.ref, number))
+                values[question.id] = parse_value(question, value)
+        except SheetError as exception:
+            results.append({"index": index, "ok": False, "error": str(exception)})
+            continue
+        results.append({"index": index, "ok": True, "created": 0, "changed": 0})
+        valid.append((index, round, field, entity, values))
+
+    with transaction.atomic():
+
+        # Find the answers of every valid sheet, creating missing ones
+        existing = {}
+        for field in ("team", "student"):
+            entities = set(entity for index, round, f, entity, values in valid if f == field)
+            if not entities:
+                continue
+            sheets = models.Answer.objects.filter(
+                question__round__competition=competition, **{field + "__in": entities}).order_by("id")
+            for answer in sheets:
+                existing.setdefault((field, getattr(answer, field + "_id"), answer.question_id), answer)
+
+        created = []
+        for index, round, field, entity, values in valid:
+            for question_id in values:
+                if (field, entity, question_id) not in existing:
+                    existing[field, entity, question_id] = None
+                    created.append(models.Answer(question_id=question_id, **{field + "_id": entity}))
+                    results[index]["created"] += 1
+        if created:
+            models.Answer.objects.bulk_create(created, batch_size=500)
+            for field in ("team", "student"):
+                entities = set(getattr(answer, field + "_id") for answer in created) - {None}
+                fresh = models.Answer.objects.filter(
+                    question_id__in=set(answer.question_id for answer in created),
+                    **{field + "__in": entities}).order_by("id")
+                for answer in fresh:
+                    key = (field, getattr(answer, field + "_id"), answer.question_id)
+                    if existing.get(key) is None:
+                        existing[key] = answer
+            generations.bump(set(round.id for index, round, field, entity, values in valid))
+
+        # Later rows for the same answer win
+        latest = {}
+        for index, round, field, entity, values in valid:
+            for question_id, value in values.items():
+                latest[field, entity, question_id] = (index, value)
+        changed = write((existing[key], value) for key, (index, value) in latest.items())
+        changed = set(answer.id for answer in changed)
+        for key, (index, value) in latest.items():
+            if existing[key].id in changed:
+                results[index]["changed"] += 1
+
+    return results
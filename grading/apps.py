@@ -3,3 +3,6 @@ from django.apps import AppConfig
 
 class GradingConfig(AppConfig):
     name = 'grading'
+
+    def ready(self):
+        from . import signals
@@ -0,0 +1,238 @@
+"""Storage backends for cached grader results.
+
+By default results are kept in a size-bounded store local to the
+process. If the `GRADING_CACHE` setting names one of Django's caches,
+results are stored there instead so that every worker process reads
+and writes the same entries. Locks that serialize computing an entry
+across processes are entries added to the same cache, so they only
+exclude each other if the cache adds atomically and never culls them,
+as Memcached and Redis do. A file-based cache checks for an entry and
+then sets it, and culls entries at random once full, so while it
+shares results offline it gives no mutual exclusion between processes.
+"""
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+
+import collections
+import threading
+import time
+
+
+DEFAULT_MAX_ENTRIES = 256
+
+# Seconds before a lock left by a crashed process expires
+LOCK_TIMEOUT = 300
+LOCK_POLL = 0.1
+
+
+class LocalStore:
+    """Process-local store that evicts the least recently used entry."""
+
+    def __init__(self, max_entries: int=DEFAULT_MAX_ENTRIES):
+        """Initialize an empty store."""
+
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()
+        self.lock = threading.RLock()
+
+    def get(self, key, default=None):
+        """Get an entry by key."""
+
+        with self.lock:
+            if key not in self.entries:
+                return default
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+    def set(self, key, value):
+        """Set an entry, evicting old entries if the store is full."""
+
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def add(self, key, value, timeout=None):
+        """Set an entry only if it is missing, returning whether it was."""
+
+        with self.lock:
+            if key in self.entries:
+                return False
+            self.set(key, value)
+            return True
+
+    def delete(self, key):
+        """Remove an entry."""
+
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        """Remove all entries."""
+
+        with self.lock:
+            self.entries.clear()
+
+
+class DjangoStore:
+    """Store backed by one of the caches configured in the settings."""
+
+    def __init__(self, alias: str):
+        """Initialize the store for a cache alias."""
+
+        self.alias = alias
+
+    @property
+    def cache(self):
+        """Get the cache, which Django keeps per thread."""
+
+        return caches[self.alias]
+
+    def get(self, key, default=None):
+        """Get an entry by key."""
+
+        return self.cache.get(key, default)
+
+    def set(self, key, value):
+        """Set an entry without expiry, eviction is left to the cache."""
+
+        self.cache.set(key, value, None)
+
+    def add(self, key, value, timeout=None):
+        """Set an entry only if it is missing, returning whether it was."""
+
+        return self.cache.add(key, value, timeout)
+
+    def delete(self, key):
+        """Remove an entry."""
+
+        self.cache.delete(key)
+
+    def clear(self):
+        """Remove all entries."""
+
+        self.cache.clear()
+
+
+local = LocalStore()
+
+_thread_locks = {}
+_thread_locks_lock = threading.Lock()
+
+
+def thread_lock(key):
+    """Get the lock of a key shared by the threads of this process."""
+
+    with _thread_locks_lock:
+        if key not in _thread_locks:
+            _thread_locks[key] = threading.Lock()
+        return _thread_locks[key]
+
+
+class Flight:
+    """Lock ensuring a cache entry is computed by one caller at a time.
+
+    Threads of a process wait on an ordinary lock, while processes
+    take turns through a lock entry added to the store itself. The
+    lock entry expires in case its owner dies while holding it.
+    """
+
+    def __init__(self, store, key, timeout: int=LOCK_TIMEOUT):
+        """Initialize the lock for a store key."""
+
+        self.store = store
+        self.key = key + ":lock"
+        self.timeout = timeout
+        self.lock = thread_lock(key)
+
+    def acquire(self, blocking: bool=True):
+        """Acquire the lock, returning whether it was acquired."""
+
+        if not self.lock.acquire(blocking):
+            return False
+        deadline = time.time() + self.timeout
+        while not self.store.add(self.key, True, self.timeout):
+            if not blocking:
+                self.lock.release()
+                return False
+            if time.time() > deadline:
+                self.store.delete(self.key)
+            time.sleep(LOCK_POLL)
+        return True
+
+    def release(self):
+        """Release the lock."""
+
+        self.store.delete(self.key)
+        self.lock.release()
+
+
+def get_store():
+    """Get the store configured by the settings."""
+
+    alias = getattr(settings, "GRADING_CACHE", None)
+    if alias is None:
+        return local
+    return DjangoStore(alias)
+
+
+def is_shared():
+    """Check whether the configured store is shared between processes."""
+
+    alias = getattr(settings, "GRADING_CACHE", None)
+    return alias is not None and not isinstance(caches[alias], LocMemCache)
+
+
+class GradeCache:
+    """Dictionary-like view of the cached results of one competition.
+
+    Keys are namespaced by the competition so that graders of several
+    competitions can share a store without colliding.
+    """
+
+    def __init__(self, namespace, store=None):
+        """Initialize the cache for a namespace."""
+
+        self.namespace = namespace
+        self.store = store or get_store()
+
+    def key(self, name):
+        """Get the store key of an entry."""
+
+        return "grading:{}:{}".format(self.namespace, name)
+
+    def get(self, name, default=None):
+        """Get an entry by name."""
+
+        return self.store.get(self.key(name), default)
+
+    def __getitem__(self, name):
+        """Get an entry by name, raising if it is missing."""
+
+        item = self.get(name)
+        if item is None:
+            raise KeyError(name)
+        return item
+
+    def __setitem__(self, name, item):
+        """Set an entry by name."""
+
+        self.store.set(self.key(name), item)
+
+    def __delitem__(self, name):
+        """Remove an entry by name."""
+
+        self.store.delete(self.key(name))
+
+    def __contains__(self, name):
+        """Check whether an entry is present."""
+
+        return self.get(name) is not None
+
+    def flight(self, name):
+        """Get the lock that serializes computing an entry."""
+
+        return Flight(self.store, self.key(name))
@@ -0,0 +1,85 @@
+"""Benchmark harness timing the yearly graders on synthetic competitions.
+
+Each benchmark loads a year's test competition into a fresh synthetic
+competition of a given number of teams, recalculates every scoreboard
+without the cache, and records the wall time and the stage breakdown
+of the run. Everything runs in a transaction that is rolled back, with
+results cached in process, so the database and shared grading cache
+are left as they were. Since worker threads would not see the
+uncommitted competition, steps are run serially.
+"""
+
+from django.db import connection, transaction
+from django.test.utils import override_settings
+
+import sys
+import time
+import platform
+import traceback
+import numpy as np
+
+from . import plans, profiling, synthetic
+
+
+class Rollback(Exception):
+    """Raised to roll back the transaction of a benchmark."""
+
+
+def measure(grader, repeat: int=1):
+    """Recalculate the scoreboards of a grader and measure each run."""
+
+    runs = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        grader.refresh_scoreboards(use_cache=False)
+        runs.append({"wall": time.perf_counter() - start, "stages": profiling.last_run(grader)})
+    return runs
+
+
+def run_one(year: str, teams: int, repeat: int=1, seed: int=0, **options):
+    """Benchmark one yearly grader at one scale."""
+
+    result = {"year": year, "scale": teams}
+    competition = None
+    try:
+        with override_settings(GRADING_CACHE=None, GRADING_WORKERS=0), transaction.atomic():
+            competition = synthetic.create_competition("Benchmark {} x{}".format(year, teams))
+            competition, (teams, students, answers) = synthetic.generate(year, teams=teams, seed=seed, **options)
+            result.update({"teams": teams, "students": students, "answers": answers})
+            try:
+                runs = measure(competition.grader, repeat)
+                walls = [run["wall"] for run in runs]
+                result.update({"runs": runs, "median": float(np.median(walls)), "min": min(walls)})
+            except Exception:
+                result["error"] = traceback.format_exc()
+            raise Rollback()
+    except Rollback:
+        pass
+    finally:
+        if competition is not None:
+            plans.pool.discard(competition.id)
+    return result
+
+
+def run(years=None, scales=(10, 50, 200), repeat: int=1, seed: int=0, **options):
+    """Benchmark yearly graders at several scales.
+
+    Returns a report that can be dumped as JSON, holding the
+    environment of the run and a result for every year and scale.
+    """
+
+    results = []
+    for year in years or synthetic.years():
+        for scale in scales:
+            results.append(run_one(year, scale, repeat=repeat, seed=seed, **options))
+
+    return {
+        "created": time.time(),
+        "environment": {
+            "python": sys.version.split()[0],
+            "numpy": np.__version__,
+            "platform": platform.platform(),
+            "database": connection.vendor},
+        "repeat": repeat,
+        "seed": seed,
+        "results": results}
@@ -0,0 +1,34 @@
+"""Bulk writes of grading models.
+
+Django only gained bulk updates in 2.2, so rows whose fields differ
+are updated here with one UPDATE per batch, setting each field with a
+conditional expression on the primary key. Like bulk creation, these
+updates send no model signals, and callers are responsible for keeping
+derived state such as totals and generations current.
+"""
+
+from django.db.models import Case, When, Value
+
+# Rows updated per query, keeping SQLite under its variable limit
+BATCH_SIZE = 200
+
+
+def update(model, objects, fields, batch_size: int=BATCH_SIZE):
+    """Write the given fields of saved model instances in batches.
+
+    Returns the number of rows updated.
+    """
+
+    objects = list(objects)
+    updated = 0
+    for start in range(0, len(objects), batch_size):
+        batch = objects[start:start + batch_size]
+        values = {}
+        for name in fields:
+            field = model._meta.get_field(name)
+            cases = (
+                When(pk=instance.pk, then=Value(getattr(instance, field.attname), output_field=field))
+                for instance in batch)
+            values[field.attname] = Case(*cases, output_field=field)
+        updated += model.objects.filter(pk__in=[instance.pk for instance in batch]).update(**values)
+    return updated
@@ -0,0 +1,116 @@
+"""Export of final results as CSV and JSON files.
+
+Results are read from the score tables a grader has cached and laid
+out as flat, ranked rows, one file per kind of result. Entity names,
+teams, and schools are loaded in one query per table.
+"""
+
+import os
+import csv
+import json
+
+import coaches.models
+from . import tables
+
+
+def ranked_rows(table: tables.ScoreTable):
+    """List the rows of a table ranked within their division and subject."""
+
+    table = table.ranked()
+    return zip(table.ranks().tolist(), table)
+
+
+def individual_rows(scores: tables.ScoreTable):
+    """Lay out overall individual scores."""
+
+    students = scores.entities()
+    for rank, (pk, division, _, score) in ranked_rows(scores):
+        student = students[pk]
+        yield {
+            "division": coaches.models.DIVISIONS_MAP[division], "rank": rank, "id": pk,
+            "name": student.name, "team": student.team.name, "school": student.team.school.name,
+            "score": score}
+
+
+def subject_rows(scores: tables.ScoreTable):
+    """Lay out subject test scores."""
+
+    students = scores.entities()
+    for rank, (pk, division, subject, score) in ranked_rows(scores):
+        student = students[pk]
+        yield {
+            "division": coaches.models.DIVISIONS_MAP[division], "subject": coaches.models.SUBJECTS_MAP[subject],
+            "rank": rank, "id": pk, "name": student.name, "team": student.team.name,
+            "school": student.team.school.name, "score": score}
+
+
+def team_rows(overall: tables.ScoreTable, **components):
+    """Lay out overall team scores with their components."""
+
+    teams = overall.entities()
+    for rank, (pk, division, _, score) in ranked_rows(overall):
+        team = teams[pk]
+        row = {"division": coaches.models.DIVISIONS_MAP[division], "rank": rank, "id": pk,
+               "name": team.name, "school": team.school.name}
+        for name, component in components.items():
+            row[name] = None if component is None else component.get(pk)
+        row["score"] = score
+        yield row
+
+
+def results(grader):
+    """Collect the exported results of a grader by file name.
+
+    The scoreboards should have been calculated so that the results
+    are in the grader's cache. Missing results are skipped.
+    """
+
+    def get(name, kind, subjects=False):
+        scores = grader.cache_get(name)
+        return None if scores is None else tables.coerce(scores, kind, subjects)
+
+    exported = {}
+    individual = get("individual_scores", "student")
+    if individual is not None:
+        exported["individual"] = list(individual_rows(individual))
+    subjects = get("subject_scores", "student", subjects=True)
+    if subjects is not None:
+        exported["subject"] = list(subject_rows(subjects))
+    overall = get("team_overall_scores", "team")
+    if overall is not None:
+        exported["team"] = list(team_rows(
+            overall,
+            individual=get("team_individual_scores", "team"),
+            team_round=get("raw_team_scores", "team"),
+            team_round_normalized=get("team_scores", "team"),
+            guts_round=get("raw_guts_scores", "team"),
+            guts_round_normalized=get("guts_scores", "team")))
+    guts = get("raw_guts_scores", "team")
+    if guts is not None:
+        exported["guts"] = list(team_rows(guts))
+    return exported
+
+
+def write_csv(path: str, rows: list):
+    """Write rows of dictionaries to a CSV file."""
+
+    with open(path, "w", newline="") as file:
+        writer = csv.DictWriter(file, fieldnames=list(rows[0].keys()) if rows else [])
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def write(exported: dict, directory: str, formats=("csv", "json")):
+    """Write exported results to a directory, returning the paths written."""
+
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    if "csv" in formats:
+        for name, rows in exported.items():
+            paths.append(os.path.join(directory, name + ".csv"))
+            write_csv(paths[-1], rows)
+    if "json" in formats:
+        paths.append(os.path.join(directory, "results.json"))
+        with open(paths[-1], "w") as file:
+            json.dump(exported, file, indent=2)
+    return paths
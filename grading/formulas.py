@@ -0,0 +1,142 @@
+"""Scoring formulas of estimation questions.
+
+A question can carry a scoring expression over the estimate `e` and
+the correct answer `a`, such as `max(0, 12 - abs(a - e) / 5) / 12`,
+which gives the score of an answer before it is multiplied by the
+question weight. Expressions may use numbers, arithmetic, comparisons,
+conditional expressions, and the functions in `FUNCTIONS`.
+
+Expressions are parsed once and checked against a whitelist of syntax
+before being compiled, so that they can be loaded from competition
+files without running arbitrary code. They are then evaluated on whole
+columns of estimates with NumPy, where scores that are not finite, for
+example after dividing by zero, count as zero.
+"""
+
+import ast
+import functools
+import numpy as np
+
+
+def _reduce(function):
+    """Make a binary NumPy function accept any number of arguments."""
+
+    def reduced(*args):
+        if len(args) < 2:
+            raise TypeError("expected at least two arguments")
+        return functools.reduce(function, args)
+    return reduced
+
+
+# Functions that may be called by name
+FUNCTIONS = {
+    "min": _reduce(np.minimum),
+    "max": _reduce(np.maximum),
+    "abs": np.abs,
+    "log": np.log,
+    "log10": np.log10,
+    "exp": np.exp,
+    "sqrt": np.sqrt,
+    "floor": np.floor,
+    "ceil": np.ceil}
+
+# Names of the estimate and answer
+VARIABLES = ("e", "a")
+
+# Named constants
+CONSTANTS = {"pi": np.pi}
+
+OPERATORS = (
+    ast.Add, ast.Sub, ast.Mult, ast.Div, ast.Pow, ast.Mod, ast.FloorDiv,
+    ast.UAdd, ast.USub,
+    ast.Eq, ast.NotEq, ast.Lt, ast.LtE, ast.Gt, ast.GtE)
+NODES = (ast.Expression, ast.BinOp, ast.UnaryOp, ast.Compare, ast.IfExp, ast.Call, ast.Name, ast.Load) + OPERATORS
+NUMBERS = tuple(getattr(ast, name) for name in ("Constant", "Num") if hasattr(ast, name))
+
+# Longest expression accepted
+MAX_LENGTH = 256
+
+
+class FormulaError(ValueError):
+    """Raised when a scoring expression is invalid or unsafe."""
+
+
+def check(tree: ast.AST):
+    """Check that an expression only uses whitelisted syntax."""
+
+    for node in ast.walk(tree):
+        if isinstance(node, NUMBERS):
+            value = getattr(node, "value", getattr(node, "n", None))
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                raise FormulaError("Only numbers are allowed as constants, not {!r}.".format(value))
+        elif not isinstance(node, NODES):
+            raise FormulaError("{} is not allowed in scoring formulas.".format(type(node).__name__))
+        elif isinstance(node, ast.Name) and node.id not in VARIABLES + tuple(CONSTANTS) + tuple(FUNCTIONS):
+            raise FormulaError("Unknown name {}.".format(node.id))
+        elif isinstance(node, ast.Compare) and len(node.ops) > 1:
+            raise FormulaError("Comparisons cannot be chained.")
+        elif isinstance(node, ast.Call) and (
+                not isinstance(node.func, ast.Name) or node.func.id not in FUNCTIONS or node.keywords):
+            raise FormulaError("Only {} can be called, without keywords.".format(", ".join(FUNCTIONS)))
+
+
+class _Vectorize(ast.NodeTransformer):
+    """Rewrite an expression to evaluate on columns.
+
+    Numbers become NumPy floats, which overflow to infinity, and
+    conditional expressions choose between columns element by element.
+    """
+
+    def visit_Constant(self, node):
+        return ast.copy_location(ast.Call(
+            func=ast.Name(id="float64", ctx=ast.Load()), args=[node], keywords=[]), node)
+
+    visit_Num = visit_Constant
+
+    def visit_IfExp(self, node):
+        self.generic_visit(node)
+        return ast.copy_location(ast.Call(
+            func=ast.Name(id="where", ctx=ast.Load()), args=[node.test, node.body, node.orelse], keywords=[]), node)
+
+
+@functools.lru_cache(maxsize=None)
+def compile_formula(expression: str):
+    """Parse, check, and compile a scoring expression.
+
+    Returns a function of an estimate column and an answer that gives
+    the score column. Compiled formulas are kept by expression.
+    """
+
+    if len(expression) > MAX_LENGTH:
+        raise FormulaError("Scoring formulas are limited to {} characters.".format(MAX_LENGTH))
+    try:
+        tree = ast.parse(expression.strip(), mode="eval")
+    except SyntaxError as exception:
+        raise FormulaError("Invalid scoring formula {!r}: {}.".format(expression, exception.msg))
+    check(tree)
+    code = compile(ast.fix_missing_locations(_Vectorize().visit(tree)), "<scoring>", "eval")
+
+    namespace = {"__builtins__": {}, "float64": np.float64, "where": np.where}
+    namespace.update(CONSTANTS)
+    namespace.update(FUNCTIONS)
+
+    def evaluate(e, a):
+        e = np.asarray(e, dtype=float)
+        a = np.float64(np.nan if a is None else a)
+        with np.errstate(all="ignore"):
+            try:
+                result = eval(code, namespace, {"e": e, "a": a})
+            except (TypeError, ValueError, ArithmeticError) as exception:
+                raise FormulaError("Invalid scoring formula {!r}: {}.".format(expression, exception))
+            result = np.broadcast_to(np.asarray(result, dtype=float), e.shape)
+        return np.where(np.isfinite(result), result, 0)
+
+    # Surface wrong arguments when loading rather than when grading
+    evaluate(np.ones(1), 1)
+    return evaluate
+
+
+def evaluate(expression: str, e, a):
+    """Score a column of estimates against an answer with an expression."""
+
+    return compile_formula(expression)(e, a)
@@ -0,0 +1,41 @@
+"""Per-round generation counters for invalidating cached grades.
+
+Every round carries a generation that is incremented whenever one of
+its answers is saved or deleted, or when the attendance of a student
+changes in the case of individual rounds. Cached grader results record
+the generations of the rounds they were computed from, and are only
+reused while those generations are unchanged.
+"""
+
+from django.db.models import F
+
+from . import models
+
+
+def bump(rounds):
+    """Increment the generation of a set of rounds."""
+
+    return models.Round.objects.filter(id__in=set(rounds)).update(generation=F("generation") + 1)
+
+
+def bump_questions(questions):
+    """Increment the generation of the rounds of a set of questions."""
+
+    rounds = models.Question.objects.filter(id__in=set(questions)).values_list("round_id", flat=True)
+    return bump(list(rounds))
+
+
+def bump_individual(competition):
+    """Increment the generation of the individual rounds of a competition."""
+
+    return models.Round.objects.filter(
+        competition=competition, grouping=models.INDIVIDUAL).update(generation=F("generation") + 1)
+
+
+def current(competition, refs=None):
+    """Get the current generations of a competition's rounds by ref."""
+
+    rounds = models.Round.objects.filter(competition=competition)
+    if refs is not None:
+        rounds = rounds.filter(ref__in=refs)
+    return dict(rounds.values_list("ref", "generation"))
@@ -14,26 +14,43 @@ provided its answer, and second to grade rounds based on the result of
 the values returned.
 """
 
-from django.db.models import Q
+from django.db import connection
+from django.db.models import Q, Model
+from django.dispatch import Signal
 
 import time
+import functools
+import threading
+import numpy as np
 
 import coaches.models
-from . import models
+from . import backends, formulas, generations, matrix, models, parallel, plans, profiling, regularization, tables
 
 
 ROUND = "round"
 QUESTION = "question"
+ARRAY = "array"
+
+# Cache entry requesting the scoreboard daemon to recalculate everything
+RECALCULATE = "recalculate"
+
+# Cache entry holding the last regularization fits to start from
+FITS = "fits"
+
+# Sent with the grader once a result is refreshed in the background
+revalidated = Signal()
 
 
 class CachedGrade:
     """Meta container object that stores cached results and timing."""
 
-    def __init__(self, result, when=None):
+    def __init__(self, result, when=None, key=None, generations=None):
         """Initialize a cache object."""
 
         self.result = result
         self.time = when or time.time()
+        self.key = key
+        self.generations = generations
 
 
 def cache_set(cache, name, result):
@@ -49,12 +66,31 @@ def cache_get(cache, name):
     return None if item is None else item.result
 
 
-def cached(cache: dict, name: object):
+def argument_key(args, kwargs):
+    """Identify the arguments of a cached call by value.
+
+    Model instances are identified by their primary key, so that the
+    key is the same in every process.
+    """
+
+    def identify(value):
+        if isinstance(value, Model):
+            return "{}#{}".format(value._meta.label, value.pk)
+        return repr(value)
+
+    return "|".join([identify(value) for value in args] + [
+        "{}={}".format(name, identify(value)) for name, value in sorted(kwargs.items())])
+
+
+def cached(cache: dict, name: object, depends: tuple=()):
     """Decorator that caches the return of a function.
 
     Intended as a quick way to save on computation. Since decorators
     within class declarations cannot reference the class, the cache
-    container must be passed manually.
+    container must be passed manually. When decorating methods of a
+    competition grader, the cache of the grader instance is used
+    instead, which is shared between processes if the `GRADING_CACHE`
+    setting is configured, and None can be passed as the container.
 
     In addition to caching the output every time the function is
     called, the decorator adds the `use_cache` keyword argument to the
@@ -63,31 +99,119 @@ def cached(cache: dict, name: object):
     returned. Otherwise, the function is called again. In order to
     provide a global caching mechanism, `use_cache_before` can be set
     instead, which uses the cached value until a number of seconds
-    since the last recalculation.
+    since the last recalculation. Cached values are only used if the
+    function was called with the same arguments.
+
+    Grader methods may list the refs of the rounds they depend on in
+    `depends`. The generations of those rounds are recorded with the
+    result, and a cached result is recalculated as soon as any of
+    them changes, unless it is still within `use_cache_before`.
+
+    To avoid making the caller wait for a recalculation, the
+    `use_stale_before` keyword argument can be set to a number of
+    seconds. A cached value that is no longer fresh but was computed
+    within that many seconds is returned immediately, and refreshed in
+    a background thread by the first caller to take the computation,
+    which sends `revalidated` for grader methods. Older values, and any when `use_cache` is off, are recalculated in
+    the call.
+
+    Grader results are computed by one caller at a time, across threads
+    and, with a shared cache, across processes. While a result is being
+    recalculated, concurrent callers receive the previous value if there
+    is one and otherwise wait for the new one.
     """
 
     def decorator(function):
-        def wrapper(*args, use_cache: bool=True, use_cache_before: int=0, **kwargs):
+        @functools.wraps(function)
+        def wrapper(*args, use_cache: bool=True, use_cache_before: int=0, use_stale_before: int=0, **kwargs):
+
+            # Graders keep their cache per competition
+            container, arguments, current = cache, args, None
+            if args and isinstance(args[0], CompetitionGrader):
+                container, arguments = args[0].cache, args[1:]
+                if depends:
+                    current = generations.current(args[0].competition, depends)
+            elif container is None:
+                raise TypeError("{} is not a grader method, so needs a cache container".format(name))
+            key = argument_key(arguments, kwargs)
+            item = container.get(name)
+            if item is not None and item.key != key:
+                item = None
 
             # Use cache time before normal cache
-            if use_cache_before > 0 and name in cache:
-                if cache[name].time >= time.time() - use_cache_before:
-                    return cache_get(cache, name)
+            if use_cache_before > 0 and item is not None:
+                if item.time >= time.time() - use_cache_before:
+                    return item.result
 
             # Then check cache normally, only if use_cache_before is 0
-            elif use_cache and name in cache:
-                return cache_get(cache, name)
+            elif use_cache and item is not None and item.generations == current:
+                return item.result
 
             if "use_cache" in function.__code__.co_varnames:
                 kwargs["use_cache"] = use_cache
 
-            result = function(*args, **kwargs)
-            cache_set(cache, name, result)
-            return result
+            def compute(publish: bool=False):
+                with profiling.stage(name, args[0] if container is not cache else None, publish=publish):
+                    result = function(*args, **kwargs)
+                container[name] = CachedGrade(result, key=key, generations=current)
+                return result
+
+            # Plain dictionaries are not shared, so need no locking
+            if not isinstance(container, backends.GradeCache):
+                return compute()
+
+            # Serve a stale value while one caller refreshes it in the background
+            flight = container.flight(name)
+            if use_cache and use_stale_before > 0 and item is not None and item.time >= time.time() - use_stale_before:
+                if flight.acquire(blocking=False):
+                    try:
+                        threading.Thread(
+                            target=revalidate, args=(flight, compute, args[0] if container is not cache else None),
+                            daemon=True).start()
+                    except Exception:
+                        flight.release()
+                        raise
+                return item.result
+
+            # Only one caller computes at a time, others with a previous
+            # value use it and the rest wait for the computation
+            requested = time.time()
+            if not flight.acquire(blocking=item is None or not use_cache):
+                return item.result
+            try:
+                latest = container.get(name)
+                if latest is not None and latest.key == key and latest.time >= requested:
+                    return latest.result
+                return compute()
+            finally:
+                flight.release()
+        wrapper.cache_name = name
         return wrapper
     return decorator
 
 
+def revalidate(flight, compute, grader=None):
+    """Recompute a cached result, releasing the flight acquired by the caller.
+
+    Results of graders are published like any refresh of the scoreboards
+    and announced with `revalidated`, so that they are also snapshotted.
+    """
+
+    try:
+        compute(publish=grader is not None)
+        if grader is not None:
+            revalidated.send(sender=type(grader), grader=grader)
+    finally:
+        flight.release()
+        connection.close()
+
+
+def fit_key(division, categories):
+    """Get the key of the regularization fit of a division and categories."""
+
+    return "{}:{}".format(division, ",".join(categories))
+
+
 class ChillDictionary(dict):
     """Dictionary that sets empty keys to chill dictionaries."""
 
@@ -118,6 +242,23 @@ class ChillDictionary(dict):
         return out
 
 
+class ScalarQuestionGrader:
+    """Adapter that grades a column with a per-answer question grader."""
+
+    def __init__(self, function):
+        """Wrap a function of a question and an answer."""
+
+        self.function = function
+
+    def __call__(self, question, values, round_matrix):
+        """Grade each answer of the column individually."""
+
+        scores = np.zeros(len(values))
+        for i, answer in round_matrix.answers(round_matrix.question_index[question.id]):
+            scores[i] = self.function(question, answer) or 0
+        return scores
+
+
 class CompetitionGrader:
     """Base class for a competition grader.
 
@@ -126,14 +267,31 @@ class CompetitionGrader:
     in the model declaration.
     """
 
-    cache = {}
+    # Cached methods that produce the scoreboards
+    scoreboards = ()
+
+    # Team rounds with live scores, kept current by the scoreboard daemon
+    live_rounds = ()
+
+    # Whether a team's live score only depends on its own answers
+    live_incremental = True
 
     def __init__(self, competition: models.Competition):
         """Initialize the competition grader."""
 
         self.competition = competition
-        self.question_graders = {}
-        self.round_graders = {}
+        self.cache = backends.GradeCache(competition.id)
+        self.plan = plans.GradingPlan(competition)
+
+    def round(self, ref: str):
+        """Get a round of the competition by its ref."""
+
+        return self.plan.round(ref)
+
+    def teams(self):
+        """Get the teams of the competition, whether or not it is active."""
+
+        return coaches.models.Team.objects.filter(competition=self.competition)
 
     ################
     # Cache access #
@@ -158,46 +316,53 @@ class CompetitionGrader:
 
         return question.weight * (answer.value or 0)
 
+    def default_array_question_grader(self, question: models.Question, values, round_matrix):
+        """Default action for grading a column of answers."""
+
+        return question.weight * np.nan_to_num(values)
+
+    def score_estimates(self, question: models.Question, estimates):
+        """Score a column of estimates with the question's scoring formula.
+
+        Questions loaded before formulas were kept in competition files
+        have none, and are refused rather than scored as zero until the
+        competition file is loaded again.
+        """
+
+        if not question.scoring:
+            raise formulas.FormulaError(
+                "Estimation question {} #{} has no scoring formula, load the competition file again.".format(
+                    question.round.ref, question.number))
+        return formulas.evaluate(question.scoring, estimates, question.answer)
+
     def default_round_grader(self, round: models.Round):
         """Default action for grading a round."""
 
-        if round.grouping == models.ROUND_GROUPINGS["individual"]:
-            model = coaches.models.Student
-            group = "student"
-        elif round.grouping == models.ROUND_GROUPINGS["team"]:
-            model = coaches.models.Team
-            group = "team"
-        else:
+        round_matrix = matrix.RoundMatrix.load(round, self.plan.round_questions(round))
+        if round_matrix is None:
             return None
 
-        # Iterate through teams or students
-        scores = ChillDictionary()
-        for division in coaches.models.DIVISIONS_MAP:
-            scores[division] = ChillDictionary()
+        return round_matrix.split(round_matrix.grade(
+            lambda question, j: self.grade_column(round_matrix, question, j)))
 
-        for thing in model.current():
+    def default_round_table(self, round: models.Round, entity_ids=None):
+        """Grade a round into a score table with the default grader.
 
-            if group == "student" and not thing.attending:
-                continue
+        Only the given entity ids are graded if any are.
+        """
 
-            score = 0
-            for question in round.questions.all():
-                answer = models.Answer.objects.filter(**{group: thing}, question=question).first()
-                if answer:
-                    result = self.get_question_grader(question)(question, answer)
-                    score += result or 0
+        round_matrix = matrix.RoundMatrix.load(round, self.plan.round_questions(round), entity_ids)
+        if round_matrix is None:
+            return None
 
-            # Separate by division
-            division = None
-            if group == "student":
-                division = thing.team.division
-            elif group == "team":
-                division = thing.division
+        return round_matrix.table(round_matrix.grade(
+            lambda question, j: self.grade_column(round_matrix, question, j)))
 
-            # Save score
-            scores[division][thing] = score
+    def grade_column(self, round_matrix, question: models.Question, j: int):
+        """Grade a question column of a round matrix."""
 
-        return scores
+        grader = self.get_array_question_grader(question)
+        return grader(question, round_matrix.values[:, j], round_matrix)
 
     #######################
     # Grader registration #
@@ -206,14 +371,59 @@ class CompetitionGrader:
     def register_question_grader(self, query: Q, function):
         """Register a question grading function to a set of questions."""
 
-        for question in models.Question.objects.filter(query, round__competition=self.competition).all():
-            self.question_graders[question.id] = function
+        self.plan.register_question(query, (QUESTION, function))
+
+    def register_array_question_grader(self, query: Q, function):
+        """Register a column grading function to a set of questions.
+
+        Array question graders are called with the question, a NumPy
+        array of answer values for every entity in the round, and the
+        round matrix, and should return an array of scores. Answers
+        without a value are NaN, and the scores of entities that have
+        no answer to the question are discarded.
+        """
+
+        self.plan.register_question(query, (ARRAY, function))
 
     def register_round_grader(self, query: Q, function):
         """Register a round grading function to a set of questions."""
 
-        for round in models.Round.objects.filter(query, competition=self.competition).all():
-            self.round_graders[round.id] = function
+        self.plan.register_round(query, function)
+
+    ##################
+    # Regularization #
+    ##################
+
+    def regularize_divisions(self, categories: list, observations: dict, weights: dict=None):
+        """Regularize the observations of each division on the grading pool.
+
+        Each fit starts from the last fit of the same division and
+        categories, and its diagnostics are kept in the cache. Call
+        `forget_fits` to fit from scratch on the next recalculation.
+        """
+
+        fits = self.cache.get(FITS) or {}
+        divisions = list(observations.keys())
+        keys = [fit_key(division, categories) for division in divisions]
+        tasks = [(categories, observations[division], weights, fits.get(key, {}).get("x"))
+                 for division, key in zip(divisions, keys)]
+        results = parallel.map(regularization.regularize_task, tasks)
+
+        fits = dict(self.cache.get(FITS) or {})
+        for key, (normalized, diagnostics) in zip(keys, results):
+            fits[key] = diagnostics
+        self.cache[FITS] = fits
+        return {division: normalized for division, (normalized, diagnostics) in zip(divisions, results)}
+
+    def fits(self):
+        """Get the diagnostics of the last fits by division and categories."""
+
+        return self.cache.get(FITS) or {}
+
+    def forget_fits(self):
+        """Start the next regularization fits from scratch."""
+
+        del self.cache[FITS]
 
     #####################
     # Grader resolution #
@@ -222,12 +432,23 @@ class CompetitionGrader:
     def get_question_grader(self, question: models.Question):
         """Get the registered question grader by the question model."""
 
-        return self.question_graders.get(question.id, self.default_question_grader)
+        kind, function = self.plan.question_target(question) or (None, None)
+        return function if kind == QUESTION else self.default_question_grader
+
+    def get_array_question_grader(self, question: models.Question):
+        """Get the column grader for a question, adapting scalar graders."""
+
+        kind, function = self.plan.question_target(question) or (None, None)
+        if kind == ARRAY:
+            return function
+        if kind == QUESTION:
+            return ScalarQuestionGrader(function)
+        return self.default_array_question_grader
 
     def get_round_grader(self, round: models.Round):
         """Get the registered round grader by the round model."""
 
-        return self.round_graders.get(round.id, self.default_round_grader)
+        return self.plan.round_target(round) or self.default_round_grader
 
     ##################
     # Actual graders #
@@ -236,46 +457,65 @@ class CompetitionGrader:
     def grade_round(self, round: models.Round):
         """Grade a round."""
 
-        return self.get_round_grader(round)(round)
+        with profiling.stage("grade_round:{}".format(round.ref), self):
+            return self.get_round_grader(round)(round)
+
+    def grade_round_table(self, round: models.Round):
+        """Grade a round into a score table keyed by entity id."""
+
+        with profiling.stage("grade_round:{}".format(round.ref), self):
+            round_grader = self.plan.round_target(round)
+            if round_grader is None:
+                return self.default_round_table(round)
+            kind = "student" if round.grouping == models.INDIVIDUAL else "team"
+            return tables.coerce(round_grader(round), kind)
 
     def grade_competition(self):
         """Grade a competition."""
 
         results = {}
-        for round in self.competition.rounds.all():
+        for round in self.plan.ensure().rounds_by_id.values():
             results[round.ref] = self.grade_round(round)
         return results
 
+    def refresh_scoreboards(self, use_cache: bool=True):
+        """Recalculate the cached results shown on the scoreboards.
+
+        With the cache enabled, only results whose rounds have changed
+        are recalculated.
+        """
+
+        with profiling.stage("refresh_scoreboards", self, publish=True):
+            for method in self.scoreboards:
+                getattr(self, method)(use_cache=use_cache)
+
 
 def prepare_individual_scores(scores):
     """Prepare the scores from a question score calculation."""
 
+    table = tables.coerce(scores, "student")
+    names = table.names()
     divisions = []
-    for division in sorted(scores.keys()):
-        division_name = coaches.models.DIVISIONS_MAP[division]
-        things = []
-        for thing in scores[division]:
-            things.append((thing.name, scores[division][thing]))
-        things.sort(key=lambda x: x[1], reverse=True)
-        divisions.append((division_name, things))
+    for division, group in table.ranked().groups():
+        things = [(names[pk], score) for pk, _, _, score in group]
+        divisions.append((coaches.models.DIVISIONS_MAP[division], things))
     return divisions
 
 
 def prepare_subject_scores(scores):
     """Prepare scores recursively."""
 
+    table = tables.coerce(scores, "student", subjects=True)
+    names = table.names()
     divisions = []
-    for division in sorted(scores.keys()):
-        division_name = coaches.models.DIVISIONS_MAP[division]
+    for division, group in table.ranked().groups():
         subjects = []
-        for subject in scores[division]:
-            students = []
-            for student in scores[division][subject]:
-                students.append((student.name, scores[division][subject][student]))
-            students.sort(key=lambda x: x[1], reverse=True)
-            subjects.append((coaches.models.SUBJECTS_MAP[subject], students))
+        for subject, students in group.subject_groups():
+            subjects.append((
+                coaches.models.SUBJECTS_MAP[subject],
+                [(names[pk], score) for pk, _, _, score in students]))
         subjects.sort(key=lambda x: x[0])
-        divisions.append((division_name, subjects))
+        divisions.append((coaches.models.DIVISIONS_MAP[division], subjects))
     return divisions
 
 
@@ -283,59 +523,69 @@ def prepare_composite_team_scores(guts_scores, guts_z, team_scores, team_z,
                                   team_individual_scores, overall_scores):
     """Prepare team scores for scoreboard."""
 
+    guts_scores, guts_z, team_scores, team_z, team_individual_scores = (
+        tables.coerce(scores, "team") for scores in (
+            guts_scores, guts_z, team_scores, team_z, team_individual_scores))
+    overall_scores = tables.coerce(overall_scores, "team")
+    names = overall_scores.names()
+
     divisions = []
-    for division in sorted(overall_scores.keys()):
-        division_name = coaches.models.DIVISIONS_MAP[division]
+    for division, group in overall_scores.ranked().groups():
         teams = []
-        for team in overall_scores[division]:
+        for pk, _, _, score in group:
             teams.append((
-                team.name,
-                guts_scores[division].get(team, 0),
-                guts_z[division].get(team, 0),
-                team_scores[division].get(team, 0),
-                team_z[division].get(team, 0),
-                team_individual_scores[division].get(team, 0),
-                overall_scores[division].get(team, 0)))
-        teams.sort(key=lambda x: x[-1], reverse=True)
-        divisions.append((division_name, teams))
+                names[pk],
+                guts_scores.get(pk),
+                guts_z.get(pk),
+                team_scores.get(pk),
+                team_z.get(pk),
+                team_individual_scores.get(pk),
+                score))
+        divisions.append((coaches.models.DIVISIONS_MAP[division], teams))
     return divisions
 
 
 def prepare_school_team_scores(school, guts_scores, team_scores, team_individual_scores, overall_scores):
     """Prepare scores for sponsor scoreboard."""
 
+    guts_scores, team_scores, team_individual_scores = (
+        tables.coerce(scores, "team") for scores in (guts_scores, team_scores, team_individual_scores))
+    overall_scores = tables.coerce(overall_scores, "team")
+    teams = overall_scores.entities()
+
     divisions = []
-    for division in sorted(overall_scores.keys()):
-        division_name = coaches.models.DIVISIONS_MAP[division]
-        teams = []
-        print(overall_scores)
-        for team in overall_scores[division]:
-            if team.school != school:
+    for division, group in overall_scores.ranked().groups():
+        rows = []
+        for pk, _, _, score in group:
+            if teams[pk].school_id != school.id:
                 continue
-            teams.append((
-                team.name,
-                guts_scores[division].get(team, 0),
-                team_scores[division].get(team, 0),
-                team_individual_scores[division].get(team, 0),
-                overall_scores[division].get(team, 0)))
-        teams.sort(key=lambda x: x[-1], reverse=True)
-        divisions.append((division_name, teams))
+            rows.append((
+                teams[pk].name,
+                guts_scores.get(pk),
+                team_scores.get(pk),
+                team_individual_scores.get(pk),
+                score))
+        divisions.append((coaches.models.DIVISIONS_MAP[division], rows))
     return divisions
 
 
 def prepare_school_individual_scores(school, scores):
     """Prepare individual scores for sponsor scoreboard."""
 
+    table = tables.coerce(scores, "student", subjects=True)
+    entities = table.entities()
+    subjects = sorted(coaches.models.SUBJECTS_MAP.keys())
+
     divisions = []
-    for division in scores:
+    for division, group in table.groups():
         students = {}
-        for i, subject in enumerate(sorted(coaches.models.SUBJECTS_MAP.keys())):
-            for student in scores[division].get(subject, []):
-                if student.team.school != school:
-                    continue
-                if student not in students:
-                    students[student] = [None, None, None, None]
-                students[student][i] = scores[division][subject][student]
+        for pk, _, subject, score in group:
+            student = entities[pk]
+            if student.team.school_id != school.id:
+                continue
+            if student not in students:
+                students[student] = [None, None, None, None]
+            students[student][subjects.index(subject)] = score
         students = list(map(lambda x: (x[0].name, x[1]), students.items()))
         students.sort(key=lambda x: x[0])
         divisions.append((coaches.models.DIVISIONS_MAP[division], students))
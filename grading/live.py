@@ -0,0 +1,331 @@
+"""Incremental live scores of team rounds such as guts.
+
+The live scoreboard of a round is kept in the grading cache as the raw
+score of every team along with its rank in its division. When answers
+of some teams are saved, only those teams are graded again and merged
+in. Every merge that changes a score or rank gets a new version, and a
+short log of the teams changed by each version lets clients ask for
+only the teams changed since the version they last saw. Clients whose
+version is no longer covered by the log get every team.
+
+Live scores are only maintained for rounds that have been asked for
+since they were last built. Versions start from the time the scores
+were built, so clients of scores built earlier are never mistaken for
+being current. The scores also record the generation of the round they
+were graded at. Teams are only graded alone when the change merged is
+the only one since, and otherwise every team is graded again and the
+changes are merged all the same, which also catches up on saves whose
+merge was lost. Graders whose questions score teams against each other
+set `live_incremental` off to always grade every team.
+
+When the scoreboard daemon is grading, it keeps the live scores of the
+grader's `live_rounds` current and requests only read them.
+
+New versions are also pushed to connected clients as server-sent
+events. Each stream waits for a new version, which saves in the same
+process announce immediately and saves in other processes are noticed
+by checking the cache every `POLL` seconds. Every event is serialized
+once per version for all clients that were on the same version. Since
+streams hold a worker while open, they close after `STREAM_SECONDS`
+and the browser reconnects from the last version it received.
+"""
+
+import json
+import time
+import threading
+
+from django.conf import settings
+
+from home.models import Competition
+import coaches.models
+from . import backends, generations, models, tables
+
+
+# Number of versions whose changed teams are remembered
+LOG_LENGTH = 256
+
+# Seconds between checks for versions from other processes
+POLL = 1
+
+# Seconds between comments that keep idle streams open
+KEEPALIVE = 15
+
+# Seconds before a stream closes and the client reconnects
+STREAM_SECONDS = 300
+
+# Milliseconds browsers wait before reconnecting
+RETRY = 3000
+
+# Announces new versions to the streams of this process
+announced = threading.Condition()
+
+# Serialized deltas shared by clients on the same version
+serialized = backends.LocalStore(64)
+
+
+def key(ref: str):
+    """Get the cache entry name of the live scores of a round."""
+
+    return "live:" + ref
+
+
+def rank(teams: dict):
+    """Rank teams of division and score pairs within their division."""
+
+    ids = list(teams.keys())
+    table = tables.ScoreTable(
+        "team", ids, [teams[pk][0] for pk in ids], [teams[pk][1] for pk in ids])
+    return {pk: [teams[pk][0], teams[pk][1], int(r)] for pk, r in zip(ids, table.ranks())}
+
+
+def grade(grader, round: models.Round, team_ids=None):
+    """Grade the raw scores of some or all teams as division and score pairs."""
+
+    if team_ids is None or grader.plan.round_target(round) is not None:
+        table = grader.grade_round_table(round)
+    else:
+        table = grader.default_round_table(round, list(team_ids))
+    return {int(pk): (int(division), float(score)) for pk, division, subject, score in table}
+
+
+def generation(round: models.Round):
+    """Get the current generation of a round."""
+
+    return generations.current(round.competition_id, [round.ref]).get(round.ref)
+
+
+def build(grader, round: models.Round):
+    """Grade the live scores of every team of a round."""
+
+    current = generation(round)
+    return {
+        "round": round.id,
+        "generation": current,
+        "version": int(time.time() * 1000),
+        "time": time.time(),
+        "log": [],
+        "teams": rank(grade(grader, round))}
+
+
+def ensure(grader, round: models.Round):
+    """Get the live scores of a round, building or catching them up if needed."""
+
+    name = key(round.ref)
+    state = grader.cache.get(name)
+    if state is not None and state["round"] == round.id and state.get("generation") == generation(round):
+        return state
+
+    flight = grader.cache.flight(name)
+    flight.acquire()
+    try:
+        state = grader.cache.get(name)
+        if state is None or state["round"] != round.id:
+            state = build(grader, round)
+            grader.cache[name] = state
+        elif state.get("generation") != generation(round):
+            state = merge(grader, round, state)
+        return state
+    finally:
+        flight.release()
+
+
+def empty(round: models.Round):
+    """Get live scores with no teams, which every later version replaces."""
+
+    return {"round": round.id, "generation": None, "version": 0, "time": 0, "log": [], "teams": {}}
+
+
+def current(grader, round: models.Round):
+    """Get the live scores of a round for a request.
+
+    If the scoreboard daemon is grading, they are only read from the
+    cache, and are empty until the daemon has built them.
+    """
+
+    if getattr(settings, "GRADING_DAEMON", False):
+        state = grader.cache.get(key(round.ref))
+        return state if state is not None and state["round"] == round.id else empty(round)
+    return ensure(grader, round)
+
+
+def merge(grader, round: models.Round, state: dict, team_ids=None):
+    """Grade teams again and record those whose score or rank changed.
+
+    Only the given teams are graded if they hold the one change since
+    the generation of the live scores, and otherwise every team is.
+    Must be called holding the flight of the live scores.
+    """
+
+    graded_generation = generation(round)
+    if team_ids is None or not grader.live_incremental or state.get("generation") != graded_generation - 1:
+        teams = grade(grader, round)
+    else:
+        team_ids = set(team_ids)
+        teams = {pk: (division, score) for pk, (division, score, r) in state["teams"].items() if pk not in team_ids}
+        teams.update(grade(grader, round, team_ids))
+    teams = rank(teams)
+
+    changed = sorted(
+        pk for pk in set(teams) | set(state["teams"])
+        if teams.get(pk) != state["teams"].get(pk))
+    if changed:
+        version = state["version"] + 1
+        state = {
+            "round": round.id,
+            "generation": graded_generation,
+            "version": version,
+            "time": time.time(),
+            "log": (state["log"] + [(version, changed)])[-LOG_LENGTH:],
+            "teams": teams}
+    else:
+        state = dict(state, generation=graded_generation)
+    grader.cache[key(round.ref)] = state
+    if changed:
+        with announced:
+            announced.notify_all()
+    return state
+
+
+def update(grader, round: models.Round, team_ids):
+    """Merge the change to the answers of some teams into the live scores.
+
+    Returns the new live scores, or None if they are not maintained.
+    """
+
+    name = key(round.ref)
+    flight = grader.cache.flight(name)
+    flight.acquire()
+    try:
+        state = grader.cache.get(name)
+        if state is None or state["round"] != round.id:
+            return None
+        return merge(grader, round, state, team_ids)
+    finally:
+        flight.release()
+
+
+def discard(competition_id, ref: str):
+    """Drop the live scores of a round so they are built again."""
+
+    del backends.GradeCache(competition_id)[key(ref)]
+
+
+def delta(grader, round: models.Round, since: int=None, state: dict=None):
+    """Get the teams whose score or rank changed since a version.
+
+    Teams are keyed by id with their name, division, raw score, and
+    rank, or None if they are no longer scored. Every team is included
+    and `full` is set if the version is missing or not covered by the
+    log. The current live scores are used unless given.
+    """
+
+    state = state or current(grader, round)
+    version, log = state["version"], state["log"]
+    covered = log[0][0] - 1 if log else version
+    if since is not None and covered <= since <= version:
+        changed = set()
+        for logged, teams in log:
+            if logged > since:
+                changed.update(teams)
+        full = False
+    else:
+        changed = set(state["teams"])
+        full = True
+
+    names = dict(coaches.models.Team.objects.filter(id__in=changed).values_list("id", "name"))
+    teams = {}
+    for pk in sorted(changed):
+        if pk not in state["teams"]:
+            teams[str(pk)] = None
+            continue
+        division, score, r = state["teams"][pk]
+        teams[str(pk)] = {
+            "name": names.get(pk, ""),
+            "division": coaches.models.DIVISIONS_MAP[division],
+            "score": score,
+            "rank": r}
+    return {"version": version, "full": full, "teams": teams}
+
+
+def dumps(grader, round: models.Round, since: int=None, state: dict=None):
+    """Get the current version and the serialized delta since a version.
+
+    Deltas are shared between clients asking from the same version.
+    The current live scores are used unless given.
+    """
+
+    state = state or current(grader, round)
+    cache_key = (round.competition_id, round.id, state["version"], since)
+    payload = serialized.get(cache_key)
+    if payload is None:
+        payload = json.dumps(delta(grader, round, since, state))
+        serialized.set(cache_key, payload)
+    return state["version"], payload
+
+
+def wait(grader, round: models.Round, version: int, timeout: float):
+    """Wait until the live scores move past a version or the timeout passes.
+
+    Returns the current version.
+    """
+
+    deadline = time.time() + timeout
+    while True:
+        state = current(grader, round)
+        latest = state["version"]
+        remaining = deadline - time.time()
+        if latest != version or remaining <= 0:
+            return latest
+        with announced:
+            announced.wait(min(POLL, remaining))
+
+
+def events(grader, round: models.Round, since: int=None, duration: float=STREAM_SECONDS, keepalive: float=KEEPALIVE):
+    """Stream new versions of the live scores as server-sent events.
+
+    The first event brings the client up to date from its version,
+    and every later event holds the teams changed by a new version.
+    """
+
+    yield "retry: {}\n\n".format(RETRY)
+    deadline = time.time() + duration
+    version = None
+    while time.time() < deadline:
+        latest = wait(grader, round, version, min(keepalive, deadline - time.time()))
+        if latest == version:
+            yield ": keepalive\n\n"
+            continue
+        version, payload = dumps(grader, round, since if version is None else version)
+        yield "id: {}\nevent: standings\ndata: {}\n\n".format(version, payload)
+
+
+def answers_changed(changes):
+    """Update the live scores of rounds whose team answers changed.
+
+    Each change is a tuple of the answer, its old value, and its new
+    value. Rounds whose live scores are not maintained are skipped
+    without loading their grader, and none are updated while the
+    scoreboard daemon keeps them current instead.
+    """
+
+    if getattr(settings, "GRADING_DAEMON", False):
+        return
+
+    team_answers = [answer for answer, old, new in changes if answer.team_id is not None]
+    if not team_answers:
+        return
+
+    # Group the changed teams by the round of their answers
+    rounds = dict((question_id, (competition_id, ref)) for question_id, competition_id, ref in
+                  models.Question.objects.filter(id__in=set(answer.question_id for answer in team_answers))
+                  .values_list("id", "round__competition_id", "round__ref"))
+    changed = {}
+    for answer in team_answers:
+        if answer.question_id in rounds:
+            changed.setdefault(rounds[answer.question_id], set()).add(answer.team_id)
+
+    for (competition_id, ref), team_ids in changed.items():
+        if key(ref) not in backends.GradeCache(competition_id):
+            continue
+        grader = Competition.objects.get(id=competition_id).grader
+        update(grader, grader.round(ref), team_ids)
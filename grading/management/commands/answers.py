@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand, CommandError
+from grading import answers, models
+
+import time
+
+
+class Command(BaseCommand):
+    """Prepare the answers of the active competition for grading."""
+
+    def add_arguments(self, parser):
+        """Add arguments to the command line parser."""
+
+        subparsers = parser.add_subparsers(dest="command", metavar="command")
+        materialize_parser = subparsers.add_parser(
+            "materialize", help="create the empty answers of every team and student", cmd=self)
+        materialize_parser.add_argument("rounds", nargs="*", help="refs of the rounds, all by default")
+
+    def handle(self, *args, **kwargs):
+        """Handle a call to the command."""
+
+        competition = models.Competition.current()
+        if competition is None:
+            raise CommandError("There is no active competition!")
+
+        if kwargs["command"] == "materialize":
+            start = time.time()
+            rounds = competition.rounds.all()
+            if kwargs["rounds"]:
+                rounds = rounds.filter(ref__in=kwargs["rounds"])
+                unknown = set(kwargs["rounds"]) - set(round.ref for round in rounds)
+                if unknown:
+                    raise CommandError("Unknown rounds: {}".format(", ".join(sorted(unknown))))
+            created = answers.materialize(competition, rounds)
+            print("Created {} answers in {} seconds!".format(created, round(time.time() - start, 3)))
+
+        else:
+            print("The current competition is {}.".format(competition.name))
@@ -0,0 +1,43 @@
+from django.core.management.base import BaseCommand
+from grading import benchmark, synthetic
+
+import sys
+import json
+
+
+class Command(BaseCommand):
+    """Time the yearly graders on synthetic competitions of several sizes.
+
+    Nothing is kept in the database, so this is safe to run against a
+    copy of the production database, though not during a competition.
+    """
+
+    def add_arguments(self, parser):
+        """Add arguments to the command line parser."""
+
+        parser.add_argument("--years", nargs="+", choices=synthetic.years(), help="years to benchmark, default all")
+        parser.add_argument("--scales", nargs="+", type=int, default=[10, 50, 200], help="numbers of teams")
+        parser.add_argument("--students", type=int, default=4, help="students per team")
+        parser.add_argument("--repeat", type=int, default=1, help="runs per year and scale")
+        parser.add_argument("--seed", type=int, default=0, help="random seed")
+        parser.add_argument("--output", "-o", help="file to write the JSON report to, default stdout")
+
+    def handle(self, *args, **kwargs):
+        """Handle a call to the command."""
+
+        report = benchmark.run(
+            years=kwargs["years"], scales=kwargs["scales"], repeat=kwargs["repeat"],
+            seed=kwargs["seed"], students_per_team=kwargs["students"])
+
+        for result in report["results"]:
+            if "error" in result:
+                summary = "failed: " + result["error"].strip().splitlines()[-1]
+            else:
+                summary = "{} seconds".format(round(result["median"], 3))
+            self.stderr.write("mbmt{0[year]} with {0[scale]} teams: {1}".format(result, summary))
+
+        if kwargs["output"]:
+            with open(kwargs["output"], "w") as file:
+                json.dump(report, file, indent=2)
+        else:
+            json.dump(report, sys.stdout, indent=2)
@@ -1,9 +1,11 @@
 from django.core.management.base import BaseCommand, CommandError
-from grading import models
+from django.db import transaction
+from grading import bulk, formulas, generations, live, models, plans, signals, totals
 
 import os
 import json
 import time
+import yaml
 import datetime
 
 
@@ -13,38 +15,183 @@ def date(string):
     return datetime.datetime.strptime(string, "%Y-%m-%d")
 
 
-def load(path, loader=json.load):
-    """Load a competition file."""
+def read(path, loader=None):
+    """Read a competition file, as YAML if it is named so and otherwise JSON."""
 
+    if loader is None:
+        loader = yaml.safe_load if path.endswith((".yaml", ".yml")) else json.load
     with open(path, "r") as file:
-        c = loader(file)
+        return loader(file)
 
-    competition = models.Competition.current()
-    competition._grader = c["grader"]
-    competition.save()
 
-    # Clear old stuff
-    print("Clearing old competition data...")
-    for round in competition.rounds.all():
-        for question in round.questions.all():
-            question.delete()
-        round.delete()
+class Diff:
+    """Changes that bring the rounds and questions of a competition to a file.
+
+    Rounds are identified by their ref and questions by their round and
+    number, so questions that keep both keep their answers. Each change
+    is also described by a line, prefixed by +, ~, or - for additions,
+    modifications, and removals.
+    """
+
+    def __init__(self):
+        """Initialize an empty diff."""
+
+        self.grader = None
+        self.rounds_created = []
+        self.rounds_updated = []
+        self.rounds_deleted = []
+        self.questions_created = []
+        self.questions_updated = []
+        self.questions_deleted = []
+        self.lines = []
+
+    def __bool__(self):
+        """Check whether there are any changes."""
+
+        return bool(self.lines)
+
+    def __str__(self):
+        """Describe the changes a line each."""
+
+        return "\n".join(self.lines) if self.lines else "No changes."
+
+    def changed_rounds(self):
+        """Get the refs of the rounds that are created, updated, or lose questions."""
+
+        return (
+            set(round.ref for round in self.rounds_created + self.rounds_updated + self.rounds_deleted) |
+            set(ref for ref, question in self.questions_created + self.questions_deleted) |
+            set(question.round.ref for question, changed in self.questions_updated))
+
+    def regrades(self):
+        """Check whether the raw scores of existing answers change."""
+
+        return any("weight" in fields for question, fields in self.questions_updated) or bool(self.questions_deleted)
+
+
+def compare(instance, values: dict):
+    """Set the fields of an instance that differ, listing them with their old values."""
+
+    changed = {}
+    for name, value in values.items():
+        if getattr(instance, name) != value:
+            changed[name] = getattr(instance, name)
+            setattr(instance, name, value)
+    return changed
+
+
+def describe(changed: dict, instance):
+    """Describe the changed fields of an instance."""
+
+    return ", ".join("{} {!r} -> {!r}".format(name, old, getattr(instance, name)) for name, old in changed.items())
+
+
+def diff(competition: models.Competition, c: dict):
+    """Compute the changes that bring a competition to a competition file."""
+
+    changes = Diff()
+    if competition._grader != c["grader"]:
+        changes.grader = c["grader"]
+        changes.lines.append("~ grader {!r} -> {!r}".format(competition._grader, c["grader"]))
+
+    rounds = {round.ref: round for round in competition.rounds.all()}
+    questions = {}
+    for question in models.Question.objects.filter(round__competition=competition).select_related("round"):
+        questions.setdefault(question.round.ref, {})[question.number] = question
 
-    # Add rounds
     for r in c["rounds"]:
-        round = models.Round.new(
-            competition, r["ref"], name=r["name"],
-            grouping=models.ROUND_GROUPINGS[r["grouping"]])
+        values = {"name": r["name"], "grouping": models.ROUND_GROUPINGS[r["grouping"]]}
+        round = rounds.pop(r["ref"], None)
+        if round is None:
+            changes.rounds_created.append(models.Round.new(competition, r["ref"], save=False, **values))
+            changes.lines.append("+ round {} ({} questions)".format(r["ref"], len(r["questions"])))
+        else:
+            changed = compare(round, values)
+            if changed:
+                changes.rounds_updated.append(round)
+                changes.lines.append("~ round {}: {}".format(r["ref"], describe(changed, round)))
 
-        # Add questions
-        qc = 0
+        existing = questions.pop(r["ref"], {})
         for i, q in enumerate(r["questions"]):
-            models.Question.new(
-                round, i+1, label=q["label"],
-                type=models.QUESTION_TYPES[q["type"]],
-                weight=q.get("weight", 1))
-            qc += 1
-        print("{0.name}: {1} questions".format(round, qc))
+            values = {
+                "label": str(q["label"]),
+                "type": models.QUESTION_TYPES[q["type"]],
+                "weight": float(q.get("weight", 1)),
+                "scoring": q.get("scoring", "")}
+            question = existing.pop(i + 1, None)
+            if question is None:
+                changes.questions_created.append((r["ref"], models.Question(number=i + 1, **values)))
+                if round is not None:
+                    changes.lines.append("+ question {} #{}".format(r["ref"], i + 1))
+            else:
+                changed = compare(question, values)
+                if changed:
+                    changes.questions_updated.append((question, changed))
+                    changes.lines.append("~ question {} #{}: {}".format(r["ref"], i + 1, describe(changed, question)))
+        for number, question in sorted(existing.items()):
+            changes.questions_deleted.append((r["ref"], question))
+            changes.lines.append("- question {} #{} and its answers".format(r["ref"], number))
+
+    for ref, round in rounds.items():
+        changes.rounds_deleted.append(round)
+        changes.lines.append("- round {} and its answers".format(ref))
+        for number, question in sorted(questions.pop(ref, {}).items()):
+            changes.questions_deleted.append((ref, question))
+    return changes
+
+
+def apply(competition: models.Competition, changes: Diff):
+    """Apply a diff to a competition in one transaction with bulk writes."""
+
+    with transaction.atomic(), signals.suspended():
+        if changes.grader is not None:
+            competition._grader = changes.grader
+            competition.save()
+
+        # Removed questions and rounds take their answers with them
+        models.Question.objects.filter(id__in=[question.id for ref, question in changes.questions_deleted]).delete()
+        models.Round.objects.filter(id__in=[round.id for round in changes.rounds_deleted]).delete()
+
+        models.Round.objects.bulk_create(changes.rounds_created)
+        bulk.update(models.Round, changes.rounds_updated, ("name", "grouping"))
+
+        rounds = dict(competition.rounds.values_list("ref", "id"))
+        for ref, question in changes.questions_created:
+            question.round_id = rounds[ref]
+        models.Question.objects.bulk_create(question for ref, question in changes.questions_created)
+        bulk.update(
+            models.Question, [question for question, changed in changes.questions_updated],
+            ("label", "type", "weight", "scoring"))
+
+        # Deletes send signals per instance and bulk writes none, so the
+        # receivers are suspended and everything is brought current once
+        if changes.regrades():
+            totals.rebuild(competition)
+        generations.bump(rounds[ref] for ref in changes.changed_rounds() if ref in rounds)
+
+    plans.invalidate(competition.id)
+    for ref in changes.changed_rounds():
+        live.discard(competition.id, ref)
+
+
+def load(path, loader=None, dry_run: bool=False):
+    """Load a competition file into the active competition.
+
+    Every scoring formula is checked first. Unless this is a dry run,
+    the changes are applied. Returns the diff.
+    """
+
+    c = read(path, loader)
+    for r in c["rounds"]:
+        for q in r["questions"]:
+            if q.get("scoring"):
+                formulas.compile_formula(q["scoring"])
+
+    competition = models.Competition.current()
+    changes = diff(competition, c)
+    if not dry_run:
+        apply(competition, changes)
+    return changes
 
 
 class Command(BaseCommand):
@@ -55,7 +202,8 @@ class Command(BaseCommand):
 
         subparsers = parser.add_subparsers(dest="command", metavar="command")
         load_parser = subparsers.add_parser("load", help="load a competition file", cmd=self)
-        load_parser.add_argument("file", help="competition JSON summary")
+        load_parser.add_argument("file", help="competition JSON or YAML summary")
+        load_parser.add_argument("--dry-run", action="store_true", help="only print the changes")
 
     def handle(self, *args, **kwargs):
         """Handle a call to the command."""
@@ -65,7 +213,10 @@ class Command(BaseCommand):
             path = kwargs["file"]
             if not os.path.isfile(path):
                 raise CommandError("Path is invalid!")
-            load(path)
+            try:
+                print(load(path, dry_run=kwargs["dry_run"]))
+            except formulas.FormulaError as exception:
+                raise CommandError(exception)
             print("Done in {} seconds!".format(round(time.time() - start, 3)))
 
         else:
@@ -0,0 +1,65 @@
+from django.core.management.base import BaseCommand, CommandError
+from grading import backends, export, models, profiling
+
+import time
+
+
+def find_competition(name):
+    """Get a competition by id or name, or the active one if None."""
+
+    if name is None:
+        competition = models.Competition.current()
+        if competition is None:
+            raise CommandError("There is no active competition!")
+        return competition
+
+    competitions = models.Competition.objects.all()
+    competition = (competitions.filter(id=name) if name.isdigit() else competitions.none()).first()
+    competition = competition or competitions.filter(name=name).first()
+    if competition is None:
+        raise CommandError("There is no competition named {}!".format(name))
+    return competition
+
+
+class Command(BaseCommand):
+    """Score a competition outside the web server and export the results."""
+
+    def add_arguments(self, parser):
+        """Add arguments to the command line parser."""
+
+        parser.add_argument("--competition", help="id or name of the competition, default the active one")
+        parser.add_argument("--output", "-o", default="results", help="directory to write the results to")
+        parser.add_argument("--format", choices=("csv", "json", "both"), default="both", help="file format")
+        parser.add_argument("--use-cache", action="store_true", help="reuse current results from a GRADING_CACHE shared with other processes")
+        parser.add_argument("--cold", action="store_true", help="fit the regularization from scratch")
+
+    def handle(self, *args, **kwargs):
+        """Handle a call to the command."""
+
+        # A new process starts with nothing in a store of its own
+        if kwargs["use_cache"] and not backends.is_shared():
+            raise CommandError("--use-cache needs a GRADING_CACHE shared with other processes!")
+
+        competition = find_competition(kwargs["competition"])
+        grader = competition.grader
+        self.stdout.write("Scoring {}...".format(competition.name))
+
+        if kwargs["cold"]:
+            grader.forget_fits()
+        start = time.time()
+        grader.refresh_scoreboards(use_cache=kwargs["use_cache"])
+        graded = time.time()
+        for key, fit in sorted(grader.fits().items()):
+            self.stdout.write("Fit {}: {} evaluations from a {} start, cost {}".format(
+                key, fit["nfev"], "warm" if fit["warm"] else "cold", fit["cost"]))
+        for depth, stage in profiling.flatten(profiling.last_run(grader)):
+            if depth <= 2:
+                self.stdout.write("{}{}: {} seconds, {} queries".format(
+                    "  " * depth, stage["name"], round(stage["wall"], 3), stage["queries"]))
+
+        formats = ("csv", "json") if kwargs["format"] == "both" else (kwargs["format"],)
+        paths = export.write(export.results(grader), kwargs["output"], formats)
+        for path in paths:
+            self.stdout.write("Wrote {}".format(path))
+        self.stdout.write("Graded in {} seconds and exported in {} seconds!".format(
+            round(graded - start, 3), round(time.time() - graded, 3)))
@@ -0,0 +1,73 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import close_old_connections
+from django.test.utils import override_settings
+from grading import backends, generations, live, models, parallel, snapshots
+from grading.grading import RECALCULATE
+
+import time
+import traceback
+
+
+class Command(BaseCommand):
+    """Recalculate the scoreboards of the active competition as answers change.
+
+    Intended to run next to the web server with `GRADING_DAEMON` set, in
+    which case the views only read the results published to the grading
+    cache and never grade inside a request. The live scores of team
+    rounds are caught up on every check.
+    """
+
+    def add_arguments(self, parser):
+        """Add arguments to the command line parser."""
+
+        parser.add_argument("--interval", type=float, default=2, help="seconds between checks for changes")
+        parser.add_argument("--once", action="store_true", help="recalculate once and exit")
+        parser.add_argument("--processes", action="store_true", help="run steps that only compute on processes")
+
+    def handle(self, *args, **kwargs):
+        """Handle a call to the command."""
+
+        if not backends.is_shared():
+            self.stderr.write("GRADING_CACHE is local to this process, results will not be visible to the web server!")
+
+        if kwargs["processes"]:
+            with override_settings(GRADING_POOL=parallel.PROCESS):
+                return self.publish(**kwargs)
+        return self.publish(**kwargs)
+
+    def publish(self, **kwargs):
+        """Recalculate the scoreboards whenever the generations change."""
+
+        published = None
+        while True:
+            close_old_connections()
+            competition = models.Competition.current()
+            if competition is None:
+                raise CommandError("There is no active competition!")
+
+            grader = competition.grader
+            for ref in grader.live_rounds:
+                try:
+                    live_round = grader.round(ref)
+                    if live_round is not None:
+                        live.ensure(grader, live_round)
+                except Exception:
+                    traceback.print_exc()
+
+            forced = grader.cache_get(RECALCULATE) is not None
+            current = (competition.id, generations.current(competition))
+            if forced or current != published:
+                if forced:
+                    del grader.cache[RECALCULATE]
+                start = time.time()
+                try:
+                    grader.refresh_scoreboards(use_cache=not forced)
+                    snapshot = snapshots.capture(grader)
+                    published = current
+                    self.stdout.write("Published scoreboards {} in {} seconds!".format(snapshot, round(time.time() - start, 3)))
+                except Exception:
+                    traceback.print_exc()
+
+            if kwargs["once"]:
+                break
+            time.sleep(kwargs["interval"])
@@ -0,0 +1,41 @@
+from django.core.management.base import BaseCommand, CommandError
+from grading import models, synthetic
+
+import time
+
+
+class Command(BaseCommand):
+    """Fill the active competition with synthetic teams and answers."""
+
+    def add_arguments(self, parser):
+        """Add arguments to the command line parser."""
+
+        parser.add_argument("year", choices=synthetic.years(), help="year of the test competition file to load")
+        parser.add_argument("--teams", type=int, default=30, help="number of teams")
+        parser.add_argument("--students", type=int, default=4, help="students per team")
+        parser.add_argument("--schools", type=int, default=None, help="number of schools")
+        parser.add_argument("--attendance", type=float, default=0.9, help="chance that a student attends")
+        parser.add_argument("--answered", type=float, default=0.9, help="chance that a question is answered")
+        parser.add_argument("--seed", type=int, default=0, help="random seed")
+        parser.add_argument("--create", action="store_true", help="create and activate a new competition first")
+
+    def handle(self, *args, **kwargs):
+        """Handle a call to the command."""
+
+        if kwargs["create"]:
+            synthetic.create_competition("Synthetic {}".format(kwargs["year"]))
+        competition = models.Competition.current()
+        if competition is None:
+            raise CommandError("There is no active competition, pass --create to make one!")
+        try:
+            synthetic.refuse_teams(competition)
+        except ValueError as exception:
+            raise CommandError("{} Pass --create to make a new competition!".format(exception))
+
+        start = time.time()
+        competition, (teams, students, answers) = synthetic.generate(
+            kwargs["year"], teams=kwargs["teams"], students_per_team=kwargs["students"],
+            schools=kwargs["schools"], attendance=kwargs["attendance"], answered=kwargs["answered"],
+            seed=kwargs["seed"])
+        self.stdout.write("Created {} teams, {} students, and {} answers in {} in {} seconds!".format(
+            teams, students, answers, competition.name, round(time.time() - start, 3)))
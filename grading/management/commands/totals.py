@@ -0,0 +1,43 @@
+from django.core.management.base import BaseCommand, CommandError
+from grading import models, totals
+
+import time
+
+
+class Command(BaseCommand):
+    """Rebuild or check the running round totals."""
+
+    def add_arguments(self, parser):
+        """Add arguments to the command line parser."""
+
+        subparsers = parser.add_subparsers(dest="command", metavar="command")
+        subparsers.add_parser("rebuild", help="recompute all totals from the answers", cmd=self)
+        subparsers.add_parser("check", help="compare the totals to the raw round grader", cmd=self)
+
+    def handle(self, *args, **kwargs):
+        """Handle a call to the command."""
+
+        competition = models.Competition.current()
+        if competition is None:
+            raise CommandError("There is no active competition!")
+
+        if kwargs["command"] == "rebuild":
+            start = time.time()
+            totals.rebuild(competition)
+            print("Rebuilt {} totals in {} seconds!".format(
+                models.RoundTotal.objects.filter(round__competition=competition).count(),
+                round(time.time() - start, 3)))
+
+        elif kwargs["command"] == "check":
+            inconsistent = 0
+            for r in competition.rounds.all():
+                mismatches = totals.check(r)
+                print("{0.name}: {1} mismatched".format(r, len(mismatches)))
+                for entity, total, score in mismatches:
+                    print("  {}: total {}, graded {}".format(entity, total, score))
+                inconsistent += len(mismatches)
+            if inconsistent:
+                raise CommandError("Totals are inconsistent, run rebuild to repair them.")
+
+        else:
+            print("The current competition is {}.".format(competition.name))
@@ -0,0 +1,146 @@
+"""Dense answer matrices for grading whole rounds at once.
+
+Instead of querying the answer of every team or student to every
+question one at a time, a round matrix loads all answers to a round in
+a single query and lays them out as an entity by question grid. The
+question weights and entity divisions are kept alongside as vectors so
+that rounds can be graded a question column at a time.
+"""
+
+import numpy as np
+
+import coaches.models
+from . import grading, models, tables
+
+
+def round_entities(round: models.Round, ids=None):
+    """Get the grouping and the gradable entities of a round.
+
+    The entities can be limited to a collection of ids.
+    """
+
+    if round.grouping == models.INDIVIDUAL:
+        entities = coaches.models.Student.objects.filter(
+            team__competition=round.competition_id, attending=True).select_related("team")
+    elif round.grouping == models.TEAM:
+        entities = coaches.models.Team.objects.filter(competition=round.competition_id)
+    else:
+        return None, None
+    if ids is not None:
+        entities = entities.filter(id__in=ids)
+    return "student" if round.grouping == models.INDIVIDUAL else "team", list(entities)
+
+
+def entity_division(group: str, entity):
+    """Get the division of a student or team."""
+
+    return entity.team.division if group == "student" else entity.division
+
+
+class RoundMatrix:
+    """Entity by question matrix of the answers to a round.
+
+    Missing answers are marked false in `present`, while answers that
+    exist but have no value are present with a value of NaN. This
+    mirrors the distinction the per-answer graders make between no
+    answer row and an answer row that has not been filled in.
+    """
+
+    def __init__(self, round: models.Round, entities: list, questions: list):
+        """Initialize an empty matrix for the entities and questions."""
+
+        self.round = round
+        self.entities = entities
+        self.questions = questions
+        self.group = "student" if round.grouping == models.INDIVIDUAL else "team"
+
+        self.entity_index = {entity.id: i for i, entity in enumerate(entities)}
+        self.question_index = {question.id: j for j, question in enumerate(questions)}
+
+        self.weights = np.array([question.weight for question in questions], dtype=float)
+        self.divisions = np.array([entity_division(self.group, entity) for entity in entities], dtype=int)
+
+        shape = (len(entities), len(questions))
+        self.values = np.full(shape, np.nan)
+        self.present = np.zeros(shape, dtype=bool)
+        self.answer_ids = np.zeros(shape, dtype=np.int64)
+
+    @classmethod
+    def load(cls, round: models.Round, questions: list=None, entity_ids=None):
+        """Load the matrix for a round in a constant number of queries.
+
+        The questions of the round are queried unless they are given.
+        Only the rows of the given entity ids are loaded if any are.
+        """
+
+        group, entities = round_entities(round, entity_ids)
+        if entities is None:
+            return None
+
+        questions = list(round.questions.all()) if questions is None else questions
+        matrix = cls(round, entities, questions)
+        field = matrix.group + "_id"
+
+        # Descending so the first answer by id wins, as with first()
+        answers = models.Answer.objects.filter(question__round=round, **{field + "__isnull": False})
+        if entity_ids is not None:
+            answers = answers.filter(**{field + "__in": entity_ids})
+        rows = answers.order_by("-id").values_list("id", field, "question_id", "value")
+        for answer_id, entity_id, question_id, value in rows:
+            i = matrix.entity_index.get(entity_id)
+            j = matrix.question_index.get(question_id)
+            if i is None or j is None:
+                continue
+            matrix.present[i, j] = True
+            matrix.answer_ids[i, j] = answer_id
+            matrix.values[i, j] = np.nan if value is None else value
+
+        return matrix
+
+    def answers(self, j: int):
+        """Build the answer objects of a question column without queries.
+
+        Answers are returned as unsaved model instances carrying their
+        original ids with the entity relation already populated, so
+        that graders written against individual answers keep working.
+        """
+
+        question = self.questions[j]
+        for i in np.flatnonzero(self.present[:, j]):
+            value = self.values[i, j]
+            yield i, models.Answer(
+                id=int(self.answer_ids[i, j]),
+                question=question,
+                value=None if np.isnan(value) else float(value),
+                **{self.group: self.entities[i]})
+
+    def grade(self, column_grader):
+        """Sum the column scores returned by the grader for each entity.
+
+        The column grader is called with the question and its column
+        index and should return a score for every entity. Scores of
+        missing answers are discarded. Columns are accumulated in
+        question order so the totals match summing answer by answer.
+        """
+
+        totals = np.zeros(len(self.entities))
+        for j, question in enumerate(self.questions):
+            scores = np.asarray(column_grader(question, j), dtype=float)
+            totals += np.where(self.present[:, j], np.nan_to_num(scores), 0)
+        return totals
+
+    def split(self, totals):
+        """Separate entity totals into a dictionary by division."""
+
+        scores = grading.ChillDictionary()
+        for division in coaches.models.DIVISIONS_MAP:
+            scores[division] = grading.ChillDictionary()
+        for i, entity in enumerate(self.entities):
+            scores[int(self.divisions[i])][entity] = float(totals[i])
+        return scores
+
+    def table(self, totals):
+        """Build a score table of the entity totals."""
+
+        return tables.ScoreTable(
+            self.group, [entity.id for entity in self.entities], self.divisions, totals)
@@ -1,7 +1,9 @@
+from django.core.exceptions import ValidationError
 from django.db import models
 
 from home.models import Competition
 from coaches.models import Team, Student
+from . import formulas
 
 
 _ROUND_GROUPINGS = (
@@ -31,6 +33,9 @@ class Round(models.Model):
     competition = models.ForeignKey(Competition, related_name="rounds", on_delete=models.CASCADE)
     grouping = models.IntegerField(choices=_ROUND_GROUPINGS)
 
+    # Incremented whenever anything graded in the round changes
+    generation = models.IntegerField(default=0, editable=False)
+
     # TODO: consider having general polymorphic rounds
     # Have single or multiple tests that can be taken by choice
     # Somehow link to student and form for actual test PDF
@@ -60,6 +65,12 @@ class Question(models.Model):
     weight = models.FloatField(default=1.0)
     answer = models.FloatField(blank=True, null=True)
 
+    # Expression scoring an estimate e against the answer a, see formulas
+    scoring = models.CharField(max_length=256, blank=True, default="")
+
+    # Weight as last loaded from or saved to the database
+    stored_weight = None
+
     # TODO: Make sure this is the optimal information for a question
     # Consider having a statistics utility for the question model that
     # returns correct, incorrect, and skipped counts.
@@ -69,6 +80,23 @@ class Question(models.Model):
 
         return "Question[#{}]".format(self.number)
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        """Remember the stored weight so that totals can be rebuilt on changes."""
+
+        question = super().from_db(db, field_names, values)
+        question.stored_weight = question.__dict__.get("weight")
+        return question
+
+    def clean(self):
+        """Check that the scoring formula compiles."""
+
+        if self.scoring:
+            try:
+                formulas.compile_formula(self.scoring)
+            except formulas.FormulaError as exception:
+                raise ValidationError({"scoring": str(exception)})
+
     @staticmethod
     def new(round: Round, number: int, save: bool=True, **options):
         """Create a new question within the round."""
@@ -94,6 +122,66 @@ class Answer(models.Model):
     team = models.ForeignKey(Team, related_name="answers", null=True, blank=True, on_delete=models.CASCADE)
     value = models.FloatField(null=True, blank=True)
 
+    # Value as last loaded from or saved to the database
+    stored_value = None
+
     # TODO: answers have to be queried for statistics, so either the
     # statistics wrapper make such queries or the queries will be
     # defined under the answer model.
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        """Remember the stored value so that changes can be applied."""
+
+        answer = super().from_db(db, field_names, values)
+        answer.stored_value = answer.__dict__.get("value")
+        return answer
+
+
+class RoundTotal(models.Model):
+    """Running raw total of a team or student on a round.
+
+    Totals are kept up to date by applying the change in value of
+    every saved answer, so that raw round scores can be read without
+    grading the round again.
+    """
+
+    round = models.ForeignKey(Round, related_name="totals", on_delete=models.CASCADE)
+    student = models.ForeignKey(Student, related_name="totals", null=True, blank=True, on_delete=models.CASCADE)
+    team = models.ForeignKey(Team, related_name="totals", null=True, blank=True, on_delete=models.CASCADE)
+    total = models.FloatField(default=0)
+
+    class Meta:
+        """Meta information about the total."""
+
+        # One of student and team is always null, and nulls never
+        # collide, so each is unique with the round on its own
+        unique_together = (("round", "student"), ("round", "team"))
+
+
+class ScoreSnapshot(models.Model):
+    """Serialized grader results of a competition at some point in time.
+
+    Snapshots outlive the grading cache, so that scoreboards can be
+    shown after a restart without grading again, and let staff compare
+    the results of two recalculations.
+    """
+
+    competition = models.ForeignKey(Competition, related_name="snapshots", on_delete=models.CASCADE)
+    created = models.DateTimeField(auto_now_add=True)
+    generation = models.IntegerField()
+    digest = models.CharField(max_length=64)
+    data = models.TextField()
+
+    class Meta:
+        """Meta information about the snapshot."""
+
+        ordering = ("-created", "-id")
+        get_latest_by = ("created", "id")
+
+    def __repr__(self):
+        """Represent the snapshot as a string."""
+
+        return "ScoreSnapshot[{}]".format(self.digest[:8])
+
+    __str__ = __repr__
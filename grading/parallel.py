@@ -0,0 +1,107 @@
+"""Pools for running independent grading steps at the same time.
+
+Steps that only compute, such as fitting the regularization of each
+division, are mapped over a pool of processes or threads chosen by the
+`GRADING_POOL` setting, and must then be module-level functions whose
+arguments can be pickled. Steps that query the database, such as
+grading independent rounds, always run on threads, each with its own
+database connection. Since those connections cannot see rows written
+by an open transaction, such steps run in the calling thread inside
+one. Either pool has `GRADING_WORKERS` workers, and with fewer than
+two workers everything runs one step at a time in the calling thread.
+
+Forking a process that already runs threads can deadlock on locks held
+by them, so web servers should keep the default thread pool, and
+processes are only worth it in the scoreboard daemon.
+"""
+
+from django.conf import settings
+from django.db import close_old_connections, connection
+
+import atexit
+import threading
+import multiprocessing
+import concurrent.futures
+
+from . import profiling
+
+
+THREAD = "thread"
+PROCESS = "process"
+
+_executors = {}
+_executors_lock = threading.Lock()
+
+
+def workers():
+    """Get the configured number of workers."""
+
+    return getattr(settings, "GRADING_WORKERS", 0) or 0
+
+
+def executor(kind: str):
+    """Get the shared pool of a kind, or None if steps run serially."""
+
+    count = workers()
+    if count < 2:
+        return None
+
+    with _executors_lock:
+        key = (kind, count)
+        if key not in _executors:
+            if kind == PROCESS:
+                # Forked workers inherit the configured Django project
+                context = multiprocessing.get_context("fork")
+                _executors[key] = concurrent.futures.ProcessPoolExecutor(count, mp_context=context)
+            else:
+                _executors[key] = concurrent.futures.ThreadPoolExecutor(count, thread_name_prefix="grading")
+        return _executors[key]
+
+
+def in_transaction():
+    """Check whether the calling thread is inside a transaction."""
+
+    return connection.in_atomic_block
+
+
+def map(function, items):
+    """Apply a pure function to each item on the configured pool."""
+
+    items = list(items)
+    pool = executor(getattr(settings, "GRADING_POOL", THREAD))
+    if pool is None or len(items) < 2:
+        return [function(item) for item in items]
+    return list(pool.map(function, items))
+
+
+def concurrently(*functions):
+    """Call functions on the thread pool, returning their results in order.
+
+    The functions may query the database and call cached grader
+    methods. Their stages are recorded under the caller's stage. Inside
+    a transaction they are called one at a time in the calling thread.
+    """
+
+    pool = executor(THREAD)
+    if pool is None or len(functions) < 2 or in_transaction():
+        return [function() for function in functions]
+
+    parent = profiling.current()
+
+    def call(function):
+        close_old_connections()
+        with profiling.attached(parent):
+            return function()
+
+    futures = [pool.submit(call, function) for function in functions]
+    return [future.result() for future in futures]
+
+
+@atexit.register
+def shutdown():
+    """Stop the workers of every pool."""
+
+    with _executors_lock:
+        for pool in _executors.values():
+            pool.shutdown()
+        _executors.clear()
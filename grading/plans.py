@@ -0,0 +1,196 @@
+"""Compiled grading plans and the pool of competition graders.
+
+A grading plan loads the rounds and questions of a competition once
+and resolves which registered grader handles each of them. Rather than
+running one query per registration, every registered query is folded
+into a single conditional annotation so that the whole dispatch table
+is loaded along with the definitions in one query per model.
+
+Graders are expensive to build, so they are pooled by competition and
+evicted least recently used first. Saving or deleting a round or
+question drops the pooled grader of its competition in this process
+and bumps a definitions token in the grading cache, which tells the
+other processes sharing that cache to rebuild theirs.
+"""
+
+from django.db.models import Case, When, Value, IntegerField
+
+import collections
+import importlib
+import threading
+import uuid
+
+from . import backends, models
+
+
+DEFAULT_MAX_GRADERS = 8
+
+# Cache entry identifying the current round and question definitions
+DEFINITIONS = "definitions"
+
+
+def dispatch(queryset, rules):
+    """Annotate each row with the index of the last rule matching it.
+
+    Conditions of a case are tried in order, so the rules are listed
+    from last to first for later registrations to take precedence.
+    """
+
+    case = Case(
+        *(When(query, then=Value(index)) for index, (query, target) in reversed(list(enumerate(rules)))),
+        default=Value(-1), output_field=IntegerField()) if rules else Value(-1, output_field=IntegerField())
+    return queryset.annotate(rule=case)
+
+
+def targets(rows, rules):
+    """Map the ids of annotated rows to the targets of their rules."""
+
+    return {row.id: rules[row.rule][1] for row in rows if row.rule >= 0}
+
+
+class GradingPlan:
+    """Rounds, questions, and grader dispatch of a competition.
+
+    Registrations are recorded as they are made and compiled together
+    the first time the plan is used, and again after any later
+    registration.
+    """
+
+    def __init__(self, competition: models.Competition):
+        """Initialize an empty plan for the competition."""
+
+        self.competition = competition
+        self.question_rules = []
+        self.round_rules = []
+        self.compiled = False
+        self.lock = threading.Lock()
+
+        self.rounds = {}
+        self.rounds_by_id = {}
+        self.questions = {}
+        self.question_targets = {}
+        self.round_targets = {}
+
+    def register_question(self, query, target):
+        """Register a target for the questions matching a query."""
+
+        self.question_rules.append((query, target))
+        self.compiled = False
+
+    def register_round(self, query, target):
+        """Register a target for the rounds matching a query."""
+
+        self.round_rules.append((query, target))
+        self.compiled = False
+
+    def compile(self):
+        """Load the definitions and resolve the registered targets."""
+
+        rounds = list(dispatch(
+            models.Round.objects.filter(competition=self.competition).order_by("id"), self.round_rules))
+        questions = list(dispatch(
+            models.Question.objects.filter(round__competition=self.competition).order_by("id"), self.question_rules))
+
+        self.rounds_by_id = {round.id: round for round in rounds}
+        self.rounds = {}
+        self.questions = {round_id: [] for round_id in self.rounds_by_id}
+        for round in self.rounds_by_id.values():
+            self.rounds.setdefault(round.ref, round)
+        for question in questions:
+            question.round = self.rounds_by_id[question.round_id]
+            self.questions[question.round_id].append(question)
+
+        self.question_targets = targets(questions, self.question_rules)
+        self.round_targets = targets(rounds, self.round_rules)
+        self.compiled = True
+
+    def ensure(self):
+        """Compile the plan if it has changed since it was last used."""
+
+        with self.lock:
+            if not self.compiled:
+                self.compile()
+        return self
+
+    def round(self, ref: str):
+        """Get a round by its ref, or None if there is no such round."""
+
+        return self.ensure().rounds.get(ref)
+
+    def round_questions(self, round: models.Round):
+        """Get the questions of a round in order."""
+
+        return self.ensure().questions.get(round.id, [])
+
+    def total_weight(self, round: models.Round):
+        """Get the sum of the question weights of a round."""
+
+        return sum(question.weight for question in self.round_questions(round))
+
+    def question_target(self, question: models.Question):
+        """Get the target registered for a question."""
+
+        return self.ensure().question_targets.get(question.id)
+
+    def round_target(self, round: models.Round):
+        """Get the target registered for a round."""
+
+        return self.ensure().round_targets.get(round.id)
+
+
+def definitions(competition_id):
+    """Get the token of the current definitions of a competition."""
+
+    return backends.GradeCache(competition_id).get(DEFINITIONS)
+
+
+class GraderPool:
+    """Graders of recently used competitions, evicted least recently used."""
+
+    def __init__(self, max_entries: int=DEFAULT_MAX_GRADERS):
+        """Initialize an empty pool."""
+
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()
+        self.lock = threading.RLock()
+
+    def get(self, competition: models.Competition):
+        """Get the grader of a competition, building it if needed."""
+
+        key = (competition.id, competition._grader)
+        token = definitions(competition.id)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] == token:
+                self.entries.move_to_end(key)
+                return entry[1]
+
+            grader = importlib.import_module(competition._grader).Grader(competition)
+            self.entries[key] = (token, grader)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+            return grader
+
+    def discard(self, competition_id):
+        """Drop the graders of a competition."""
+
+        with self.lock:
+            for key in [key for key in self.entries if key[0] == competition_id]:
+                del self.entries[key]
+
+    def clear(self):
+        """Drop every grader."""
+
+        with self.lock:
+            self.entries.clear()
+
+
+pool = GraderPool()
+
+
+def invalidate(competition_id):
+    """Rebuild the graders of a competition after its definitions change."""
+
+    pool.discard(competition_id)
+    backends.GradeCache(competition_id)[DEFINITIONS] = uuid.uuid4().hex
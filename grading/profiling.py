@@ -0,0 +1,211 @@
+"""Timing, query, and memory instrumentation of the grading pipeline.
+
+Every cached grader stage and every round grading call is measured as
+a stage. Stages nest, so a run of the scoreboards is recorded as a tree
+of stages, each with its wall time, the number and total time of the
+SQL queries it ran, and the peak memory it allocated. When a stage
+that publishes, such as a refresh of the scoreboards, finishes as the
+outermost stage of a run, its breakdown is stored in the grading cache
+of the competition, where the scoreboard daemon and the web server can
+both read the last run.
+
+Measuring memory with tracemalloc slows every allocation down, so it is
+only done if tracing was already started, for example with `python -X
+tracemalloc`, or during runs while the `GRADING_PROFILE_MEMORY` setting
+is enabled, in which case tracing stops when the last run finishes.
+"""
+
+from django.conf import settings
+from django.db import connection
+
+import time
+import functools
+import contextlib
+import threading
+import tracemalloc
+
+
+# Cache entry holding the breakdown of the last run
+LAST_RUN = "profile"
+
+_local = threading.local()
+
+# Runs tracing memory, and whether they started the tracing
+_tracing = {"runs": 0, "started": False}
+_tracing_lock = threading.Lock()
+
+
+def stack():
+    """Get the stages currently running in this thread."""
+
+    if not hasattr(_local, "stack"):
+        _local.stack = []
+    return _local.stack
+
+
+def current():
+    """Get the innermost stage running in this thread, if any."""
+
+    parents = stack()
+    return parents[-1] if parents else None
+
+
+@contextlib.contextmanager
+def attached(parent: "Stage"=None):
+    """Record the stages of this thread under a stage of another thread."""
+
+    previous = stack()
+    _local.stack = [parent] if parent is not None else []
+    try:
+        yield
+    finally:
+        _local.stack = previous
+
+
+def memory_enabled():
+    """Check whether stage memory should be measured."""
+
+    return tracemalloc.is_tracing()
+
+
+def start_tracing():
+    """Start tracing memory for a run if enabled, returning whether it was."""
+
+    if not getattr(settings, "GRADING_PROFILE_MEMORY", False):
+        return False
+    with _tracing_lock:
+        if _tracing["runs"] == 0 and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            _tracing["started"] = True
+        _tracing["runs"] += 1
+    return True
+
+
+def stop_tracing():
+    """Stop tracing memory once the last run that traces finishes."""
+
+    with _tracing_lock:
+        _tracing["runs"] -= 1
+        if _tracing["runs"] == 0 and _tracing["started"]:
+            tracemalloc.stop()
+            _tracing["started"] = False
+
+
+class Stage:
+    """Measurements of one stage of the grading pipeline."""
+
+    def __init__(self, name: str, grader=None, publish: bool=False):
+        """Initialize an unstarted stage."""
+
+        self.name = name
+        self.grader = grader
+        self.publish = publish
+        self.tracing = False
+        self.children = []
+        self.wall = 0
+        self.queries = 0
+        self.query_time = 0
+        self.memory = None
+        self.started = None
+        self._peak = 0
+        self._memory_start = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        """Count and time a query run while the stage is active."""
+
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries += 1
+            self.query_time += time.perf_counter() - start
+
+    def __enter__(self):
+        """Start measuring the stage."""
+
+        parents = stack()
+        if parents:
+            parents[-1].children.append(self)
+        else:
+            self.tracing = start_tracing()
+        parents.append(self)
+
+        if memory_enabled():
+            current, peak = tracemalloc.get_traced_memory()
+            if parents[:-1]:
+                parents[-2]._peak = max(parents[-2]._peak, peak)
+            self._memory_start = current
+            self._peak = current
+            tracemalloc.reset_peak()
+            self.memory = 0
+
+        self._wrapper = connection.execute_wrapper(self)
+        self._wrapper.__enter__()
+        self.started = time.time()
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """Finish measuring the stage and publish it if it is outermost and publishes."""
+
+        self.wall = time.perf_counter() - self._start
+        self._wrapper.__exit__(exc_type, exc_value, traceback)
+
+        parents = stack()
+        parents.pop()
+        if self.memory is not None and tracemalloc.is_tracing():
+            peak = max(self._peak, tracemalloc.get_traced_memory()[1])
+            self.memory = peak - self._memory_start
+            if parents:
+                parents[-1]._peak = max(parents[-1]._peak, peak)
+
+        if self.tracing:
+            stop_tracing()
+        if not parents and self.publish and self.grader is not None:
+            self.grader.cache[LAST_RUN] = self.report()
+
+    def report(self):
+        """Get the measurements of the stage and its children."""
+
+        return {
+            "name": self.name,
+            "started": self.started,
+            "wall": self.wall,
+            "queries": self.queries,
+            "query_time": self.query_time,
+            "memory": self.memory,
+            "children": [child.report() for child in self.children]}
+
+
+def stage(name: str, grader=None, publish: bool=False):
+    """Measure a stage, publishing it to the grader's cache if asked and outermost."""
+
+    return Stage(name, grader, publish)
+
+
+def profiled(name: str=None):
+    """Decorate a grader method to be measured as a stage."""
+
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(self, *args, **kwargs):
+            with stage(name or function.__name__, self):
+                return function(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def flatten(report: dict, depth: int=0):
+    """List the stages of a report depth first with their depth."""
+
+    if report is None:
+        return
+    yield depth, report
+    for child in report["children"]:
+        yield from flatten(child, depth + 1)
+
+
+def last_run(grader):
+    """Get the breakdown of the last run of a grader."""
+
+    return grader.cache.get(LAST_RUN)
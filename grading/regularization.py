@@ -0,0 +1,158 @@
+"""Logistic regularization of scores across categories.
+
+Scores in different categories, such as subject tests or the parts of
+the team score, are made comparable by mapping each category through a
+logistic transform t(s, a) = s / (s + e^a (1 - s)) with its own factor
+a. The factors are fitted so that entities scored in several categories
+have transformed scores as close together as possible, weighting each
+pair of categories by the weights and scores involved. The factors are
+constrained so that their weighted sum is zero.
+
+Observations are laid out as a dense entity by category matrix with a
+mask of the scores that are present, so that the residuals of every
+pair of categories and their Jacobian are computed with NumPy instead
+of looping over entities. Scores are expected to be non-negative.
+
+Fits can be started from the parameters of a previous fit, which
+converges in a few evaluations when only some scores have changed.
+"""
+
+import time
+import itertools
+import numpy as np
+import scipy.optimize
+
+
+def observation_matrix(categories: list, observations: dict):
+    """Lay out observations as keys, a score matrix, and a presence mask.
+
+    Observations map each entity to a dictionary of its scores by
+    category. Missing scores are zero in the matrix.
+    """
+
+    keys = list(observations.keys())
+    index = {category: j for j, category in enumerate(categories)}
+    scores = np.zeros((len(keys), len(categories)))
+    present = np.zeros((len(keys), len(categories)), dtype=bool)
+    for i, key in enumerate(keys):
+        for category, score in observations[key].items():
+            j = index[category]
+            scores[i, j] = score
+            present[i, j] = True
+    return keys, scores, present
+
+
+def transform(scores, factors):
+    """Apply the logistic transform of each category to a score matrix."""
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        result = scores / (scores + np.exp(factors) * (1 - scores))
+    return np.nan_to_num(result)
+
+
+def factor_map(weights):
+    """Get the matrix mapping free parameters to the category factors.
+
+    The first d - 1 factors are free, and the last is chosen so that
+    the weighted sum of the factors is zero.
+    """
+
+    d = len(weights)
+    mapping = np.zeros((d, d - 1))
+    mapping[:d - 1] = np.eye(d - 1)
+    mapping[d - 1] = -weights[:d - 1] / weights[d - 1]
+    return mapping
+
+
+def residual_functions(scores, present, weights):
+    """Get the residuals of the free parameters and their Jacobian.
+
+    Each pair of categories contributes a residual per entity of
+    sqrt(w1 w2 s1 s2) (t1 - t2) when both scores are present, whose sum
+    of squares is the regularization loss. Since dt/da = -t (1 - t), the
+    Jacobian follows directly from the transformed scores.
+    """
+
+    d = len(weights)
+    pairs = np.array(list(itertools.combinations(range(d), 2)))
+    first, second = pairs[:, 0], pairs[:, 1]
+    both = present[:, first] & present[:, second]
+    scale = np.sqrt(np.maximum(
+        weights[first] * weights[second] * scores[:, first] * scores[:, second], 0)) * both
+    mapping = factor_map(weights)
+
+    def residuals(x):
+        t = transform(scores, mapping @ x)
+        return (scale * (t[:, first] - t[:, second])).ravel()
+
+    def jacobian(x):
+        t = transform(scores, mapping @ x)
+        slope = -t * (1 - t)
+        jac = slope[:, first, None] * mapping[first] - slope[:, second, None] * mapping[second]
+        return (scale[:, :, None] * jac).reshape(-1, d - 1)
+
+    return residuals, jacobian
+
+
+def fit(scores, present, weights, start=None):
+    """Fit the category factors of a score matrix.
+
+    The fit starts from the free parameters of a previous fit if they
+    are given, and otherwise from zero. Returns the factors and the
+    convergence diagnostics of the fit, including its free parameters.
+    """
+
+    weights = np.asarray(weights, dtype=float)
+    d = len(weights)
+    if d < 2:
+        return np.zeros(d), {"x": [], "warm": False, "nfev": 0, "njev": 0, "cost": 0.0,
+                             "optimality": 0.0, "status": 0, "success": True, "time": 0.0}
+
+    warm = start is not None and len(start) == d - 1
+    x0 = np.asarray(start, dtype=float) if warm else np.zeros(d - 1)
+    residuals, jacobian = residual_functions(scores, present, weights)
+    begin = time.perf_counter()
+    result = scipy.optimize.least_squares(residuals, x0, jac=jacobian, ftol=1e-12)
+    diagnostics = {
+        "x": result.x.tolist(),
+        "warm": warm,
+        "nfev": int(result.nfev),
+        "njev": int(result.njev or 0),
+        "cost": float(result.cost),
+        "optimality": float(result.optimality),
+        "status": int(result.status),
+        "success": bool(result.success),
+        "time": time.perf_counter() - begin}
+    return factor_map(weights) @ result.x, diagnostics
+
+
+def normalize(scores, factors, weights):
+    """Combine the transformed scores of each entity by weight."""
+
+    return transform(scores, factors) @ np.asarray(weights, dtype=float)
+
+
+def regularize(categories: list, observations: dict, weights: dict=None, start=None, diagnostics: bool=False):
+    """Regularize observations and combine them into a score per entity.
+
+    Categories missing from an entity's observations count as zero.
+    Returns the combined scores keyed like the observations, and with
+    `diagnostics` set, also the diagnostics of the fit.
+    """
+
+    weights = np.array([1 if not weights else weights[category] for category in categories], dtype=float)
+    keys, scores, present = observation_matrix(categories, observations)
+    factors, details = fit(scores, present, weights, start)
+    details["factors"] = dict(zip(categories, factors.tolist()))
+    normalized = dict(zip(keys, normalize(scores, factors, weights).tolist()))
+    return (normalized, details) if diagnostics else normalized
+
+
+def regularize_task(task: tuple):
+    """Regularize a tuple of categories, observations, weights, and start.
+
+    Returns the scores and diagnostics, for mapping over a pool.
+    """
+
+    categories, observations, weights, start = task
+    return regularize(categories, observations, weights, start, diagnostics=True)
@@ -0,0 +1,169 @@
+"""Signal receivers that keep derived grading state current."""
+
+import contextlib
+import threading
+
+from django.db.models.signals import pre_save, post_save, pre_delete, post_delete
+from django.dispatch import receiver
+
+from coaches.models import Team, Student
+from . import generations, grading, live, models, plans, snapshots, totals
+
+
+# Deletions being collected and suspensions of this thread
+_local = threading.local()
+
+
+def deleting():
+    """Get the students and teams being deleted as model and key pairs."""
+
+    if not hasattr(_local, "deleting"):
+        _local.deleting = set()
+    return _local.deleting
+
+
+def is_suspended():
+    """Check whether the receivers are suspended in this thread."""
+
+    return getattr(_local, "suspended", 0) > 0
+
+
+@contextlib.contextmanager
+def suspended():
+    """Skip every receiver in this thread for bulk writes.
+
+    Whatever writes inside is responsible for rebuilding the totals and
+    bumping the generations it changed afterwards.
+    """
+
+    _local.suspended = getattr(_local, "suspended", 0) + 1
+    try:
+        yield
+    finally:
+        _local.suspended -= 1
+
+
+def owned_by_deleted(answer: models.Answer):
+    """Check whether an answer goes with a student or team being deleted."""
+
+    return ((Student, answer.student_id) in deleting()
+            or (Team, answer.team_id) in deleting())
+
+
+def answers_changed(changes):
+    """Propagate a batch of answer changes.
+
+    Each change is a tuple of the answer, its old value, and its new
+    value. Anything that writes answers without saving them one by one
+    should call this with its changes.
+    """
+
+    changes = list(changes)
+    if not changes:
+        return
+    totals.apply(changes)
+    generations.bump_questions(answer.question_id for answer, old, new in changes)
+    live.answers_changed(changes)
+
+
+@receiver(post_save, sender=models.Answer)
+def answer_saved(sender, instance: models.Answer, **kwargs):
+    """Apply the change in an answer's value."""
+
+    if not is_suspended():
+        answers_changed([(instance, instance.stored_value, instance.value)])
+    instance.stored_value = instance.value
+
+
+@receiver(post_delete, sender=models.Answer)
+def answer_deleted(sender, instance: models.Answer, **kwargs):
+    """Remove a deleted answer's value.
+
+    Answers removed along with their student or team are skipped, as
+    the totals of the owner go with it.
+    """
+
+    if is_suspended() or owned_by_deleted(instance):
+        return
+    answers_changed([(instance, instance.stored_value, None)])
+
+
+@receiver(pre_save, sender=Student)
+def student_saving(sender, instance: Student, **kwargs):
+    """Invalidate individual rounds when attendance changes."""
+
+    if is_suspended():
+        return
+
+    attending = None
+    if instance.pk is not None:
+        attending = Student.objects.filter(pk=instance.pk).values_list("attending", flat=True).first()
+    if bool(attending) != bool(instance.attending):
+        generations.bump_individual(instance.team.competition_id)
+
+
+@receiver(pre_delete, sender=Team)
+@receiver(pre_delete, sender=Student)
+def owner_deleting(sender, instance, **kwargs):
+    """Note a student or team whose answers are about to be deleted."""
+
+    if is_suspended():
+        return
+
+    deleting().add((sender, instance.pk))
+
+
+@receiver(post_delete, sender=Team)
+@receiver(post_delete, sender=Student)
+def owner_deleted(sender, instance, **kwargs):
+    """Regrade the rounds of a competition once a student or team is gone."""
+
+    if is_suspended():
+        return
+
+    deleting().discard((sender, instance.pk))
+    if sender is Student and (Team, instance.team_id) in deleting():
+        return
+    competition_id = instance.competition_id if sender is Team else instance.team.competition_id
+    generations.bump(models.Round.objects.filter(competition_id=competition_id).values_list("id", flat=True))
+
+
+@receiver(post_save, sender=models.Round)
+@receiver(post_delete, sender=models.Round)
+def round_changed(sender, instance: models.Round, **kwargs):
+    """Rebuild the graders of a competition and regrade a round when it changes."""
+
+    if is_suspended():
+        return
+
+    generations.bump([instance.id])
+    plans.invalidate(instance.competition_id)
+    live.discard(instance.competition_id, instance.ref)
+
+
+@receiver(post_save, sender=models.Question)
+@receiver(post_delete, sender=models.Question)
+def question_changed(sender, instance: models.Question, created: bool=False, **kwargs):
+    """Rebuild the graders of a competition and regrade a round when its questions change.
+
+    Running totals are rebuilt when a saved question's weight changed
+    or a question is removed along with its answers.
+    """
+
+    if is_suspended():
+        return
+
+    competition_id = instance.round.competition_id
+    if kwargs["signal"] is post_delete or not created and instance.weight != instance.stored_weight:
+        totals.rebuild(competition_id)
+    instance.stored_weight = instance.weight
+    generations.bump([instance.round_id])
+    plans.invalidate(competition_id)
+    live.discard(competition_id, instance.round.ref)
+
+
+@receiver(grading.revalidated)
+def result_revalidated(sender, grader, **kwargs):
+    """Snapshot results refreshed in the background, as requests do."""
+
+    snapshots.capture(grader)
@@ -0,0 +1,221 @@
+"""Persisted, versioned snapshots of grader results.
+
+Snapshots store the cached scoreboard results of a grader as JSON, with
+teams and students replaced by their ids. Each snapshot is stamped
+with the total round generation it was taken at and a hash of its
+results, so that identical recalculations are not stored twice. The
+latest snapshot can be restored into the grading cache after a restart,
+and any two snapshots can be compared.
+"""
+
+import json
+import hashlib
+import numpy as np
+
+import coaches.models
+from . import generations, grading, models, tables
+
+
+# Cached grader results that make up the scoreboards
+RESULTS = (
+    "individual_scores", "subject_scores", "team_individual_scores",
+    "raw_team_scores", "team_scores", "raw_guts_scores", "guts_scores",
+    "team_overall_scores", "raw_guts_score", "individual_powers", "individual_weights")
+
+ENTITIES = tables.ENTITIES
+
+# Key marking a serialized score table
+TABLE = "__table__"
+
+
+def encode_key(key):
+    """Encode a dictionary key of a result as a string."""
+
+    for kind, model in ENTITIES.items():
+        if isinstance(key, model):
+            return "{}:{}".format(kind, key.pk)
+    return str(key)
+
+
+def serialize(value):
+    """Convert a result to something that can be dumped as JSON."""
+
+    if isinstance(value, tables.ScoreTable):
+        return {TABLE: value.to_json()}
+    if isinstance(value, dict):
+        return {encode_key(key): serialize(item) for key, item in value.items()}
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def expand(value):
+    """Expand serialized score tables into nested scores keyed like dictionaries."""
+
+    if not isinstance(value, dict):
+        return value
+    if TABLE in value:
+        table = tables.ScoreTable.from_json(value[TABLE])
+        scores = table.to_dict(key=lambda pk: "{}:{}".format(table.kind, pk))
+        return {str(division): group for division, group in scores.items()}
+    return {key: expand(item) for key, item in value.items()}
+
+
+def entity_keys(value, keys=None):
+    """Collect the ids of the entities used as keys by kind."""
+
+    keys = {kind: set() for kind in ENTITIES} if keys is None else keys
+    if isinstance(value, dict):
+        for key, item in value.items():
+            kind, separator, pk = key.partition(":")
+            if separator and kind in keys:
+                keys[kind].add(int(pk))
+            entity_keys(item, keys)
+    return keys
+
+
+def load_entities(data):
+    """Load every entity used in serialized results in one query per kind."""
+
+    keys = entity_keys(data)
+    return {
+        "student": coaches.models.Student.objects.select_related("team__school").in_bulk(keys["student"]),
+        "team": coaches.models.Team.objects.select_related("school").in_bulk(keys["team"])}
+
+
+def decode_key(key, entities):
+    """Decode a dictionary key, returning None for deleted entities."""
+
+    kind, separator, pk = key.partition(":")
+    if separator and kind in entities:
+        return entities[kind].get(int(pk))
+    if key.lstrip("-").isdigit():
+        return int(key)
+    return key
+
+
+def deserialize(value, entities):
+    """Convert serialized results back to dictionaries of entities."""
+
+    if not isinstance(value, dict):
+        return value
+    if TABLE in value:
+        return tables.ScoreTable.from_json(value[TABLE])
+    result = grading.ChillDictionary()
+    for key, item in value.items():
+        decoded = decode_key(key, entities)
+        if decoded is not None:
+            result[decoded] = deserialize(item, entities)
+    return result
+
+
+def latest(competition):
+    """Get the latest snapshot of a competition."""
+
+    return models.ScoreSnapshot.objects.filter(competition=competition).first()
+
+
+def capture(grader):
+    """Store the cached scoreboard results of a grader.
+
+    If the results are identical to the latest snapshot, that snapshot
+    is returned instead of storing a new one.
+    """
+
+    data = {}
+    for name in RESULTS:
+        item = grader.cache.get(name)
+        if item is not None:
+            data[name] = {"result": serialize(item.result), "key": item.key, "generations": item.generations}
+    if not data:
+        return None
+
+    results = json.dumps({name: entry["result"] for name, entry in data.items()}, sort_keys=True)
+    digest = hashlib.sha256(results.encode()).hexdigest()
+    previous = latest(grader.competition)
+    if previous is not None and previous.digest == digest:
+        return previous
+
+    return models.ScoreSnapshot.objects.create(
+        competition=grader.competition,
+        generation=sum(generations.current(grader.competition).values()),
+        digest=digest,
+        data=json.dumps(data, sort_keys=True))
+
+
+def results(snapshot: models.ScoreSnapshot):
+    """Get the results of a snapshot keyed by entity."""
+
+    data = json.loads(snapshot.data)
+    entities = load_entities(data)
+    return {name: deserialize(entry["result"], entities) for name, entry in data.items()}
+
+
+def restore(grader, snapshot: models.ScoreSnapshot=None):
+    """Load a snapshot, by default the latest, into a grader's cache.
+
+    Only results missing from the cache are restored, so results
+    calculated since are kept. Restored results keep the round
+    generations they were calculated from, so they are only used while
+    those rounds are unchanged.
+    """
+
+    snapshot = snapshot or latest(grader.competition)
+    if snapshot is None:
+        return None
+
+    data = json.loads(snapshot.data)
+    data = {name: entry for name, entry in data.items() if name not in grader.cache}
+    entities = load_entities(data)
+    for name, entry in data.items():
+        grader.cache[name] = grading.CachedGrade(
+            deserialize(entry["result"], entities),
+            when=snapshot.created.timestamp(),
+            key=entry["key"],
+            generations=entry["generations"])
+    return snapshot
+
+
+def flatten(value, path=()):
+    """Flatten nested results into paths and scores."""
+
+    if isinstance(value, dict):
+        for key, item in value.items():
+            yield from flatten(item, path + (key,))
+    else:
+        yield path, value
+
+
+def label(key, entities):
+    """Get a readable label for a serialized key."""
+
+    entity = decode_key(key, entities)
+    if isinstance(entity, coaches.models.Team) or isinstance(entity, coaches.models.Student):
+        return entity.name
+    if isinstance(entity, int):
+        return coaches.models.DIVISIONS_MAP.get(entity, key)
+    return coaches.models.SUBJECTS_MAP.get(key, key)
+
+
+def compare(old: models.ScoreSnapshot, new: models.ScoreSnapshot, tolerance: float=1e-9):
+    """List the scores that differ between two snapshots.
+
+    Each difference is given as the result name, a readable path of
+    division, subject, and entity, and the old and new score, either
+    of which is None if the score is missing from that snapshot.
+    """
+
+    old_data = expand(json.loads(old.data))
+    new_data = expand(json.loads(new.data))
+    entities = load_entities({"old": old_data, "new": new_data})
+
+    differences = []
+    for name in RESULTS:
+        before = dict(flatten(old_data.get(name, {}).get("result", {})))
+        after = dict(flatten(new_data.get(name, {}).get("result", {})))
+        for path in sorted(set(before) | set(after)):
+            a, b = before.get(path), after.get(path)
+            if a is not None and b is not None and abs(a - b) <= tolerance:
+                continue
+            differences.append((name, " / ".join(label(key, entities) for key in path), a, b))
+    return differences
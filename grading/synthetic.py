@@ -0,0 +1,150 @@
+"""Synthetic competitions for measuring grading performance.
+
+A synthetic competition is built from one of the competition files
+under the competitions directory and filled with schools, teams,
+students, and random answers. Everything is created with bulk inserts,
+after which the running totals and round generations are brought up to
+date as the answer signals would have done.
+"""
+
+from django.db import transaction
+from django.utils import timezone
+
+import os
+import random
+
+from django.conf import settings
+
+import coaches.models
+from home.models import Competition
+from .management.commands.competition import load
+from . import generations, models, totals
+
+
+COMPETITIONS = os.path.join(settings.BASE_DIR, "competitions")
+
+# Estimation answers are drawn around this value when none is set
+ESTIMATION_ANSWER = 100
+
+
+def definition(year: str):
+    """Get the path of the test competition file of a year."""
+
+    return os.path.join(COMPETITIONS, "mbmt{}".format(year), "test.json")
+
+
+def years():
+    """List the years that have a test competition file."""
+
+    return sorted(
+        name[4:] for name in os.listdir(COMPETITIONS)
+        if name.startswith("mbmt") and os.path.isfile(os.path.join(COMPETITIONS, name, "test.json")))
+
+
+def create_competition(name: str="Synthetic"):
+    """Create and activate an empty competition."""
+
+    today = timezone.now().date()
+    competition = Competition.objects.create(
+        name=name,
+        date=today,
+        date_registration_start=today,
+        date_registration_end=today,
+        date_edit_teams_end=today,
+        date_edit_shirts_end=today,
+        year="synthetic")
+    competition.activate()
+    return competition
+
+
+def refuse_teams(competition: Competition, replace: bool=False):
+    """Refuse to replace the teams of a competition unless asked to."""
+
+    if not replace and coaches.models.Team.objects.filter(competition=competition).exists():
+        raise ValueError("{} already has teams, which populating would delete.".format(competition.name))
+
+
+def populate(competition: Competition, teams: int=30, students_per_team: int=4, schools: int=None,
+             attendance: float=0.9, answered: float=0.9, blank: float=0.05, accuracy: float=0.5,
+             seed: int=0, replace: bool=False):
+    """Fill a competition with teams, students, and random answers.
+
+    Competitions that already have teams are refused unless `replace`
+    is set, in which case their teams are deleted. Teams are spread
+    over the schools and divisions, students pick two different
+    subjects and attend with the given probability, and each question
+    is answered with probability `answered`, left blank with
+    probability `blank`, and otherwise correct with probability
+    `accuracy`. Estimation answers are drawn around the question's
+    answer. Returns the number of teams, students, and answers made.
+    """
+
+    refuse_teams(competition, replace)
+
+    rng = random.Random(seed)
+    schools = schools or max(1, teams // 3)
+    subjects = list(coaches.models.SUBJECTS_MAP)
+    divisions = list(coaches.models.DIVISIONS_MAP)
+
+    with transaction.atomic():
+        coaches.models.Team.objects.filter(competition=competition).delete()
+        school_objects = [
+            coaches.models.School.objects.get_or_create(name="Synthetic School {}".format(i))[0]
+            for i in range(schools)]
+
+        coaches.models.Team.objects.bulk_create(
+            coaches.models.Team(
+                name="Team {}".format(i), number=i, school=school_objects[i % schools],
+                competition=competition, division=divisions[i % len(divisions)])
+            for i in range(teams))
+        team_objects = list(coaches.models.Team.objects.filter(competition=competition).order_by("number"))
+
+        student_objects = []
+        for team in team_objects:
+            for j in range(students_per_team):
+                subject1, subject2 = rng.sample(subjects, 2)
+                student_objects.append(coaches.models.Student(
+                    first_name="Student", last_name="{}-{}".format(team.number, j), team=team,
+                    subject1=subject1, subject2=subject2, grade=rng.choice((6, 7, 8)),
+                    shirt_size=rng.choice((1, 2, 3, 4)), attending=rng.random() < attendance))
+        coaches.models.Student.objects.bulk_create(student_objects)
+        student_objects = list(coaches.models.Student.objects.filter(team__competition=competition))
+
+        rounds = list(models.Round.objects.filter(competition=competition).prefetch_related("questions"))
+        for round in rounds:
+            for question in round.questions.all():
+                if question.type == models.ESTIMATION and question.answer is None:
+                    question.answer = ESTIMATION_ANSWER
+                    models.Question.objects.filter(id=question.id).update(answer=ESTIMATION_ANSWER)
+
+        answers = []
+        for round in rounds:
+            group = "student" if round.grouping == models.INDIVIDUAL else "team"
+            entities = student_objects if group == "student" else team_objects
+            for entity in entities:
+                for question in round.questions.all():
+                    if rng.random() >= answered:
+                        continue
+                    if rng.random() < blank:
+                        value = None
+                    elif question.type == models.ESTIMATION:
+                        value = question.answer * rng.lognormvariate(0, 0.5)
+                    else:
+                        value = 1 if rng.random() < accuracy else 0
+                    answers.append(models.Answer(question=question, value=value, **{group: entity}))
+        models.Answer.objects.bulk_create(answers, batch_size=500)
+
+    # Bulk inserts do not send the signals that keep these current
+    totals.rebuild(competition)
+    generations.bump(round.id for round in rounds)
+    return len(team_objects), len(student_objects), len(answers)
+
+
+def generate(year: str, **options):
+    """Load a year's test competition into the active one and populate it."""
+
+    competition = Competition.current()
+    refuse_teams(competition, options.get("replace", False))
+    load(definition(year))
+    competition.refresh_from_db()
+    return competition, populate(competition, **options)
@@ -0,0 +1,290 @@
+"""Compact score tables keyed by entity id.
+
+A score table stores grader results as parallel NumPy columns of
+entity ids, divisions, subjects, and scores instead of nested
+dictionaries keyed by model instances. Tables are cheap to keep in the
+grading cache, can be serialized to JSON or a binary blob, and can be
+grouped by division and ranked without touching the database. Entity
+instances are only loaded, in one query, when names are needed for
+display.
+"""
+
+import io
+import json
+import numpy as np
+
+import coaches.models
+
+
+ENTITIES = {
+    "student": coaches.models.Student,
+    "team": coaches.models.Team}
+
+# Subject of rows that are not split by subject
+NO_SUBJECT = ""
+
+
+def entity_id(entity):
+    """Get the id of an entity or return an id unchanged."""
+
+    return getattr(entity, "pk", entity)
+
+
+class ScoreTable:
+    """Scores of students or teams with their divisions and subjects.
+
+    Each row is an entity and optionally a subject, so an entity that
+    is scored in two subjects appears in two rows.
+    """
+
+    def __init__(self, kind: str, ids=(), divisions=(), scores=(), subjects=None):
+        """Initialize a table from its columns."""
+
+        self.kind = kind
+        self.ids = np.asarray(ids, dtype=np.int64)
+        self.divisions = np.asarray(divisions, dtype=np.int64)
+        self.scores = np.asarray(scores, dtype=float)
+        self.subjects = np.asarray(
+            [NO_SUBJECT] * len(self.ids) if subjects is None else subjects, dtype="<U8")
+        self._index = None
+
+    @classmethod
+    def from_rows(cls, kind: str, rows):
+        """Build a table from rows of id, division, subject, and score."""
+
+        rows = list(rows)
+        if not rows:
+            return cls(kind)
+        ids, divisions, subjects, scores = zip(*rows)
+        return cls(kind, ids, divisions, scores, subjects)
+
+    @classmethod
+    def from_scores(cls, kind: str, scores: dict, subjects: bool=False):
+        """Build a table from nested dictionaries of scores.
+
+        The scores are keyed by division and then by entity, or by
+        division, subject, and entity if `subjects` is set. Entities
+        may be model instances or ids.
+        """
+
+        def rows():
+            for division, items in scores.items():
+                groups = items.items() if subjects else ((NO_SUBJECT, items),)
+                for subject, group in groups:
+                    for entity, score in group.items():
+                        yield entity_id(entity), division, subject, score
+
+        return cls.from_rows(kind, rows())
+
+    def __len__(self):
+        """Get the number of rows."""
+
+        return len(self.ids)
+
+    def __iter__(self):
+        """Iterate over rows of id, division, subject, and score."""
+
+        for i in range(len(self)):
+            yield int(self.ids[i]), int(self.divisions[i]), str(self.subjects[i]), float(self.scores[i])
+
+    def __eq__(self, other):
+        """Check whether two tables have the same rows in the same order."""
+
+        return (
+            isinstance(other, ScoreTable) and self.kind == other.kind
+            and np.array_equal(self.ids, other.ids)
+            and np.array_equal(self.divisions, other.divisions)
+            and np.array_equal(self.subjects, other.subjects)
+            and np.array_equal(self.scores, other.scores))
+
+    def __repr__(self):
+        """Represent the table as a string."""
+
+        return "ScoreTable[{}, {} rows]".format(self.kind, len(self))
+
+    def __getstate__(self):
+        """Pickle only the columns."""
+
+        return {"kind": self.kind, "ids": self.ids, "divisions": self.divisions,
+                "scores": self.scores, "subjects": self.subjects}
+
+    def __setstate__(self, state):
+        """Restore the columns."""
+
+        self.__dict__.update(state)
+        self._index = None
+
+    ##########
+    # Access #
+    ##########
+
+    @property
+    def index(self):
+        """Get the row of each entity id and subject."""
+
+        if self._index is None:
+            self._index = {(int(i), str(s)): row for row, (i, s) in enumerate(zip(self.ids, self.subjects))}
+        return self._index
+
+    def get(self, entity, default=0, subject: str=NO_SUBJECT):
+        """Get the score of an entity, which may be an instance or an id."""
+
+        row = self.index.get((entity_id(entity), subject))
+        return default if row is None else float(self.scores[row])
+
+    def __contains__(self, entity):
+        """Check whether an entity has a score that is not split by subject."""
+
+        return (entity_id(entity), NO_SUBJECT) in self.index
+
+    def take(self, mask):
+        """Get the rows selected by a mask or index array."""
+
+        return ScoreTable(self.kind, self.ids[mask], self.divisions[mask], self.scores[mask], self.subjects[mask])
+
+    def select(self, division: int=None, subject: str=None):
+        """Get the rows of a division and subject."""
+
+        mask = np.ones(len(self), dtype=bool)
+        if division is not None:
+            mask &= self.divisions == division
+        if subject is not None:
+            mask &= self.subjects == subject
+        return self.take(mask)
+
+    def groups(self):
+        """Iterate over the divisions and their rows in division order."""
+
+        for division in np.unique(self.divisions):
+            yield int(division), self.select(division=division)
+
+    def subject_groups(self):
+        """Iterate over the subjects and their rows in subject order."""
+
+        for subject in np.unique(self.subjects):
+            yield str(subject), self.select(subject=subject)
+
+    ##################
+    # Transformation #
+    ##################
+
+    def with_scores(self, scores):
+        """Get a copy of the table with different scores."""
+
+        return ScoreTable(self.kind, self.ids, self.divisions, scores, self.subjects)
+
+    def scale(self, factor: float):
+        """Multiply every score by a factor."""
+
+        return self.with_scores(self.scores * factor)
+
+    def transform(self, function):
+        """Replace the scores of each division by a function of them."""
+
+        scores = self.scores.copy()
+        for division in np.unique(self.divisions):
+            mask = self.divisions == division
+            scores[mask] = function(self.scores[mask])
+        return self.with_scores(scores)
+
+    def ranks(self):
+        """Rank rows within their division and subject, highest first.
+
+        Tied scores share the best rank, so scores of 9, 7, 7, and 5
+        are ranked 1, 2, 2, and 4.
+        """
+
+        ranks = np.zeros(len(self), dtype=np.int64)
+        for division in np.unique(self.divisions):
+            for subject in np.unique(self.subjects):
+                rows = np.flatnonzero((self.divisions == division) & (self.subjects == subject))
+                scores = self.scores[rows]
+                ranks[rows] = 1 + (scores[None, :] > scores[:, None]).sum(axis=1)
+        return ranks
+
+    def ranked(self):
+        """Sort rows by division and subject, then by score descending."""
+
+        return self.take(np.lexsort((self.ids, -self.scores, self.subjects, self.divisions)))
+
+    ############
+    # Entities #
+    ############
+
+    def entities(self):
+        """Load the entities of the table by id in one query."""
+
+        model = ENTITIES[self.kind]
+        related = "team__school" if self.kind == "student" else "school"
+        return model.objects.select_related(related).in_bulk(set(self.ids.tolist()))
+
+    def names(self):
+        """Get the names of the entities by id."""
+
+        return {pk: entity.name for pk, entity in self.entities().items()}
+
+    #################
+    # Serialization #
+    #################
+
+    def to_dict(self, key=int):
+        """Convert to nested dictionaries of scores keyed by division.
+
+        Rows split by subject are nested under their subject. Entity
+        ids are passed through `key`, which may for example look up
+        model instances.
+        """
+
+        result = {}
+        for pk, division, subject, score in self:
+            group = result.setdefault(division, {})
+            if subject != NO_SUBJECT:
+                group = group.setdefault(subject, {})
+            group[key(pk)] = score
+        return result
+
+    def to_json(self):
+        """Convert to a dictionary of columns that can be dumped as JSON."""
+
+        return {"kind": self.kind, "ids": self.ids.tolist(), "divisions": self.divisions.tolist(),
+                "subjects": self.subjects.tolist(), "scores": self.scores.tolist()}
+
+    @classmethod
+    def from_json(cls, data: dict):
+        """Load a table from a dictionary of columns."""
+
+        return cls(data["kind"], data["ids"], data["divisions"], data["scores"], data["subjects"])
+
+    def dumps(self):
+        """Serialize to a JSON string."""
+
+        return json.dumps(self.to_json())
+
+    @classmethod
+    def loads(cls, string: str):
+        """Load a table from a JSON string."""
+
+        return cls.from_json(json.loads(string))
+
+    def to_bytes(self):
+        """Serialize the columns to a compact binary blob."""
+
+        buffer = io.BytesIO()
+        np.savez(buffer, kind=np.array(self.kind), ids=self.ids, divisions=self.divisions,
+                 scores=self.scores, subjects=self.subjects)
+        return buffer.getvalue()
+
+    @classmethod
+    def from_bytes(cls, blob: bytes):
+        """Load a table from a binary blob."""
+
+        with np.load(io.BytesIO(blob), allow_pickle=False) as data:
+            return cls(str(data["kind"]), data["ids"], data["divisions"], data["scores"], data["subjects"])
+
+
+def coerce(scores, kind: str, subjects: bool=False):
+    """Get a score table from a table or nested dictionaries of scores."""
+
+    if isinstance(scores, ScoreTable):
+        return scores
+    return ScoreTable.from_scores(kind, scores, subjects)
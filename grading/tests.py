@@ -1,3 +1,1394 @@
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.core.management import call_command
+from django.utils import timezone
 
-# Create your tests here.
+import io
+import os
+import csv
+import math
+import itertools
+import json
+import tempfile
+import time
+import random
+import threading
+import numpy as np
+import scipy.optimize
+
+from django.conf import settings
+from django.db.models import Q
+
+from home.models import Competition
+from coaches.models import School, Team, Student, SUBJECTS_MAP
+from .management.commands.competition import load
+from . import aggregates, answers, backends, benchmark, formulas, generations, grading, live, matrix, models, parallel, plans, profiling, regularization, snapshots, synthetic, tables, totals
+
+
+COMPETITION_2020 = os.path.join(settings.BASE_DIR, "competitions", "mbmt2020", "test.json")
+
+
+def create_competition():
+    """Create a competition with teams, students, and answers."""
+
+    today = timezone.now().date()
+    competition = Competition.objects.create(
+        name="MBMT Test",
+        date=today,
+        active=True,
+        date_registration_start=today,
+        date_registration_end=today,
+        date_edit_teams_end=today,
+        date_edit_shirts_end=today,
+        year="test",
+        _grader="competitions.mbmt2020.grading")
+    load(COMPETITION_2020)
+    models.Question.objects.filter(type=models.ESTIMATION).update(answer=100)
+
+    rng = random.Random(2021)
+    subjects = list(SUBJECTS_MAP.keys())
+    school = School.objects.create(name="Blair")
+    for t in range(6):
+        team = Team.objects.create(
+            name="Team {}".format(t), number=t, school=school,
+            competition=competition, division=1 + t % 2)
+        for s in range(4):
+            Student.objects.create(
+                first_name="Student", last_name="{}{}".format(t, s), team=team,
+                subject1=rng.choice(subjects), subject2=rng.choice(subjects),
+                grade=8, shirt_size=1, attending=s != 3)
+
+    for round in competition.rounds.all():
+        if round.grouping == models.INDIVIDUAL:
+            entities = {"student": Student.objects.all()}
+        else:
+            entities = {"team": Team.objects.all()}
+        for group, things in entities.items():
+            for thing in things:
+                for question in round.questions.all():
+                    if rng.random() < 0.1:
+                        continue
+                    value = None if rng.random() < 0.1 else rng.choice((0, 1))
+                    if question.type == models.ESTIMATION and value is not None:
+                        value = rng.uniform(1, 200)
+                    models.Answer.objects.create(question=question, value=value, **{group: thing})
+    return competition
+
+
+@override_settings(GRADING_CACHE=None, GRADING_WORKERS=0)
+class GradingTestCase(TestCase):
+    """Base test case with a small competition and random answers."""
+
+    def setUp(self):
+        """Start every test with an empty grading cache."""
+
+        backends.local.clear()
+
+    @classmethod
+    def setUpTestData(cls):
+        """Create a competition with teams, students, and answers."""
+
+        cls.competition = create_competition()
+
+    def reference_round_scores(self, grader, round):
+        """Grade a round answer by answer as the original grader did."""
+
+        group = "student" if round.grouping == models.INDIVIDUAL else "team"
+        scores = {1: {}, 2: {}}
+        things = Student.objects.filter(attending=True) if group == "student" else Team.objects.all()
+        for thing in things:
+            score = 0
+            for question in round.questions.all():
+                answer = models.Answer.objects.filter(**{group: thing}, question=question).first()
+                if answer:
+                    score += grader.get_question_grader(question)(question, answer) or 0
+            division = thing.team.division if group == "student" else thing.division
+            scores[division][thing] = score
+        return scores
+
+
+class RoundMatrixTests(GradingTestCase):
+    """Test the dense round grading engine."""
+
+    def test_matches_reference(self):
+        """Matrix grading should match grading answer by answer."""
+
+        grader = grading.CompetitionGrader(self.competition)
+        for round in self.competition.rounds.all():
+            self.assertEqual(grader.default_round_grader(round), self.reference_round_scores(grader, round))
+
+    def test_yearly_grader(self):
+        """Yearly question graders should be dispatched per column."""
+
+        grader = self.competition.grader
+        round = self.competition.rounds.get(ref="team")
+        self.assertEqual(grader.grade_round(round), self.reference_round_scores(grader, round))
+
+
+class ArrayQuestionGraderTests(GradingTestCase):
+    """Test registration and dispatch of column question graders."""
+
+    def test_scalar_adapter(self):
+        """Scalar graders should be adapted to grade whole columns."""
+
+        grader = grading.CompetitionGrader(self.competition)
+        grader.register_question_grader(Q(round__ref="guts"), lambda question, answer: 2 * (answer.value or 0))
+        round = self.competition.rounds.get(ref="guts")
+        self.assertEqual(grader.grade_round(round), self.reference_round_scores(grader, round))
+
+    def test_array_dispatch(self):
+        """Array graders should receive whole columns and override scalar ones."""
+
+        calls = []
+
+        def double(question, values, round_matrix):
+            calls.append(question.id)
+            return 2 * np.nan_to_num(values)
+
+        grader = grading.CompetitionGrader(self.competition)
+        grader.register_question_grader(Q(round__ref="guts"), lambda question, answer: 2 * (answer.value or 0))
+        reference = grader.grade_round(self.competition.rounds.get(ref="guts"))
+        grader.register_array_question_grader(Q(round__ref="guts"), double)
+        self.assertEqual(grader.grade_round(self.competition.rounds.get(ref="guts")), reference)
+        self.assertEqual(len(calls), 30)
+
+    def test_estimation_column(self):
+        """The yearly estimation grader should score a column at once."""
+
+        grader = self.competition.grader
+        question = models.Question.objects.get(round__ref="guts", number=26)
+        scores = grader.get_array_question_grader(question)(question, np.array([95, np.nan, -1, 500]), None)
+        np.testing.assert_allclose(scores, [question.weight * 11 / 12, 0, 0, 0])
+
+    def test_constant_queries(self):
+        """Loading a round should not depend on the number of entities."""
+
+        round = self.competition.rounds.get(ref="guts")
+        with self.assertNumQueries(3):
+            round_matrix = matrix.RoundMatrix.load(round)
+        self.assertEqual(round_matrix.values.shape, (6, len(round_matrix.questions)))
+
+
+class RoundTotalTests(GradingTestCase):
+    """Test the running totals kept on answer writes."""
+
+    def test_totals_follow_answers(self):
+        """Totals should match the raw grader after edits and deletes."""
+
+        for answer in models.Answer.objects.filter(question__round__ref="team")[:20]:
+            answer.value = None if answer.value else 1
+            answer.save()
+        answer = models.Answer.objects.filter(question__round__ref="team", value=1).first()
+        answer.delete()
+        models.Answer.objects.create(question=answer.question, team=answer.team, value=0.5)
+
+        for round in self.competition.rounds.all():
+            self.assertEqual(totals.check(round), [])
+
+    def test_rebuild(self):
+        """Rebuilding should reproduce the incrementally kept totals."""
+
+        round = self.competition.rounds.get(ref="guts")
+        before = totals.read(round)
+        models.RoundTotal.objects.all().delete()
+        totals.rebuild(self.competition)
+        self.assertEqual(totals.read(round), before)
+
+    def test_unique(self):
+        """Each team or student should have one total per round."""
+
+        from django.db import IntegrityError, transaction
+        round = self.competition.rounds.get(ref="guts")
+        total = models.RoundTotal.objects.filter(round=round).first()
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            models.RoundTotal.objects.create(round=round, team=total.team, total=0)
+
+
+@override_settings(GRADING_CACHE=None, GRADING_WORKERS=0)
+class DeletionTests(TransactionTestCase):
+    """Test deleting students and teams along with their answers and totals."""
+
+    def setUp(self):
+        """Create the competition outside of a test transaction."""
+
+        backends.local.clear()
+        self.competition = create_competition()
+
+    def test_delete_student(self):
+        """Deleting a student should commit and leave the other totals current."""
+
+        student = Student.objects.filter(answers__value=1).first()
+        pk = student.pk
+        round = self.competition.rounds.get(ref="subject1")
+        before = generations.current(self.competition)
+        student.delete()
+        self.assertFalse(models.RoundTotal.objects.filter(student_id=pk).exists())
+        self.assertGreater(generations.current(self.competition)[round.ref], before[round.ref])
+        for round in self.competition.rounds.all():
+            self.assertEqual(totals.check(round), [])
+
+    def test_delete_team(self):
+        """Deleting a team should take its students, answers, and totals with it."""
+
+        team = Team.objects.filter(answers__value=1).first()
+        pk = team.pk
+        team.delete()
+        self.assertFalse(models.RoundTotal.objects.filter(team_id=pk).exists())
+        self.assertFalse(Student.objects.filter(team_id=pk).exists())
+        self.assertFalse(models.Answer.objects.filter(team_id=pk).exists())
+        for round in self.competition.rounds.all():
+            self.assertEqual(totals.check(round), [])
+
+    def test_delete_materialized(self):
+        """Teams should stay deletable once their empty answers are materialized."""
+
+        round1 = self.competition.rounds.get(ref="subject1")
+        round2 = self.competition.rounds.get(ref="subject2")
+        rounds = ((round1, "subject1"), (round2, "subject2"))
+        before = aggregates.subject_question_counts(rounds)
+        answers.materialize(self.competition)
+        self.assertEqual(aggregates.subject_question_counts(rounds), before)
+
+        team = Team.objects.first()
+        pk = team.pk
+        team.delete()
+        self.assertFalse(models.Answer.objects.filter(team_id=pk).exists())
+        for round in self.competition.rounds.all():
+            self.assertEqual(totals.check(round), [])
+
+    def test_replace_populated(self):
+        """Populating over existing teams should replace them and commit."""
+
+        teams, students, created = synthetic.populate(self.competition, teams=8, seed=1, replace=True)
+        self.assertEqual(Team.objects.filter(competition=self.competition).count(), teams)
+        self.assertEqual(models.Answer.objects.count(), created)
+        for round in self.competition.rounds.all():
+            self.assertEqual(totals.check(round), [])
+
+
+@override_settings(CACHES={"grading": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}})
+class GradeCacheTests(TestCase):
+    """Test the storage of cached grader results."""
+
+    def test_shared_store(self):
+        """Caches of the same competition should see each other's entries."""
+
+        first = backends.GradeCache(1, backends.DjangoStore("grading"))
+        second = backends.GradeCache(1, backends.DjangoStore("grading"))
+        other = backends.GradeCache(2, backends.DjangoStore("grading"))
+        grading.cache_set(first, "scores", {1: 2})
+        self.assertEqual(grading.cache_get(second, "scores"), {1: 2})
+        self.assertIsNone(grading.cache_get(other, "scores"))
+
+    def test_argument_key(self):
+        """Cached results should only be reused for the same arguments."""
+
+        calls = []
+        container = backends.GradeCache(1, backends.LocalStore())
+
+        @grading.cached(container, "square")
+        def square(x):
+            calls.append(x)
+            return x * x
+
+        self.assertEqual([square(2), square(2), square(3)], [4, 4, 9])
+        self.assertEqual(calls, [2, 3])
+        self.assertEqual(grading.cache_get(container, "square"), 9)
+
+    def test_eviction(self):
+        """The local store should be bounded."""
+
+        store = backends.LocalStore(max_entries=2)
+        for key in range(3):
+            store.set(key, key)
+        self.assertEqual((store.get(0), store.get(2)), (None, 2))
+
+
+class GenerationTests(GradingTestCase):
+    """Test invalidation of cached results by round generations."""
+
+    def test_answer_invalidates_round(self):
+        """Saving a guts answer should only invalidate guts results."""
+
+        grader = self.competition.grader
+        grader.calculate_team_scores()
+        individual = grader.cache.get("individual_scores")
+        guts = grader.cache.get("guts_scores")
+
+        answer = models.Answer.objects.filter(question__round__ref="guts").first()
+        answer.value = 0.5
+        answer.save()
+
+        grader.calculate_team_scores()
+        self.assertIs(grader.cache.get("individual_scores").time, individual.time)
+        self.assertGreater(grader.cache.get("guts_scores").time, guts.time)
+
+    def test_attendance_invalidates_individual(self):
+        """Changing attendance should only invalidate individual rounds."""
+
+        before = generations.current(self.competition)
+        student = Student.objects.filter(attending=True).first()
+        student.attending = False
+        student.save()
+        after = generations.current(self.competition)
+        self.assertEqual(after["subject1"], before["subject1"] + 1)
+        self.assertEqual(after["guts"], before["guts"])
+
+
+class SlowGrader(grading.CompetitionGrader):
+    """Grader with a slow cached computation."""
+
+    cache = {}
+
+    def __init__(self, competition):
+        super().__init__(competition)
+        self.calls = 0
+
+    @grading.cached(cache, "slow")
+    def slow(self):
+        self.calls += 1
+        time.sleep(0.2)
+        return self.calls
+
+
+class SingleFlightTests(GradingTestCase):
+    """Test that concurrent callers share one computation."""
+
+    def run_concurrently(self, function, count=8):
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(function())) for i in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_waits_for_result(self):
+        """Callers without a previous value should wait for the result."""
+
+        grader = SlowGrader(self.competition)
+        self.assertEqual(self.run_concurrently(grader.slow), [1] * 8)
+        self.assertEqual(grader.calls, 1)
+
+    def test_previous_value(self):
+        """Callers with a previous value should not wait."""
+
+        grader = SlowGrader(self.competition)
+        grader.slow()
+        time.sleep(0.05)
+        results = self.run_concurrently(lambda: grader.slow(use_cache_before=0.01), count=4)
+        self.assertEqual(grader.calls, 2)
+        self.assertIn(1, results)
+
+    def test_stale_while_revalidate(self):
+        """Stale values should be served while refreshing in the background."""
+
+        grader = SlowGrader(self.competition)
+        grader.slow()
+        time.sleep(0.05)
+        start = time.time()
+        self.assertEqual(grader.slow(use_cache_before=0.01, use_stale_before=60), 1)
+        self.assertLess(time.time() - start, 0.1)
+        time.sleep(0.4)
+        self.assertEqual(grader.cache_get("slow"), 2)
+
+    def test_revalidate_snapshot(self):
+        """Results refreshed in the background should be snapshotted."""
+
+        from unittest import mock
+        grader = SlowGrader(self.competition)
+        grader.slow()
+        time.sleep(0.05)
+        with mock.patch.object(snapshots, "capture") as capture:
+            grader.slow(use_cache_before=0.01, use_stale_before=60)
+            time.sleep(0.4)
+        capture.assert_called_once_with(grader)
+        self.assertEqual(profiling.last_run(grader)["name"], "slow")
+
+    def test_stale_burst(self):
+        """A burst of stale hits should start one refresh, and none without the cache."""
+
+        grader = SlowGrader(self.competition)
+        grader.slow()
+        time.sleep(0.05)
+        threads = threading.active_count()
+        results = [grader.slow(use_cache_before=0.01, use_stale_before=60) for i in range(8)]
+        self.assertEqual(results, [1] * 8)
+        self.assertLessEqual(threading.active_count(), threads + 1)
+        time.sleep(0.4)
+        self.assertEqual(grader.calls, 2)
+
+        self.assertEqual(grader.slow(use_cache=False, use_stale_before=60), 3)
+
+
+class ScoreboardDaemonTests(GradingTestCase):
+    """Test the scoreboard recalculation command."""
+
+    def test_publishes_scoreboards(self):
+        """Running once should publish every scoreboard result."""
+
+        call_command("scoreboard", "--once", stdout=io.StringIO(), stderr=io.StringIO())
+        grader = self.competition.grader
+        for method in grader.scoreboards:
+            self.assertIsNotNone(grader.cache_get(getattr(grader, method).cache_name))
+
+
+class ScoreSnapshotTests(GradingTestCase):
+    """Test persisting and comparing grader results."""
+
+    def test_restore(self):
+        """A restored snapshot should reproduce the cached results."""
+
+        grader = self.competition.grader
+        grader.refresh_scoreboards()
+        expected = grader.cache_get("team_overall_scores")
+        snapshot = snapshots.capture(grader)
+        self.assertEqual(snapshots.capture(grader), snapshot)
+
+        backends.local.clear()
+        snapshots.restore(grader)
+        self.assertEqual(grader.cache_get("team_overall_scores"), expected)
+        self.assertIs(grader.calculate_team_scores(), grader.cache_get("team_overall_scores"))
+
+    def test_individual_modifiers(self):
+        """Individual powers and weights should be restored for the scoreboard."""
+
+        for year, name in (("2018", "individual_powers"), ("2020", "individual_weights")):
+            competition = Competition.objects.get(id=self.competition.id)
+            competition._grader = "competitions.mbmt{}.grading".format(year)
+            grader = competition.grader
+            grader.calculate_individual_scores(use_cache=False)
+            expected = grader.cache_get(name)
+            self.assertTrue(expected)
+            snapshots.capture(grader)
+
+            backends.local.clear()
+            snapshots.restore(grader)
+            self.assertEqual(grader.cache_get(name), expected)
+            models.ScoreSnapshot.objects.all().delete()
+
+    def test_restore_missing(self):
+        """Restoring should keep results calculated since the snapshot."""
+
+        grader = self.competition.grader
+        grader.refresh_scoreboards()
+        snapshots.capture(grader)
+        fresh = grader.cache["individual_scores"]
+        del grader.cache["team_overall_scores"]
+        snapshots.restore(grader)
+        self.assertIs(grader.cache["individual_scores"], fresh)
+        self.assertIsNotNone(grader.cache_get("team_overall_scores"))
+
+    def test_compare(self):
+        """Comparing snapshots should list the changed scores."""
+
+        grader = self.competition.grader
+        grader.refresh_scoreboards()
+        old = snapshots.capture(grader)
+        answer = models.Answer.objects.filter(question__round__ref="guts", value=0).first()
+        answer.value = 1
+        answer.save()
+        grader.refresh_scoreboards()
+        new = snapshots.capture(grader)
+
+        changed = set(name for name, path, before, after in snapshots.compare(old, new))
+        self.assertIn("raw_guts_scores", changed)
+        self.assertNotIn("individual_scores", changed)
+
+
+class GradingPlanTests(GradingTestCase):
+    """Test the compiled grading plan and grader pool."""
+
+    def test_compiled_dispatch(self):
+        """Registrations should be resolved together in one query per model."""
+
+        grader = grading.CompetitionGrader(self.competition)
+        with self.assertNumQueries(0):
+            grader.register_question_grader(Q(round__ref="guts"), lambda question, answer: 2 * (answer.value or 0))
+            grader.register_array_question_grader(Q(type=models.ESTIMATION), grader.default_array_question_grader)
+        with self.assertNumQueries(2):
+            grader.plan.compile()
+
+        estimation = models.Question.objects.get(round__ref="guts", number=26)
+        correct = models.Question.objects.get(round__ref="guts", number=1)
+        self.assertEqual(grader.get_array_question_grader(estimation), grader.default_array_question_grader)
+        self.assertIsInstance(grader.get_array_question_grader(correct), grading.ScalarQuestionGrader)
+        self.assertEqual(grader.get_question_grader(estimation), grader.default_question_grader)
+        self.assertEqual(grader.round("guts").id, estimation.round_id)
+
+    def test_pool(self):
+        """Graders should be reused until the definitions change."""
+
+        grader = self.competition.grader
+        self.assertIs(Competition.objects.get(id=self.competition.id).grader, grader)
+        question = models.Question.objects.get(round__ref="team", number=1)
+        question.weight = 3
+        question.save()
+        rebuilt = self.competition.grader
+        self.assertIsNot(rebuilt, grader)
+        self.assertEqual(rebuilt.plan.round_questions(rebuilt.round("team"))[0].weight, 3)
+
+    def test_eviction(self):
+        """The least recently used grader should be evicted."""
+
+        pool = plans.GraderPool(max_entries=1)
+        grader = pool.get(self.competition)
+        self.assertIs(pool.get(self.competition), grader)
+        other = Competition.objects.get(id=self.competition.id)
+        other._grader = "competitions.mbmt2019.grading"
+        pool.get(other)
+        self.assertIsNot(pool.get(self.competition), grader)
+
+
+class ScoreTableTests(GradingTestCase):
+    """Test the id-keyed score table."""
+
+    def test_matches_round_grader(self):
+        """Tables should hold the same scores as the nested dictionaries."""
+
+        grader = grading.CompetitionGrader(self.competition)
+        for round in self.competition.rounds.all():
+            table = grader.grade_round_table(round)
+            scores = grader.default_round_grader(round)
+            self.assertEqual(table.to_dict(), {
+                division: {entity.id: score for entity, score in scores[division].items()}
+                for division in scores if scores[division]})
+
+    def test_ranks_and_serialization(self):
+        """Tied scores should share a rank and tables should round trip."""
+
+        table = tables.ScoreTable("team", [1, 2, 3, 4, 5], [1, 1, 1, 1, 2], [9, 7, 7, 5, 1])
+        self.assertEqual(table.ranks().tolist(), [1, 2, 2, 4, 1])
+        self.assertEqual([pk for pk, _, _, _ in table.scale(-1).ranked()], [4, 2, 3, 1, 5])
+        self.assertEqual(tables.ScoreTable.loads(table.dumps()), table)
+        self.assertEqual(tables.ScoreTable.from_bytes(table.to_bytes()), table)
+        self.assertEqual(table.get(Team(id=3)), 7)
+        self.assertEqual(table.get(6, default=None), None)
+
+    def test_yearly_graders(self):
+        """Yearly graders should produce tables the scoreboards can show."""
+
+        for year in ("2018", "2019", "2020"):
+            competition = Competition.objects.get(id=self.competition.id)
+            competition._grader = "competitions.mbmt{}.grading".format(year)
+            grader = competition.grader
+            overall = grader.calculate_team_scores(use_cache=False)
+            self.assertIsInstance(overall, tables.ScoreTable)
+            self.assertEqual(len(overall), 6)
+
+            divisions = grading.prepare_composite_team_scores(
+                grader.cache_get("raw_guts_scores"), grader.cache_get("guts_scores"),
+                grader.cache_get("raw_team_scores"), grader.cache_get("team_scores"),
+                grader.cache_get("team_individual_scores"), overall)
+            for name, teams in divisions:
+                self.assertEqual([team[-1] for team in teams], sorted((team[-1] for team in teams), reverse=True))
+            self.assertTrue(grading.prepare_subject_scores(grader.cache_get("subject_scores")))
+
+
+class ProfilingTests(GradingTestCase):
+    """Test the instrumentation of the grading pipeline."""
+
+    @override_settings(GRADING_PROFILE_MEMORY=True)
+    def test_last_run(self):
+        """A scoreboard refresh should be recorded as a tree of stages."""
+
+        import tracemalloc
+        grader = self.competition.grader
+        grader.refresh_scoreboards(use_cache=False)
+        self.assertFalse(tracemalloc.is_tracing())
+
+        report = profiling.last_run(grader)
+        self.assertEqual(report["name"], "refresh_scoreboards")
+        names = [stage["name"] for depth, stage in profiling.flatten(report)]
+        for name in ("individual_scores", "_calculate_individual_modifiers", "grade_round:guts", "team_overall_scores"):
+            self.assertIn(name, names)
+        self.assertGreaterEqual(report["queries"], sum(
+            stage["queries"] for depth, stage in profiling.flatten(report) if depth == 1))
+        self.assertGreater(report["queries"], 0)
+        self.assertGreaterEqual(report["memory"], max(child["memory"] for child in report["children"]))
+
+    def test_views(self):
+        """Staff should see the last run on the index page and as JSON."""
+
+        from django.contrib.auth.models import User
+        self.competition.grader.refresh_scoreboards(use_cache=False)
+        self.competition.grader.guts_live_round_scores(use_cache=False)
+        User.objects.create_superuser("admin", "admin@example.com", "password")
+        self.client.login(username="admin", password="password")
+        self.assertContains(self.client.get("/grading/"), "grade_round:guts")
+        self.assertEqual(json.loads(self.client.get("/grading/api/profile/").content)["name"], "refresh_scoreboards")
+
+
+class BenchmarkTests(GradingTestCase):
+    """Test the synthetic competition generator and benchmark harness."""
+
+    def test_populate(self):
+        """Populating should create answers whose totals are current."""
+
+        teams, students, answers = synthetic.populate(self.competition, teams=8, seed=1, replace=True)
+        self.assertEqual((teams, students), (8, 32))
+        self.assertEqual(models.Answer.objects.count(), answers)
+        for round in self.competition.rounds.all():
+            self.assertEqual(totals.check(round), [])
+
+    def test_refuse_teams(self):
+        """Synthesizing into a competition with teams should leave them alone."""
+
+        from django.core.management.base import CommandError
+        with self.assertRaises(ValueError):
+            synthetic.populate(self.competition, teams=8)
+        with self.assertRaises(CommandError):
+            call_command("synthesize", "2020", stdout=io.StringIO())
+        self.assertEqual(Team.objects.filter(competition=self.competition).count(), 6)
+        self.assertEqual(Student.objects.count(), 24)
+
+    def test_yearly_graders(self):
+        """Every yearly grader should be benchmarked without leaving data."""
+
+        report = benchmark.run(scales=[6])
+        self.assertEqual([result["year"] for result in report["results"]], ["2017", "2018", "2019", "2020"])
+        for result in report["results"]:
+            self.assertNotIn("error", result)
+            self.assertEqual(result["runs"][0]["stages"]["name"], "refresh_scoreboards")
+        json.dumps(report)
+        self.assertEqual(Competition.current(), self.competition)
+        self.assertEqual(Team.objects.count(), 6)
+
+
+class ScoreCommandTests(GradingTestCase):
+    """Test scoring and exporting a competition from the command line."""
+
+    def test_export(self):
+        """Every kind of result should be written as CSV and JSON."""
+
+        Competition.objects.filter(id=self.competition.id).update(active=False)
+        with tempfile.TemporaryDirectory() as directory:
+            call_command("score", competition=self.competition.name, output=directory, stdout=io.StringIO())
+            with open(os.path.join(directory, "team.csv")) as file:
+                teams = list(csv.DictReader(file))
+            with open(os.path.join(directory, "results.json")) as file:
+                results = json.load(file)
+
+        self.assertEqual(len(teams), 6)
+        self.assertEqual(sorted(results), ["guts", "individual", "subject", "team"])
+        self.assertEqual(len(results["individual"]), Student.objects.filter(attending=True).count())
+        self.assertLessEqual(len(results["subject"]), 2 * len(results["individual"]))
+        for division in ("Zermelo", "Dedekind"):
+            ranked = [row for row in results["team"] if row["division"] == division]
+            self.assertEqual([row["rank"] for row in ranked], list(range(1, len(ranked) + 1)))
+
+    def test_use_cache(self):
+        """Reusing cached results should need a cache shared between processes."""
+
+        from django.core.management.base import CommandError
+        with self.assertRaises(CommandError):
+            call_command("score", "--use-cache", stdout=io.StringIO())
+        with self.settings(
+                CACHES={"grading": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}},
+                GRADING_CACHE="grading"):
+            self.assertFalse(backends.is_shared())
+        with self.settings(
+                CACHES={"grading": {"BACKEND": "django.core.cache.backends.filebased.FileBasedCache",
+                                    "LOCATION": tempfile.gettempdir()}},
+                GRADING_CACHE="grading"):
+            self.assertTrue(backends.is_shared())
+
+
+class ParallelTests(GradingTestCase):
+    """Test running independent grading steps on pools."""
+
+    def test_regularization_pools(self):
+        """Divisions regularized on a pool should match serial results."""
+
+        grader = self.competition.grader
+        rng = random.Random(15)
+        observations = {
+            division: {team: {"indiv": rng.random(), "team": rng.random(), "guts": rng.random()}
+                       for team in Team.objects.filter(division=division)}
+            for division in (1, 2)}
+        weights = {"indiv": 50, "team": 25, "guts": 25}
+        serial = grader.logistic_regularization_mdiv(["indiv", "team", "guts"], observations, weights)
+        for pool in (parallel.THREAD, parallel.PROCESS):
+            grader.forget_fits()
+            with self.settings(GRADING_WORKERS=2, GRADING_POOL=pool):
+                self.assertEqual(
+                    grader.logistic_regularization_mdiv(["indiv", "team", "guts"], observations, weights), serial)
+
+    def test_concurrently(self):
+        """Concurrent steps should return in order and nest their stages."""
+
+        def step(value):
+            with profiling.stage("step"):
+                time.sleep(0.05)
+                return value
+
+        # Tests run inside a transaction, which keeps steps serial
+        from unittest import mock
+        grader = grading.CompetitionGrader(self.competition)
+        with self.settings(GRADING_WORKERS=3), mock.patch.object(parallel, "in_transaction", return_value=False):
+            with profiling.stage("outer", grader, publish=True):
+                start = time.time()
+                results = parallel.concurrently(lambda: step(1), lambda: step(2), lambda: step(3))
+                elapsed = time.time() - start
+        self.assertEqual(results, [1, 2, 3])
+        self.assertLess(elapsed, 0.15)
+        self.assertEqual([child["name"] for child in profiling.last_run(grader)["children"]], ["step"] * 3)
+
+    def test_transaction(self):
+        """Steps inside a transaction should see its uncommitted rows."""
+
+        team = Team.objects.create(
+            name="Uncommitted", number=99, school=School.objects.first(), competition=self.competition, division=1)
+        with self.settings(GRADING_WORKERS=3):
+            results = parallel.concurrently(
+                lambda: threading.current_thread().name,
+                lambda: Team.objects.filter(id=team.id).exists())
+        self.assertEqual(results, [threading.current_thread().name, True])
+
+
+def reference_regularization(categories, observations, weights=None):
+    """Regularize observations with the original loop-based loss."""
+
+    if not weights:
+        weights = {c: 1 for c in categories}
+    d = len(categories)
+
+    def transform(s, a):
+        return s/(s+math.e**a*(1-s))
+
+    def factors_of(x):
+        factors = {categories[i]: x[i] for i in range(d-1)}
+        factors[categories[d-1]] = -sum([weights[categories[i]]*x[i] for i in range(d-1)])/weights[categories[d-1]]
+        return factors
+
+    def loss(x):
+        factors = factors_of(x)
+        L = 0
+        for obs in observations.values():
+            for c1, c2 in itertools.combinations(obs.keys(), 2):
+                L += weights[c1] * weights[c2] * obs[c1]*obs[c2]*(transform(obs[c1], factors[c1]) - transform(obs[c2], factors[c2]))**2
+        return L
+
+    factors = factors_of(scipy.optimize.least_squares(loss, [0]*(d-1), ftol=1e-12).x)
+    return {inst: sum([weights[c] * transform(obs.get(c, 0), factors[c]) for c in categories])
+            for inst, obs in observations.items()}
+
+
+class RegularizationTests(TestCase):
+    """Test the vectorized logistic regularization."""
+
+    def test_team_categories(self):
+        """Composite team scores should match the original regularization."""
+
+        rng = random.Random(16)
+        observations = {
+            i: {"indiv": rng.uniform(0.05, 0.6), "team": rng.uniform(0.1, 0.9), "guts": rng.uniform(0.2, 0.7)}
+            for i in range(40)}
+        weights = {"indiv": 50, "team": 25, "guts": 25}
+        expected = reference_regularization(["indiv", "team", "guts"], observations, weights)
+        actual = regularization.regularize(["indiv", "team", "guts"], observations, weights)
+        for key in observations:
+            self.assertAlmostEqual(actual[key], expected[key], places=4)
+
+    def test_subject_categories(self):
+        """Students with two of four subjects should match the original regularization."""
+
+        rng = random.Random(61)
+        subjects = ["al", "nt", "ge", "cp"]
+        bias = {"al": 1.0, "nt": 0.6, "ge": 0.8, "cp": 0.4}
+        observations = {}
+        for i in range(60):
+            first, second = rng.sample(subjects, 2)
+            observations[i] = {subject: min(0.95, bias[subject] * rng.uniform(0.1, 0.9)) for subject in (first, second)}
+        expected = reference_regularization(subjects, observations)
+        actual = regularization.regularize(subjects, observations)
+        for key in observations:
+            self.assertAlmostEqual(actual[key], expected[key], places=4)
+
+    def test_jacobian(self):
+        """The analytic Jacobian should match finite differences."""
+
+        rng = np.random.RandomState(0)
+        scores = rng.uniform(0.05, 0.95, (20, 3))
+        present = rng.uniform(size=(20, 3)) < 0.8
+        weights = np.array([2.0, 1.0, 1.0])
+        residuals, jacobian = regularization.residual_functions(scores, present, weights)
+        x = np.array([0.3, -0.2])
+        analytic = jacobian(x)
+        numeric = np.stack([
+            (residuals(x + h) - residuals(x - h)) / 2e-6 for h in np.eye(2) * 1e-6], axis=1)
+        np.testing.assert_allclose(analytic, numeric, rtol=1e-5, atol=1e-8)
+
+
+class WarmStartTests(GradingTestCase):
+    """Test starting regularization fits from the last fits."""
+
+    def test_warm_start(self):
+        """Refits should start from the last fit unless it is forgotten."""
+
+        grader = self.competition.grader
+        grader.calculate_team_scores(use_cache=False)
+        cold = grader.fits()
+        self.assertTrue(cold)
+        self.assertFalse(any(fit["warm"] for fit in cold.values()))
+
+        answer = models.Answer.objects.filter(question__round__ref="team", value=0).first()
+        answer.value = 1
+        answer.save()
+        grader.calculate_team_scores(use_cache=False)
+        warm = {key: fit for key, fit in grader.fits().items() if key.endswith("indiv,team,guts")}
+        self.assertEqual(len(warm), 2)
+        for key, fit in warm.items():
+            self.assertTrue(fit["warm"])
+            self.assertLessEqual(fit["nfev"], cold[key]["nfev"])
+            self.assertIn("factors", fit)
+
+        grader.forget_fits()
+        grader.calculate_team_scores(use_cache=False)
+        self.assertFalse(any(fit["warm"] for fit in grader.fits().values()))
+
+    def test_same_result(self):
+        """A warm start should converge to the same scores."""
+
+        rng = random.Random(17)
+        observations = {i: {"a": rng.uniform(0.1, 0.9), "b": rng.uniform(0.1, 0.5)} for i in range(30)}
+        cold, cold_fit = regularization.regularize(["a", "b"], observations, diagnostics=True)
+        warm, warm_fit = regularization.regularize(["a", "b"], observations, start=cold_fit["x"], diagnostics=True)
+        self.assertTrue(warm_fit["warm"])
+        self.assertLess(warm_fit["nfev"], cold_fit["nfev"])
+        for key in observations:
+            self.assertAlmostEqual(warm[key], cold[key], places=6)
+
+
+class AggregateTests(GradingTestCase):
+    """Test grouped answer statistics."""
+
+    def test_subject_question_counts(self):
+        """Counts should match counting answer by answer in one query."""
+
+        round1 = self.competition.rounds.get(ref="subject1")
+        round2 = self.competition.rounds.get(ref="subject2")
+        expected = {division: {} for division in (1, 2)}
+        for i, round in enumerate((round1, round2)):
+            for answer in models.Answer.objects.filter(question__round=round):
+                if not answer.student.attending or answer.value is None:
+                    continue
+                subject = answer.student.subject1 if i == 0 else answer.student.subject2
+                counts = expected[answer.student.team.division].setdefault(subject, {})
+                correct, total = counts.get(answer.question.number, (0, 0))
+                counts[answer.question.number] = (correct + (answer.value or 0), total + 1)
+
+        with self.assertNumQueries(1):
+            counts = aggregates.subject_question_counts(((round1, "subject1"), (round2, "subject2")))
+        self.assertEqual(counts, expected)
+
+
+class LiveScoreTests(GradingTestCase):
+    """Test the incremental live guts scores."""
+
+    def expected(self, grader, round):
+        """Grade the round from scratch as division, score, and rank."""
+
+        table = grader.guts_live_round_scores(use_cache=False)
+        return {int(pk): (division, score, rank) for (pk, division, subject, score), rank in zip(table, table.ranks())}
+
+    def test_delta(self):
+        """Saving answers should update and report only the changed teams."""
+
+        grader = self.competition.grader
+        round = grader.round("guts")
+        first = live.delta(grader, round)
+        self.assertTrue(first["full"])
+        self.assertEqual(len(first["teams"]), Team.objects.count())
+        self.assertEqual(live.delta(grader, round, first["version"])["teams"], {})
+
+        answer = models.Answer.objects.filter(question__round=round, question__type=models.CORRECT, value=0).first()
+        answer.value = 1
+        answer.save()
+        update = live.delta(grader, round, first["version"])
+        self.assertFalse(update["full"])
+        self.assertEqual(update["version"], first["version"] + 1)
+        self.assertIn(str(answer.team_id), update["teams"])
+        self.assertLess(len(update["teams"]), len(first["teams"]))
+
+        state = grader.cache[live.key("guts")]
+        for pk, (division, score, rank) in self.expected(grader, round).items():
+            self.assertEqual(state["teams"][pk][0], division)
+            self.assertAlmostEqual(state["teams"][pk][1], score)
+            self.assertEqual(state["teams"][pk][2], rank)
+        for pk, team in first["teams"].items():
+            if pk not in update["teams"]:
+                self.assertEqual(state["teams"][int(pk)][1:], [team["score"], team["rank"]])
+
+        self.assertTrue(live.delta(grader, round, first["version"] - 1)["full"])
+
+    def test_view(self):
+        """Staff should get deltas keyed by team id."""
+
+        from django.contrib.auth.models import User
+        User.objects.create_superuser("admin", "admin@example.com", "password")
+        self.client.login(username="admin", password="password")
+        first = json.loads(self.client.get("/grading/live/guts/update/").content)
+        self.assertTrue(first["full"])
+        self.assertEqual(set(first["teams"]), set(str(pk) for pk in Team.objects.values_list("id", flat=True)))
+        again = json.loads(self.client.get("/grading/live/guts/update/", {"since": first["version"]}).content)
+        self.assertEqual(again, {"version": first["version"], "full": False, "teams": {}})
+
+    def test_events(self):
+        """Streams should push each new version once with its changed teams."""
+
+        grader = self.competition.grader
+        round = grader.round("guts")
+        stream = live.events(grader, round, keepalive=0.05)
+        self.assertTrue(next(stream).startswith("retry:"))
+
+        def event(chunk):
+            lines = dict(line.split(": ", 1) for line in chunk.strip().split("\n"))
+            self.assertEqual(lines["event"], "standings")
+            data = json.loads(lines["data"])
+            self.assertEqual(int(lines["id"]), data["version"])
+            return data
+
+        first = event(next(stream))
+        self.assertTrue(first["full"])
+        self.assertEqual(next(stream), ": keepalive\n\n")
+
+        answer = models.Answer.objects.filter(question__round=round, question__type=models.CORRECT, value=0).first()
+        answer.value = 1
+        answer.save()
+        update = event(next(stream))
+        self.assertEqual(update["version"], first["version"] + 1)
+        self.assertIn(str(answer.team_id), update["teams"])
+        self.assertIs(live.dumps(grader, round, first["version"])[1], live.dumps(grader, round, first["version"])[1])
+
+        resumed = live.events(grader, round, since=first["version"])
+        next(resumed)
+        self.assertEqual(event(next(resumed)), update)
+
+    def test_catch_up(self):
+        """Changes whose merge was missed should be caught up by grading every team."""
+
+        grader = self.competition.grader
+        round = grader.round("guts")
+        first = live.delta(grader, round)
+        answer = models.Answer.objects.filter(question__round=round, question__type=models.CORRECT, value=0).first()
+        models.Answer.objects.filter(id=answer.id).update(value=1)
+        generations.bump([round.id])
+
+        update = live.delta(grader, round, first["version"])
+        self.assertFalse(update["full"])
+        self.assertIn(str(answer.team_id), update["teams"])
+        state = grader.cache[live.key("guts")]
+        for pk, (division, score, rank) in self.expected(grader, round).items():
+            self.assertAlmostEqual(state["teams"][pk][1], score)
+
+    def test_not_incremental(self):
+        """Graders that score teams against each other should grade every team on a save."""
+
+        from unittest import mock
+        grader = self.competition.grader
+        round = grader.round("guts")
+        live.ensure(grader, round)
+        answer = models.Answer.objects.filter(question__round=round, question__type=models.CORRECT, value=0).first()
+        with mock.patch.object(type(grader), "live_incremental", False), \
+                mock.patch.object(live, "grade", wraps=live.grade) as grade:
+            answer.value = 1
+            answer.save()
+        grade.assert_called_once_with(grader, round)
+
+    def test_events_setting(self):
+        """Streams should only be served when enabled."""
+
+        from django.contrib.auth.models import User
+        User.objects.create_superuser("admin", "admin@example.com", "password")
+        self.client.login(username="admin", password="password")
+        self.assertEqual(self.client.get("/grading/live/guts/events/").status_code, 404)
+        self.assertContains(self.client.get("/grading/live/guts/"), "const events = false;")
+        with self.settings(GRADING_LIVE_EVENTS=True):
+            response = self.client.get("/grading/live/guts/events/")
+            self.assertEqual(response["Content-Type"], "text/event-stream")
+            self.assertTrue(next(iter(response.streaming_content)).startswith(b"retry:"))
+            response.close()
+            self.assertContains(self.client.get("/grading/live/guts/"), "const events = true;")
+
+    @override_settings(GRADING_DAEMON=True)
+    def test_daemon(self):
+        """Requests should only read live scores that the daemon keeps current."""
+
+        from django.contrib.auth.models import User
+        User.objects.create_superuser("admin", "admin@example.com", "password")
+        self.client.login(username="admin", password="password")
+        self.assertEqual(
+            json.loads(self.client.get("/grading/live/guts/update/").content),
+            {"version": 0, "full": True, "teams": {}})
+        self.assertNotIn(live.key("guts"), self.competition.grader.cache)
+
+        call_command("scoreboard", "--once", stdout=io.StringIO(), stderr=io.StringIO())
+        first = json.loads(self.client.get("/grading/live/guts/update/").content)
+        self.assertEqual(len(first["teams"]), Team.objects.count())
+
+        answer = models.Answer.objects.filter(
+            question__round__ref="guts", question__type=models.CORRECT, value=0).first()
+        answer.value = 1
+        answer.save()
+        self.assertEqual(self.competition.grader.cache[live.key("guts")]["version"], first["version"])
+        call_command("scoreboard", "--once", stdout=io.StringIO(), stderr=io.StringIO())
+        update = json.loads(self.client.get("/grading/live/guts/update/", {"since": first["version"]}).content)
+        self.assertEqual(update["version"], first["version"] + 1)
+        self.assertIn(str(answer.team_id), update["teams"])
+
+
+class ConditionalResponseTests(GradingTestCase):
+    """Test entity tags and rendered response caching of scoreboards."""
+
+    def setUp(self):
+        """Log in as staff with a CSRF cookie."""
+
+        super().setUp()
+        from django.contrib.auth.models import User
+        from django.middleware.csrf import _get_new_csrf_token
+        User.objects.create_superuser("admin", "admin@example.com", "password")
+        self.client.login(username="admin", password="password")
+        self.client.cookies[settings.CSRF_COOKIE_NAME] = _get_new_csrf_token()
+
+    def test_scoreboard(self):
+        """Unchanged scoreboards should be answered with 304 and new scores with a new tag."""
+
+        first = self.client.get("/grading/scoreboard/teams/")
+        self.assertEqual(first.status_code, 200)
+        self.assertIn("Last-Modified", first)
+        etag = first["ETag"]
+
+        again = self.client.get("/grading/scoreboard/teams/", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(again.status_code, 304)
+        self.assertEqual(again["ETag"], etag)
+        modified = self.client.get("/grading/scoreboard/teams/", HTTP_IF_MODIFIED_SINCE=first["Last-Modified"])
+        self.assertEqual(modified.status_code, 200)
+        self.assertEqual(self.client.get("/grading/scoreboard/teams/").content, first.content)
+
+        answer = models.Answer.objects.filter(question__round__ref="team", value=0).first()
+        answer.value = 1
+        answer.save()
+        changed = self.client.get("/grading/scoreboard/teams/", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(changed.status_code, 200)
+        self.assertNotEqual(changed["ETag"], etag)
+
+    def test_live_update(self):
+        """Live updates should be tagged by their version."""
+
+        first = self.client.get("/grading/live/guts/update/")
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(self.client.get("/grading/live/guts/update/", HTTP_IF_NONE_MATCH=first["ETag"]).status_code, 304)
+        since = self.client.get("/grading/live/guts/update/", {"since": json.loads(first.content)["version"]})
+        self.assertNotEqual(since["ETag"], first["ETag"])
+
+
+class FormulaTests(GradingTestCase):
+    """Test compiled estimation scoring formulas."""
+
+    def test_matches_numpy(self):
+        """Formulas should score columns as the equivalent NumPy code."""
+
+        e = np.array([0, 1, 50, 99.5, 100, 180, 10**6, np.nan])
+        a = 100
+        with np.errstate(divide="ignore", invalid="ignore"):
+            expected = {
+                "max(0, 12-abs(a-e)/5) / 12": np.maximum(0, 12-abs(a-e)/5) / 12,
+                "12*min(e/a, a/e)**3": 12*np.minimum(e/a, a/e)**3,
+                "max(0, 12-500*(abs(a-e)/a)**2)": np.maximum(0, 12-500*(abs(a-e)/a)**2),
+                "log(e) if e > 1 else 0": np.where(e > 1, np.log(e), 0)}
+        for expression, values in expected.items():
+            np.testing.assert_allclose(formulas.evaluate(expression, e, a), np.nan_to_num(values, posinf=0))
+
+    def test_unsafe(self):
+        """Anything but arithmetic on the estimate and answer should be rejected."""
+
+        for expression in ("__import__('os')", "e.real", "(lambda: 1)()", "'x'", "[e]", "e if True else a",
+                           "0 < e < 1", "max(e, a, key=abs)", "min(e)", "b + 1", "e;"):
+            with self.assertRaises(formulas.FormulaError, msg=expression):
+                formulas.compile_formula(expression)
+
+    def test_yearly_grader(self):
+        """Estimation questions should be scored by the formulas they were loaded with."""
+
+        round = self.competition.rounds.get(ref="guts")
+        question = round.questions.get(number=26)
+        self.assertEqual(question.scoring, "max(0, 12-abs(a-e)/5) / 12")
+        grader = self.competition.grader
+        values = np.array([np.nan, -5, 90, 100])
+        np.testing.assert_allclose(
+            grader.guts_question_grader(question, values, None), [0, 0, 10, 12])
+
+    def test_missing(self):
+        """Estimation questions without a formula should not score as zero."""
+
+        question = self.competition.rounds.get(ref="guts").questions.get(number=26)
+        question.scoring = ""
+        with self.assertRaises(formulas.FormulaError):
+            self.competition.grader.guts_question_grader(question, np.array([100.0]), None)
+
+    def test_edit(self):
+        """Editing a formula or weight should regrade cached scores and totals."""
+
+        grader = self.competition.grader
+        round = self.competition.rounds.get(ref="guts")
+        team = Team.objects.first()
+        before = [tuple(row) for row in grader.guts_live_round_scores()]
+        total = models.RoundTotal.objects.get(round=round, team=team).total
+
+        estimate = round.questions.get(number=26)
+        estimate.scoring = "1"
+        estimate.save()
+        grader = self.competition.grader
+        self.assertEqual(grader.guts_question_grader(estimate, np.array([1.0, 500.0]), None).tolist(), [12, 12])
+        after = [tuple(row) for row in grader.guts_live_round_scores()]
+        self.assertNotEqual(before, after)
+
+        question = models.Answer.objects.filter(team=team, question__round=round, value=1).first().question
+        question.weight += 10
+        question.save()
+        self.assertNotEqual(after, [tuple(row) for row in self.competition.grader.guts_live_round_scores()])
+        self.assertAlmostEqual(models.RoundTotal.objects.get(round=round, team=team).total, total + 10)
+        self.assertEqual(totals.check(round), [])
+
+    def test_validation(self):
+        """Invalid formulas should be rejected by the model and the loader."""
+
+        from django.core.exceptions import ValidationError
+        question = models.Question.objects.filter(type=models.ESTIMATION).first()
+        question.scoring = "e.__class__"
+        with self.assertRaises(ValidationError):
+            question.full_clean()
+
+        with open(COMPETITION_2020) as file:
+            definition = json.load(file)
+        definition["rounds"][-1]["questions"][-1]["scoring"] = "open('x')"
+        with tempfile.NamedTemporaryFile("w", suffix=".json", delete=False) as file:
+            json.dump(definition, file)
+        try:
+            with self.assertRaises(formulas.FormulaError):
+                load(file.name)
+        finally:
+            os.remove(file.name)
+        self.assertTrue(models.Question.objects.filter(round__competition=self.competition).exists())
+
+
+class CompetitionLoaderTests(GradingTestCase):
+    """Test loading competition files as a diff."""
+
+    def write(self, definition, suffix=".json"):
+        """Write a competition definition to a temporary file."""
+
+        import yaml
+        file = tempfile.NamedTemporaryFile("w", suffix=suffix, delete=False)
+        with file:
+            (yaml.safe_dump if suffix == ".yaml" else json.dump)(definition, file)
+        self.addCleanup(os.remove, file.name)
+        return file.name
+
+    def definition(self):
+        """Read the test competition definition."""
+
+        with open(COMPETITION_2020) as file:
+            return json.load(file)
+
+    def test_unchanged(self):
+        """Loading the same file again should change nothing."""
+
+        answers = models.Answer.objects.count()
+        self.assertFalse(load(COMPETITION_2020))
+        self.assertFalse(load(self.write(self.definition(), ".yaml")))
+        self.assertEqual(models.Answer.objects.count(), answers)
+
+    def test_upsert(self):
+        """Edited questions should keep their answers and removed ones lose them."""
+
+        definition = self.definition()
+        guts = definition["rounds"][-1]
+        guts["questions"][0]["weight"] = 30
+        removed = guts["questions"].pop()
+        definition["rounds"][0]["questions"].append({"label": 9, "type": "correct"})
+        definition["rounds"].append({"ref": "relay", "name": "Relay Round", "grouping": "team", "questions": [
+            {"label": 1, "type": "correct"}, {"label": 2, "type": "correct"}]})
+
+        round = self.competition.rounds.get(ref="guts")
+        first = round.questions.get(number=1)
+        kept = first.answers.count()
+        generation = round.generation
+        path = self.write(definition)
+
+        changes = load(path, dry_run=True)
+        self.assertIn("~ question guts #1: weight 3.0 -> 30.0", str(changes))
+        self.assertIn("- question guts #30 and its answers", str(changes))
+        self.assertIn("+ question subject1 #9", str(changes))
+        self.assertIn("+ round relay (2 questions)", str(changes))
+        self.assertEqual(round.questions.get(number=1).weight, 3)
+
+        load(path)
+        question = round.questions.get(number=1)
+        self.assertEqual((question.id, question.weight, question.answers.count()), (first.id, 30, kept))
+        self.assertFalse(round.questions.filter(number=30).exists())
+        self.assertEqual(self.competition.rounds.get(ref="relay").questions.count(), 2)
+        self.assertEqual(self.competition.rounds.get(ref="subject1").questions.count(), 9)
+        self.assertGreater(models.Round.objects.get(id=round.id).generation, generation)
+        self.assertEqual(totals.check(models.Round.objects.get(id=round.id)), [])
+        self.assertEqual(len(self.competition.grader.plan.round_questions(round)), len(guts["questions"]))
+        self.assertFalse(load(path))
+
+    def test_bulk_removal(self):
+        """Removing questions and rounds should rebuild the totals once."""
+
+        from unittest import mock
+        definition = self.definition()
+        guts = definition["rounds"][-1]
+        del guts["questions"][-5:]
+        definition["rounds"] = [r for r in definition["rounds"] if r["ref"] != "team"]
+
+        with mock.patch.object(totals, "rebuild", wraps=totals.rebuild) as rebuild, \
+                mock.patch.object(totals, "apply", wraps=totals.apply) as apply:
+            load(self.write(definition))
+        self.assertEqual(rebuild.call_count, 1)
+        self.assertEqual(apply.call_count, 0)
+        self.assertFalse(self.competition.rounds.filter(ref="team").exists())
+        for round in self.competition.rounds.all():
+            self.assertEqual(totals.check(round), [])
+
+    def test_command(self):
+        """The command should print the diff of a dry run without applying it."""
+
+        import io
+        definition = self.definition()
+        definition["rounds"][0]["name"] = "Subject Round 1"
+        from contextlib import redirect_stdout
+        from .management.commands.competition import Command
+        output = io.StringIO()
+        with redirect_stdout(output):
+            Command().handle(command="load", file=self.write(definition), dry_run=True)
+        self.assertIn("~ round subject1: name 'Individual Round 1' -> 'Subject Round 1'", output.getvalue())
+        self.assertEqual(self.competition.rounds.get(ref="subject1").name, "Individual Round 1")
+
+
+class AnswerGridTests(GradingTestCase):
+    """Test bulk creation and writing of answers."""
+
+    def test_materialize(self):
+        """Every entity should get an answer to every question once."""
+
+        created = answers.materialize(self.competition)
+        self.assertGreater(created, 0)
+        for round in self.competition.rounds.all():
+            count = Student.objects.count() if round.grouping == models.INDIVIDUAL else Team.objects.count()
+            missing = count * round.questions.count() - models.Answer.objects.filter(
+                question__round=round).values("question", "student", "team").distinct().count()
+            self.assertEqual(missing, 0)
+        self.assertEqual(answers.materialize(self.competition), 0)
+
+    def test_sheet_and_write(self):
+        """Sheets should be read in constant queries and written in one transaction."""
+
+        answers.materialize(self.competition)
+        round = self.competition.rounds.get(ref="team")
+        team = Team.objects.first()
+        with self.assertNumQueries(2):
+            sheet = answers.sheet(round, team)
+        self.assertEqual([question.number for question, answer in sheet], list(range(1, 16)))
+
+        values = [(answer, 1.0) for question, answer in sheet]
+        changed = [answer for answer, value in values if answer.value != 1]
+        self.assertEqual(answers.write(values), changed)
+        self.assertEqual(answers.write(values), [])
+        stored = models.Answer.objects.filter(id__in=[answer.id for answer in changed]).values_list("value", flat=True)
+        self.assertEqual(set(stored), {1})
+        self.assertEqual(totals.check(round), [])
+
+    def test_form(self):
+        """Submitting a grading sheet should save its changed values."""
+
+        from django.contrib.auth.models import User
+        User.objects.create_superuser("admin", "admin@example.com", "password")
+        self.client.login(username="admin", password="password")
+        round = self.competition.rounds.get(ref="guts")
+        team = Team.objects.first()
+        url = "/grading/grade/team/{}/guts/".format(team.id)
+        self.assertEqual(self.client.get(url).status_code, 200)
+        question = round.questions.get(number=1)
+        self.client.post(url, {str(question.id): "1"})
+        self.assertEqual(models.Answer.objects.filter(team=team, question=question).order_by("id").first().value, 1)
+        self.assertEqual(totals.check(round), [])
+
+
+class SubmitAnswersTests(GradingTestCase):
+    """Test submitting many sheets of answers at once."""
+
+    def setUp(self):
+        """Log in as staff."""
+
+        super().setUp()
+        from django.contrib.auth.models import User
+        User.objects.create_superuser("admin", "admin@example.com", "password")
+        self.client.login(username="admin", password="password")
+
+    def post(self, sheets):
+        """Submit sheets to the API."""
+
+        return self.client.post("/grading/api/answers/", json.dumps({"sheets": sheets}), content_type="application/json")
+
+    def test_submit(self):
+        """Valid sheets should be saved together and invalid ones reported."""
+
+        team = Team.objects.create(
+            name="Late Team", number=99, school=School.objects.first(), competition=self.competition, division=1)
+        student = Student.objects.filter(attending=True).first()
+        guts = self.competition.rounds.get(ref="guts")
+        sheets = [
+            {"round": "guts", "team": team.id, "answers": {"1": 1, "2": 0, "26": 120.5}},
+            {"round": "subject1", "student": student.id, "answers": {"1": 1, "2": None}},
+            {"round": "guts", "team": team.id, "answers": {"1": 2}},
+            {"round": "guts", "team": team.id, "answers": {"31": 1}},
+            {"round": "relay", "team": team.id, "answers": {}},
+            {"round": "guts", "student": student.id, "answers": {"1": 1}},
+            {"round": "guts", "team": team.id, "answers": {"3": "1"}}]
+
+        response = self.post(sheets)
+        self.assertEqual(response.status_code, 200)
+        results = json.loads(response.content)["results"]
+        self.assertEqual([result["ok"] for result in results], [True, True, False, False, False, False, False])
+        self.assertEqual((results[0]["created"], results[0]["changed"]), (3, 3))
+        self.assertIn("0, 1, or null", results[2]["error"])
+
+        values = dict(models.Answer.objects.filter(team=team).values_list("question__number", "value"))
+        self.assertEqual(values, {1: 1, 2: 0, 26: 120.5})
+        self.assertEqual(
+            models.Answer.objects.filter(student=student, question__round__ref="subject1", question__number=1)
+            .order_by("id").first().value, 1)
+        self.assertEqual(totals.check(guts), [])
+
+        again = json.loads(self.post(sheets[:1]).content)["results"]
+        self.assertEqual((again[0]["created"], again[0]["changed"]), (0, 0))
+
+    def test_bad_request(self):
+        """Bodies without a list of sheets should be rejected."""
+
+        response = self.client.post("/grading/api/answers/", "nope", content_type="application/json")
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.client.get("/grading/api/answers/").status_code, 405)
+        self.assertEqual(self.post([{}] * (answers.MAX_SHEETS + 1)).status_code, 400)
+
+        body = json.dumps({"sheets": []})
+        self.assertEqual(self.client.post("/grading/api/answers/", body, content_type="text/plain").status_code, 415)
+        Competition.objects.filter(id=self.competition.id).update(active=False)
+        self.assertEqual(self.post([]).status_code, 404)
+
+    def test_csrf(self):
+        """Submissions should need the CSRF token of the staff session."""
+
+        from django.test import Client
+        client = Client(enforce_csrf_checks=True)
+        client.login(username="admin", password="password")
+        body = json.dumps({"sheets": []})
+        self.assertEqual(client.post("/grading/api/answers/", body, content_type="application/json").status_code, 403)
+
+        from django.middleware.csrf import _get_new_csrf_token
+        token = _get_new_csrf_token()
+        client.cookies[settings.CSRF_COOKIE_NAME] = token
+        response = client.post("/grading/api/answers/", body, content_type="application/json", HTTP_X_CSRFTOKEN=token)
+        self.assertEqual(response.status_code, 200)
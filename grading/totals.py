@@ -0,0 +1,134 @@
+"""Incremental running totals of raw round scores.
+
+Whenever an answer is saved, the difference between its new and old
+raw score, the question weight times the value, is added to the total
+of its team or student for the round. Reading the raw scores of a
+round then only requires reading the totals. Totals can be rebuilt
+from scratch and checked against the raw output of grade_round.
+"""
+
+from django.db import IntegrityError, transaction
+from django.db.models import F, Sum, FloatField
+
+import collections
+
+import coaches.models
+from . import grading, matrix, models
+
+
+def raw_score(weight: float, value):
+    """Get the raw score of an answer value to a question."""
+
+    return weight * (value or 0)
+
+
+def apply(changes):
+    """Apply a batch of answer changes to the running totals.
+
+    Each change is a tuple of the answer, its old value, and its new
+    value. Changes to the same total are merged so that every affected
+    total is written once. Missing totals are only created for changes
+    that set a value and move the score.
+    """
+
+    changes = list(changes)
+    questions = dict((id, (weight, round_id)) for id, weight, round_id in models.Question.objects.filter(
+        id__in=set(answer.question_id for answer, old, new in changes)).values_list("id", "weight", "round_id"))
+
+    deltas = collections.defaultdict(float)
+    created = collections.defaultdict(bool)
+    for answer, old, new in changes:
+        if answer.question_id not in questions:
+            continue
+        weight, round_id = questions[answer.question_id]
+        delta = raw_score(weight, new) - raw_score(weight, old)
+        if answer.student_id is not None:
+            key = (round_id, answer.student_id, None)
+        elif answer.team_id is not None:
+            key = (round_id, None, answer.team_id)
+        else:
+            continue
+        deltas[key] += delta
+        created[key] |= new is not None and delta != 0
+
+    for (round_id, student_id, team_id), delta in deltas.items():
+        updated = models.RoundTotal.objects.filter(
+            round_id=round_id, student_id=student_id, team_id=team_id).update(total=F("total") + delta)
+
+        # Answers are already saved, so a missing total is just summed,
+        # but removals never create one, as their owner may be going too
+        if not updated and created[round_id, student_id, team_id]:
+            total = models.Answer.objects.filter(
+                question__round_id=round_id, student_id=student_id, team_id=team_id
+            ).aggregate(total=_raw_sum())["total"] or 0
+            try:
+                with transaction.atomic():
+                    models.RoundTotal.objects.create(
+                        round_id=round_id, student_id=student_id, team_id=team_id, total=total)
+
+            # Another writer created the total after these answers were saved
+            except IntegrityError:
+                models.RoundTotal.objects.filter(
+                    round_id=round_id, student_id=student_id, team_id=team_id).update(total=total)
+
+
+def _raw_sum():
+    """Aggregate for the raw score of a set of answers."""
+
+    return Sum(F("value") * F("question__weight"), output_field=FloatField())
+
+
+def rebuild(competition):
+    """Recompute every running total of a competition from its answers."""
+
+    rows = models.Answer.objects.filter(
+        question__round__competition=competition
+    ).values("question__round", "student", "team").annotate(total=_raw_sum())
+
+    with transaction.atomic():
+        models.RoundTotal.objects.filter(round__competition=competition).delete()
+        models.RoundTotal.objects.bulk_create(
+            models.RoundTotal(
+                round_id=row["question__round"],
+                student_id=row["student"],
+                team_id=row["team"],
+                total=row["total"] or 0)
+            for row in rows if row["student"] is not None or row["team"] is not None)
+
+
+def read(round: models.Round):
+    """Read the raw scores of a round by division from the totals."""
+
+    group, entities = matrix.round_entities(round)
+    if entities is None:
+        return None
+
+    totals = dict(models.RoundTotal.objects.filter(
+        round=round, **{group + "__isnull": False}).values_list(group + "_id", "total"))
+    scores = grading.ChillDictionary()
+    for division in coaches.models.DIVISIONS_MAP:
+        scores[division] = grading.ChillDictionary()
+    for entity in entities:
+        scores[matrix.entity_division(group, entity)][entity] = totals.get(entity.id, 0)
+    return scores
+
+
+def check(round: models.Round, tolerance: float=1e-6):
+    """Compare the totals of a round to the raw round grader output.
+
+    Returns a list of the entities whose total differs from the score
+    given by the base grader, along with both values.
+    """
+
+    expected = grading.CompetitionGrader(round.competition).grade_round(round)
+    actual = read(round)
+    if expected is None:
+        return []
+
+    mismatches = []
+    for division in expected:
+        for entity, score in expected[division].items():
+            total = actual[division].get(entity, 0)
+            if abs(total - score) > tolerance:
+                mismatches.append((entity, total, score))
+    return mismatches
@@ -13,6 +13,7 @@ urlpatterns = [
     url(r"^grade/teams/$", views.TeamsView.as_view(), name="teams"),
     url(r"^grade/(?P<grouping>\w+)/(?P<any_id>\d+)/(?P<round_id>\w+)/$", views.score, name="score"),
     url(r"^grade/statistics/$", views.statistics, name="statistics"),
+    url(r"^api/answers/$", views.submit_answers, name="api_answers"),
 
     # Logistics
     url(r"^attendance/$", views.attendance, name="attendance"),
@@ -27,7 +28,10 @@ urlpatterns = [
     url(r"^scoreboard/students/$", views.student_scoreboard, name="scoreboard_students"),
     url(r"^scoreboard/teams/$", views.team_scoreboard, name="scoreboard_teams"),
     url(r"^live/(?P<round_id>\w+)/update/$", views.live_update, name="live_update"),
+    url(r"^live/(?P<round_id>\w+)/events/$", views.live_events, name="live_events"),
     url(r"^live/(?P<round_id>\w+)/$", views.live, name="live"),
+    url(r"^scoreboard/snapshots/$", views.snapshot_list, name="snapshots"),
+    url(r"^api/profile/$", views.profile, name="api_profile"),
 
     # Sponsor scores
     url(r"^scoreboard/sponsors/$", views.sponsor_scoreboard, name="scoreboard_sponsors"),
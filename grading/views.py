@@ -1,24 +1,126 @@
+from django.conf import settings
 from django.contrib.auth.decorators import login_required
 from django.contrib.admin.views.decorators import staff_member_required
 from django.views.decorators.csrf import csrf_exempt
 from django.views import View
 from django.views.generic import ListView
 from django.shortcuts import render, redirect, HttpResponse, get_object_or_404
+from django.http import StreamingHttpResponse, HttpResponseBadRequest, HttpResponseNotAllowed
+from django.utils.cache import get_conditional_response, patch_vary_headers, quote_etag
+from django.utils.http import http_date
 from django.db.models import Q
 
 import json
 import math
+import hashlib
+import time
+import datetime
 import collections
 import itertools
 import traceback
 
 from home.models import User, Competition
 from coaches.models import Coaching, Student, Team, Chaperone, DIVISIONS_MAP, DIVISIONS, SUBJECTS
-from .models import Round, Question, Answer, ESTIMATION
-from . import grading
+from .models import Round, Question, Answer, ScoreSnapshot, ESTIMATION, TEAM
+from . import answers, backends, grading, profiling, snapshots
+from . import live as live_scores
 from .forms import StatsForm
 
 
+# Seconds for which scoreboards show stale scores while refreshing them
+STALE_BEFORE = 600
+
+# Rendered scoreboard responses by entity tag
+rendered = backends.LocalStore(128)
+
+
+def grader_results(grader, method, **kwargs):
+    """Get the result of a cached grader method.
+
+    If the scoreboard daemon is grading, results are only read from
+    the grading cache and never calculated during the request.
+    """
+
+    # Fall back to the latest snapshot after a restart
+    function = getattr(grader, method)
+    if grader.cache_get(function.cache_name) is None:
+        snapshots.restore(grader)
+
+    if getattr(settings, "GRADING_DAEMON", False):
+        result = grader.cache_get(function.cache_name)
+        if result is None:
+            raise LookupError("Scores have not been published by the scoreboard daemon yet.")
+        return result
+
+    start = time.time()
+    result = function(**kwargs)
+    if grader.cache[function.cache_name].time >= start:
+        snapshots.capture(grader)
+    return result
+
+
+def score_version(grader, names, *parts):
+    """Identify the cached results shown on a page by when they were computed.
+
+    Returns a tag of the results and any other parts of the page along
+    with the time of the newest result, or None if a result is missing.
+    """
+
+    items = [grader.cache.get(name) for name in names]
+    if any(item is None for item in items):
+        return None
+    tag = [grader.competition.id] + ["{}@{!r}".format(name, item.time) for name, item in zip(names, items)]
+    return "|".join(map(str, tag + list(parts))), max(item.time for item in items)
+
+
+def versioned_response(request, version, page, csrf: bool=False):
+    """Respond with a page that only changes along with its version.
+
+    The response gets a strong entity tag and last modified time from
+    the version, so requests with a matching entity tag are answered
+    with 304 Not Modified, and its content is only rendered once per
+    version. Pages with CSRF tokens are kept per token, and rendered
+    every time for clients that have none yet.
+    """
+
+    if version is None or csrf and "CSRF_COOKIE" not in request.META:
+        return page()
+
+    tag, modified = version
+    if csrf:
+        tag += "|" + request.META["CSRF_COOKIE"]
+    etag = quote_etag(hashlib.sha256(tag.encode()).hexdigest())
+    last_modified = int(modified)
+
+    # Last modified times only have a resolution of a second, so
+    # conditional requests are only answered from the entity tag
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        entry = rendered.get(etag)
+        if entry is None:
+            response = page()
+            if response.status_code != 200:
+                return response
+            rendered.set(etag, (response.content, response["Content-Type"]))
+        else:
+            response = HttpResponse(entry[0], content_type=entry[1])
+
+    response["ETag"] = etag
+    response["Last-Modified"] = http_date(last_modified)
+    patch_vary_headers(response, ("Cookie",))
+    return response
+
+
+def recalculate(grader, method):
+    """Recalculate the result of a cached grader method."""
+
+    if getattr(settings, "GRADING_DAEMON", False):
+        grader.cache_set(grading.RECALCULATE, True)
+    else:
+        getattr(grader, method)(use_cache=False)
+        snapshots.capture(grader)
+
+
 # Staff check
 
 class StaffMemberRequired(View):
@@ -37,12 +139,25 @@ class StaffMemberRequired(View):
 
 @staff_member_required
 def index(request):
+    competition = Competition.current()
+    profile = profiling.last_run(competition.grader) if competition else None
     return render(request, "grading/index.html", {
-        "competition": Competition.current(),
+        "competition": competition,
         "students": Student.current().count(),
         "teams": Team.current().count(),
         "chaperones": Chaperone.current().count(),
-        "coaching": Coaching.current().all()})
+        "coaching": Coaching.current().all(),
+        "profile": profile,
+        "profile_started": datetime.datetime.fromtimestamp(profile["started"]) if profile else None,
+        "stages": list(profiling.flatten(profile))})
+
+
+@staff_member_required
+def profile(request):
+    """Get the breakdown of the last grading run."""
+
+    competition = Competition.current()
+    return HttpResponse(json.dumps(profiling.last_run(competition.grader) if competition else None))
 
 
 class StudentsView(ListView, StaffMemberRequired):
@@ -102,21 +217,14 @@ def score(request, grouping, any_id, round_id):
 def score_team(request, team_id, round):
     """Scoring view for a team."""
 
-    # Iterate questions and get answers
+    # Pair questions with answers, creating any that are missing
     team = Team.objects.filter(id=team_id).first()
-    answers = []
-    question_answer = []
-    for question in round.questions.order_by("number").all():
-        answer = Answer.objects.filter(team=team, question=question).first()
-        if not answer:
-            answer = Answer(team=team, question=question)
-            answer.save()
-        answers.append(answer)
-        question_answer.append((question, answer))
+    question_answer = answers.sheet(round, team)
+    sheet = [answer for question, answer in question_answer]
 
     # Update the answers
     if request.method == "POST":
-        update_answers(request, answers)
+        update_answers(request, sheet)
         return redirect("grading:teams")
 
     # Render the grading view
@@ -132,21 +240,14 @@ def score_team(request, team_id, round):
 def score_individual(request, student_id, round):
     """Scoring view for an individual."""
 
-    # Iterate questions and get answers
+    # Pair questions with answers, creating any that are missing
     student = Student.objects.filter(id=student_id).first()
-    answers = []
-    question_answer = []
-    for question in round.questions.order_by("number").all():
-        answer = Answer.objects.filter(student=student, question=question).first()
-        if not answer:
-            answer = Answer(student=student, question=question)
-            answer.save()
-        answers.append(answer)
-        question_answer.append((question, answer))
+    question_answer = answers.sheet(round, student)
+    sheet = [answer for question, answer in question_answer]
 
     # Update the answers
     if request.method == "POST":
-        update_answers(request, answers)
+        update_answers(request, sheet)
         return redirect("grading:students")
 
     # Render the grading view
@@ -159,16 +260,48 @@ def score_individual(request, student_id, round):
 
 
 @staff_member_required
-def update_answers(request, answers):
-    """Update the answers to a round by an individual or group."""
+def update_answers(request, sheet):
+    """Update the answers to a round by an individual or group at once."""
 
-    for answer in answers:
+    values = []
+    for answer in sheet:
         id = str(answer.question.id)
         if id in request.POST:
-            value = None if str(request.POST[id]) == "" else float(request.POST[id])
-            if answer.value != value:
-                answer.value = value
-                answer.save()
+            values.append((answer, None if str(request.POST[id]) == "" else float(request.POST[id])))
+    answers.write(values)
+
+
+@staff_member_required
+def submit_answers(request):
+    """Save the answers of many sheets at once from a JSON body.
+
+    The body holds a list of sheets under `sheets`, each naming a round,
+    a team or student, and values by question number. Requests are sent
+    from a staff session and carry its CSRF token in the `X-CSRFToken`
+    header. Responds with a result per sheet in the order they were sent.
+    """
+
+    if request.method != "POST":
+        return HttpResponseNotAllowed(["POST"])
+    if request.content_type != "application/json":
+        return HttpResponse(
+            json.dumps({"error": "Expected a JSON body."}), status=415, content_type="application/json")
+    try:
+        sheets = json.loads(request.body.decode())["sheets"]
+        if not isinstance(sheets, list):
+            raise TypeError()
+    except (ValueError, KeyError, TypeError):
+        return HttpResponseBadRequest(json.dumps({"error": "Expected an object with a list of sheets."}))
+    if len(sheets) > answers.MAX_SHEETS:
+        return HttpResponseBadRequest(json.dumps({
+            "error": "At most {} sheets can be sent at once.".format(answers.MAX_SHEETS)}))
+
+    competition = Competition.current()
+    if competition is None:
+        return HttpResponse(
+            json.dumps({"error": "There is no active competition."}), status=404, content_type="application/json")
+    results = answers.submit(competition, sheets)
+    return HttpResponse(json.dumps({"results": results}), content_type="application/json")
 
 
 @login_required
@@ -266,28 +399,63 @@ def live(request, round_id):
     """Get the live guts scoreboard."""
 
     if round_id == "guts":
-        return render(request, "grading/guts.html", {"divisions": (DIVISIONS[0][1], DIVISIONS[1][1])})
+        return render(request, "grading/guts.html", {
+            "divisions": (DIVISIONS[0][1], DIVISIONS[1][1]),
+            "events": getattr(settings, "GRADING_LIVE_EVENTS", False)})
     else:
         return redirect("student_view")
 
 
 @staff_member_required
 def live_update(request, round_id):
-    """Get the live scoreboard update."""
+    """Get the teams whose live score or rank changed since a version.
 
-    if round_id == "guts":
-        grader = Competition.current().grader
-        scores = grader.guts_live_round_scores(use_cache_before=20)
-        named_scores = dict()
-        for division in scores:
-            division_name = DIVISIONS_MAP[division]
-            named_scores[division_name] = {}
-            for team in scores[division]:
-                named_scores[division_name][team.name] = scores[division][team]
-        return HttpResponse(json.dumps(named_scores).encode())
-    else:
+    Clients send the version of the last update they received as
+    `since`, and get every team if they send none. Until the scoreboard
+    daemon has built the live scores, no teams are sent.
+    """
+
+    grader = Competition.current().grader
+    round = grader.round(round_id)
+    if round is None or round.grouping != TEAM:
         return HttpResponse("{}")
 
+    try:
+        since = int(request.GET["since"])
+    except (KeyError, ValueError):
+        since = None
+    state = live_scores.current(grader, round)
+    version = "{}|live:{}|{}|{}".format(grader.competition.id, round.ref, state["version"], since), state["time"]
+    return versioned_response(request, version, lambda: HttpResponse(
+        live_scores.dumps(grader, round, since, state)[1].encode()))
+
+
+@staff_member_required
+def live_events(request, round_id):
+    """Stream new versions of the live scores as server-sent events.
+
+    Reconnecting browsers resume from the last event they received.
+    Streams are only served if `GRADING_LIVE_EVENTS` is set, since each
+    holds a worker while open.
+    """
+
+    if not getattr(settings, "GRADING_LIVE_EVENTS", False):
+        return HttpResponse(status=404)
+
+    grader = Competition.current().grader
+    round = grader.round(round_id)
+    if round is None or round.grouping != TEAM:
+        return HttpResponse(status=404)
+
+    try:
+        since = int(request.META.get("HTTP_LAST_EVENT_ID") or request.GET["since"])
+    except (KeyError, ValueError):
+        since = None
+    response = StreamingHttpResponse(live_scores.events(grader, round, since), content_type="text/event-stream")
+    response["Cache-Control"] = "no-cache"
+    response["X-Accel-Buffering"] = "no"
+    return response
+
 
 @login_required
 def sponsor_scoreboard(request):
@@ -295,30 +463,30 @@ def sponsor_scoreboard(request):
 
     grader = Competition.current().grader
 
-    # Check subject scores
-    subject_scores = grader.cache_get("subject_scores")
-    if subject_scores is None:
-        subject_scores = grader.calculate_individual_scores(use_cache=False)
-
-    # Check team scores
-    team_scores = grader.cache_get("team_overall_scores")
-    if team_scores is None:
-        team_scores = grader.calculate_team_scores(use_cache=True)
-
+    # Cached scores are only recalculated if their rounds changed
     school = Coaching.current(coach=request.user).first().school
-    individual_scores = grading.prepare_school_individual_scores(school, subject_scores)
-    team_scores = grading.prepare_school_team_scores(
-        school,
-        grader.cache_get("raw_guts_scores"),
-        grader.cache_get("raw_team_scores"),
-        grader.cache_get("team_individual_scores"),
-        team_scores)
-
-    print(individual_scores, team_scores)
+    try:
+        grader_results(grader, "calculate_individual_scores", use_stale_before=STALE_BEFORE)
+        team_scores = grader_results(grader, "calculate_team_scores", use_stale_before=STALE_BEFORE)
+    except LookupError:
+        return render(request, "grading/scoring.html", {"individual_scores": [], "team_scores": []})
+
+    def page():
+        return render(request, "grading/scoring.html", {
+            "individual_scores": grading.prepare_school_individual_scores(school, grader.cache_get("subject_scores")),
+            "team_scores": grading.prepare_school_team_scores(
+                school,
+                grader.cache_get("raw_guts_scores"),
+                grader.cache_get("raw_team_scores"),
+                grader.cache_get("team_individual_scores"),
+                team_scores)})
 
-    return render(request, "grading/scoring.html", {
-        "individual_scores": individual_scores,
-        "team_scores": team_scores})
+    version = score_version(
+        grader,
+        ("subject_scores", grader.calculate_team_scores.cache_name,
+         "raw_guts_scores", "raw_team_scores", "team_individual_scores"),
+        "sponsors", request.user.pk, school.pk)
+    return versioned_response(request, version, page)
 
 
 @staff_member_required
@@ -328,23 +496,35 @@ def student_scoreboard(request):
     grader = Competition.current().grader
 
     if request.method == "POST" and "recalculate" in request.POST:
-        grader.calculate_individual_scores(use_cache=False)
+        if "refit" in request.POST:
+            grader.forget_fits()
+        recalculate(grader, "calculate_individual_scores")
         return redirect("grading:scoreboard_students")
 
     try:
-        individual_scores = grading.prepare_individual_scores(
-            grader.calculate_individual_scores(use_cache=True))
-        subject_scores = grading.prepare_subject_scores(grader.cache_get("subject_scores"))
-        context = {
-            "individual_scores": individual_scores,
-            "subject_scores": subject_scores,
-            "individual_powers": grader.individual_weight,
-            "individual_bonus": {}}
-            #"individual_powers": grader.individual_powers,
-            #"individual_bonus": grader.individual_bonus}
+        results = grader_results(grader, "calculate_individual_scores", use_cache=True)
     except Exception:
-        context = {"error": traceback.format_exc().replace("\n", "<br>")}
-    return render(request, "grading/student/scoreboard.html", context)
+        return render(request, "grading/student/scoreboard.html", {
+            "error": traceback.format_exc().replace("\n", "<br>")})
+
+    def page():
+        try:
+            individual_scores = grading.prepare_individual_scores(results)
+            subject_scores = grading.prepare_subject_scores(grader.cache_get("subject_scores"))
+            context = {
+                "individual_scores": individual_scores,
+                "subject_scores": subject_scores,
+                "individual_powers": grader.cache_get("individual_powers") or grader.cache_get("individual_weights"),
+                "individual_bonus": {}}
+                #"individual_powers": grader.individual_powers,
+                #"individual_bonus": grader.individual_bonus}
+        except Exception:
+            context = {"error": traceback.format_exc().replace("\n", "<br>")}
+        return render(request, "grading/student/scoreboard.html", context)
+
+    version = score_version(
+        grader, (grader.calculate_individual_scores.cache_name, "subject_scores"), "students", request.user.pk)
+    return versioned_response(request, version, page, csrf=True)
 
 
 @staff_member_required
@@ -353,20 +533,48 @@ def team_scoreboard(request):
 
     grader = Competition.current().grader
     if request.method == "POST" and "recalculate" in request.POST:
-        grader.calculate_team_scores(use_cache=False)
+        if "refit" in request.POST:
+            grader.forget_fits()
+        recalculate(grader, "calculate_team_scores")
         return redirect("grading:scoreboard_teams")
 
     try:
-        team_scores = grader.calculate_team_scores(use_cache=True)
-        context = {
-            "team_scores": grading.prepare_composite_team_scores(
-                grader.cache_get("raw_guts_scores"), grader.cache_get("guts_scores"),
-                grader.cache_get("raw_team_scores"), grader.cache_get("team_scores"),
-                grader.cache_get("team_individual_scores"),
-                team_scores)}
+        team_scores = grader_results(grader, "calculate_team_scores", use_cache=True)
     except Exception:
-        context = {"error": traceback.format_exc().replace("\n", "<br>")}
-    return render(request, "grading/team/scoreboard.html", context)
+        return render(request, "grading/team/scoreboard.html", {
+            "error": traceback.format_exc().replace("\n", "<br>")})
+
+    def page():
+        try:
+            context = {
+                "team_scores": grading.prepare_composite_team_scores(
+                    grader.cache_get("raw_guts_scores"), grader.cache_get("guts_scores"),
+                    grader.cache_get("raw_team_scores"), grader.cache_get("team_scores"),
+                    grader.cache_get("team_individual_scores"),
+                    team_scores)}
+        except Exception:
+            context = {"error": traceback.format_exc().replace("\n", "<br>")}
+        return render(request, "grading/team/scoreboard.html", context)
+
+    version = score_version(
+        grader,
+        (grader.calculate_team_scores.cache_name, "raw_guts_scores", "guts_scores",
+         "raw_team_scores", "team_scores", "team_individual_scores"),
+        "teams", request.user.pk)
+    return versioned_response(request, version, page, csrf=True)
+
+
+@staff_member_required
+def snapshot_list(request):
+    """List score snapshots and compare two of them."""
+
+    competition = Competition.current()
+    context = {"snapshots": ScoreSnapshot.objects.filter(competition=competition)[:50]}
+    if "old" in request.GET and "new" in request.GET:
+        old = get_object_or_404(ScoreSnapshot, pk=request.GET["old"], competition=competition)
+        new = get_object_or_404(ScoreSnapshot, pk=request.GET["new"], competition=competition)
+        context.update({"old": old, "new": new, "differences": snapshots.compare(old, new)})
+    return render(request, "grading/snapshots.html", context)
 
 
 @staff_member_required
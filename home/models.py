@@ -26,9 +26,8 @@ class Competition(models.Model):
     # Semantics
     year = models.CharField(max_length=20)  # First, second, etc.
 
-    # Grader path and cache
+    # Grader path
     _grader = models.CharField(max_length=40, null=True, blank=True)
-    _grader_instance = None
 
     def __repr__(self):
         """Represent the competition as a string."""
@@ -60,15 +59,10 @@ class Competition(models.Model):
 
     @property
     def grader(self):
-        """Instantiate a grader of the competition type."""
+        """Get the pooled grader of the competition type."""
 
-        if Competition._grader_instance is not None:
-            return Competition._grader_instance
-
-        import importlib
-        grader = importlib.import_module(self._grader).Grader(self)
-        Competition._grader_instance = grader
-        return grader
+        from grading import plans
+        return plans.pool.get(self)
 
     @property
     def can_register(self):
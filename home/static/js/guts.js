@@ -1,46 +1,96 @@
 let scoreboards;
 let frozen = false;
 
+// Live scores by team id and the version they are current as of
+let teams = {};
+let version = null;
+let polling = null;
+
+function render() {
+
+  const divisions = {};
+  for (const id of Object.keys(teams)) {
+    const team = teams[id];
+    (divisions[team.division] = divisions[team.division] || []).push(team);
+  }
+
+  for (const division of Object.keys(divisions)) {
+    const ranked = divisions[division];
+    ranked.sort((a, b) => a.rank - b.rank || a.name.localeCompare(b.name));
+
+    scoreboards[division + "1"].empty();
+    scoreboards[division + "2"].empty();
+
+    const half = Math.ceil(ranked.length / 2);
+
+    for (let i = 0; i < ranked.length; i++)
+      scoreboards[division + (i < half ? "1" : "2")].append(
+        $("<tr>").append(
+          $("<td>").text(ranked[i].rank),
+          $("<td class='team'>").text(ranked[i].name),
+          $("<td>").text(Math.round(ranked[i].score * 1000) / 1000)));
+  }
+}
+
+function apply(update) {
+  if (update.version === undefined) return;
+
+  // Far behind clients get every team again
+  if (update.full) teams = {};
+  for (const id of Object.keys(update.teams)) {
+    if (update.teams[id] === null) delete teams[id];
+    else teams[id] = update.teams[id];
+  }
+  version = update.version;
+
+  if (frozen) console.log("Didn't update!");
+  else render();
+  console.log("Updated scoreboard!");
+}
+
 function update() {
 
   console.log("Updating...");
-  if (frozen) console.log("Didn't update!");
 
-  $.ajax("/grading/live/guts/update/").then(scores => {
-    scores = JSON.parse(scores);
+  const query = version === null ? "" : "?since=" + version;
+  $.ajax("/grading/live/guts/update/" + query).then(
+    update => apply(JSON.parse(update)),
+    error => console.log(error));
+}
 
-    for (let division of Object.keys(scores)) {
-      const teams = [];
-      for (const team in scores[division])
-        if (scores[division].hasOwnProperty(team))
-          teams.push(team);
-      teams.sort((a, b) => scores[division][b] - scores[division][a]);
+function poll() {
+  if (polling) return;
+  polling = setInterval(update, 25*1000);
+  update();
+}
 
-      scoreboards[division + "1"].empty();
-      scoreboards[division + "2"].empty();
+function listen() {
 
-      const half = Math.ceil(teams.length / 2);
+  // Poll instead where server-sent events are unavailable or disabled
+  if (!window.EventSource || !events) return poll();
 
-      for (let i = 0; i < teams.length; i++)
-        scoreboards[division + (i < half ? "1" : "2")].append(
-          "<tr><td>" + (i + 1) + "</td>" +
-          "<td class='team'>" + teams[i] + "</td>" +
-          "<td>" + Math.round(scores[division][teams[i]] * 1000) / 1000 + "</td></tr>");
+  const source = new EventSource("/grading/live/guts/events/" + (version === null ? "" : "?since=" + version));
+  source.addEventListener("standings", event => apply(JSON.parse(event.data)));
+  source.onerror = () => {
+    if (source.readyState === EventSource.CLOSED) {
+      console.log("Lost live updates, polling instead");
+      poll();
     }
-    console.log("Updated scoreboard!");
-  }, error => console.log(error));
+  };
 }
 
 function freeze() {
   frozen = !frozen;
   if (frozen) document.getElementById("freeze").innerHTML = "Frozen!";
-  else document.getElementById("freeze").innerHTML = "Freeze!"
+  else {
+    document.getElementById("freeze").innerHTML = "Freeze!";
+    render();
+  }
 }
 
 window.onload = function() {
   scoreboards = {};
   for (let scoreboard of document.getElementsByClassName("scoreboard-body"))
     scoreboards[scoreboard.id] = $(scoreboard);
-  update();
-  setInterval(update, 25*1000);
+  listen();
 };
@@ -86,6 +86,49 @@ DATABASES = {
 }
 
 
+# Caches
+# https://docs.djangoproject.com/en/1.9/topics/cache/
+
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+    },
+    # Grader results and the locks that compute them once at a time. The
+    # locks need an atomic add, so deployments with several worker
+    # processes or the scoreboard daemon should use Memcached or Redis
+    # here. A FileBasedCache is shared but gives no mutual exclusion and
+    # culls entries at random once full.
+    "grading": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        "LOCATION": "grading",
+        "TIMEOUT": None,
+        "OPTIONS": {"MAX_ENTRIES": 100000},
+    },
+}
+
+# Cache alias for grader results
+GRADING_CACHE = "grading"
+
+# Whether scores are calculated by `manage.py scoreboard` rather than views
+GRADING_DAEMON = False
+
+# Whether grading stages also measure peak memory, which slows them down
+GRADING_PROFILE_MEMORY = False
+
+# Workers for independent grading steps, run serially if fewer than two
+GRADING_WORKERS = 4
+
+# Whether the live guts scoreboard is pushed over server-sent events
+# rather than polled. Each open stream holds a worker for up to five
+# minutes, so only enable this with a server that handles long-lived
+# responses, such as gunicorn with gevent or threaded workers.
+GRADING_LIVE_EVENTS = False
+
+# Pool for steps that only compute, either "thread" or "process", where
+# processes are forked and so are best left to the scoreboard daemon
+GRADING_POOL = "thread"
+
+
 # Password validation
 # https://docs.djangoproject.com/en/1.9/ref/settings/#auth-password-validators
 